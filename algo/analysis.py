@@ -0,0 +1,439 @@
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+import concurrent.futures
+import math
+import open3d as o3d
+import numpy as np
+import scipy
+from skimage import measure
+from gridscan import grid_dbscan
+import pccache
+from spatial import SpatialIndex
+
+
+def _conic_design(points: np.ndarray) -> np.ndarray:
+    """
+    Build the design matrix rows [x^2, xy, y^2, x, y, 1] for general conics through (..., 2) arrays of points.
+    """
+    x = points[..., 0]
+    y = points[..., 1]
+    return np.stack((x * x, x * y, y * y, x, y, np.ones_like(x)), axis=-1)
+
+
+def _fit_conics(samples: np.ndarray) -> np.ndarray:
+    """
+    Least squares fit of a conic to each set of points in a (T, k, 2) array, all in one batched SVD.
+
+    Returns a (T, 6) array of conic coefficients (A, B, C, D, E, F) with unit norm.
+    """
+    _, _, vh = np.linalg.svd(_conic_design(samples))
+    return vh[..., -1, :]
+
+
+def _conic_to_ellipse(conics: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert a (T, 6) array of conic coefficients to ellipses.
+
+    Returns a tuple of (centers, axes, valid), where centers is (T, 2), axes is (T, 2) of the semi-axis lengths, and
+    valid is a boolean mask of which conics are actually real ellipses.
+    """
+    a, b, c, d, e, f = conics.T
+    det = 4 * a * c - b * b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x0 = (b * e - 2 * c * d) / det
+        y0 = (b * d - 2 * a * e) / det
+        # Value of the conic at the center
+        f0 = f + (d * x0 + e * y0) / 2
+        # Eigenvalues of the quadratic part
+        root = np.sqrt((a - c) ** 2 + b * b)
+        axes_sq = -f0[:, None] / np.column_stack(((a + c + root) / 2, (a + c - root) / 2))
+        valid = (det > 0) & np.all(axes_sq > 0, axis=1)
+        axes = np.sqrt(np.where(valid[:, None], axes_sq, np.nan))
+    return np.column_stack((x0, y0)), axes, valid
+
+
+def _sampson_distances(points: np.ndarray, conics: np.ndarray) -> np.ndarray:
+    """
+    Approximate geometric distance from every point (N, 2) to every conic (T, 6). Returns a (T, N) array.
+    """
+    a, b, c, d, e, _ = (conics[:, i:i + 1] for i in range(6))
+    x = points[:, 0]
+    y = points[:, 1]
+    values = conics @ _conic_design(points).T
+    grad_x = 2 * a * x + b * y + d
+    grad_y = b * x + 2 * c * y + e
+    return np.abs(values) / np.sqrt(grad_x ** 2 + grad_y ** 2 + 1e-12)
+
+
+def fit_ellipse_ransac(points: np.ndarray, min_samples: int, residual_threshold: float, max_trials: int = 100,
+                       seed: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Robustly fit an ellipse to an (N, 2) array of points using RANSAC.
+
+    All max_trials random samples are drawn and fitted at once, and scored on the number of points within
+    residual_threshold of each fit; the best one is then refit on all of its inliers. Pass a seed to get the same
+    result every time.
+
+    Returns a tuple of (center, semi_axes, inliers), or None if no ellipse could be found.
+    """
+    n = len(points)
+    min_samples = max(min_samples, 5)
+    if n < min_samples:
+        return None
+    # Normalize the points so the conic fits are well conditioned
+    center = points.mean(axis=0)
+    scale = np.sqrt(np.mean(np.sum((points - center) ** 2, axis=1)))
+    if scale == 0:
+        return None
+    normalized = (points - center) / scale
+    threshold = residual_threshold / scale
+
+    rng = np.random.default_rng(seed)
+    # Random sample of min_samples distinct points for each trial
+    samples = np.argpartition(rng.random((max_trials, n)), min_samples - 1, axis=1)[:, :min_samples]
+    conics = _fit_conics(normalized[samples])
+    _, _, valid = _conic_to_ellipse(conics)
+    if not np.any(valid):
+        return None
+    residuals = _sampson_distances(normalized, conics)
+    inliers = residuals < threshold
+    counts = np.where(valid, np.count_nonzero(inliers, axis=1), -1)
+    # Break ties by the total residual of the inliers
+    inlier_error = np.sum(np.where(inliers, residuals, 0), axis=1)
+    best = np.lexsort((inlier_error, -counts))[0]
+    best_inliers = inliers[best]
+
+    conic = conics[best:best + 1]
+    if np.count_nonzero(best_inliers) >= 5:
+        refit = _fit_conics(normalized[best_inliers][None])
+        if _conic_to_ellipse(refit)[2][0]:
+            conic = refit
+    ellipse_center, axes, _ = _conic_to_ellipse(conic)
+    return ellipse_center[0] * scale + center, axes[0] * scale, best_inliers
+
+
+def compute_diameters_ellipse(points: np.ndarray, use_ransac: bool = True, seed: int = 0) -> Tuple[float, float]:
+    if len(points) < 3:
+        return (np.nan, np.nan)
+    # Use RANSAC to fit an ellipse to the points
+    if use_ransac:
+        ellipse = fit_ellipse_ransac(points, min(max(5, len(points) // 3), 20), 0.01, seed=seed)
+        if ellipse is None:
+            return compute_diameters_ellipse(points, use_ransac=False)
+        a, b = ellipse[1] * 2
+        return max(a, b), min(a, b)
+    ellipse = measure.fit.EllipseModel()
+    if not ellipse.estimate(points):
+        return np.nan, np.nan
+    a = ellipse.params[2] * 2
+    b = ellipse.params[3] * 2
+    return max(a, b), min(a, b)
+
+
+def compute_diameters_simple(points: np.ndarray) -> Tuple[float, float]:
+    if len(points) < 3:
+        return np.nan, np.nan
+    try:
+        hull = points[scipy.spatial.ConvexHull(points).vertices]
+    except scipy.spatial.qhull.QhullError:
+        return np.nan, np.nan
+    dist = scipy.spatial.distance_matrix(hull, hull)
+    i, j = np.unravel_index(np.argmax(dist), dist.shape)
+        # Compute the distance along the axis perpendicular to the diameter axis
+    # Find the vector to project onto, normalized and perpendicular to the difference between the diameter points
+    s = hull[i] - hull[j]
+    s /= np.sqrt(np.dot(s, s))
+    s[0], s[1] = -s[1], s[0]
+    # Find the length of each projection by taking the dot product
+    proj_lens = np.dot(hull - hull[i], s)
+    # Instead of taking the most positive projected length and subtracting the most negative, we take the projected
+    # length furthest from zero and double it. This is because in the scanned point cloud, the stem might appear as
+    # only half of an ellipse since the back is blocked
+    return dist[i, j], np.max(np.abs(proj_lens)) * 2
+
+
+class SliceResult(NamedTuple):
+    """
+    Stems found in a single slice.
+
+    labels is the cluster label for each point (-1 for noise), and diameters are the long diameters of each stem that
+    could be fit, from largest to smallest.
+    """
+    labels: np.ndarray
+    stem_count: int
+    diameters: List[float]
+
+
+def group_clusters(points: np.ndarray, labels: np.ndarray) -> List[np.ndarray]:
+    """
+    Split points up by cluster label, in one pass.
+
+    Returns a list with the points in each cluster, in order of label. Noise points (label -1) are left out.
+    """
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    grouped = points[order]
+    unique_labels, starts = np.unique(sorted_labels, return_index=True)
+    stops = np.append(starts[1:], len(sorted_labels))
+    return [grouped[start:stop] for label, start, stop in zip(unique_labels, starts, stops) if label >= 0]
+
+
+def analyze_slice(points: np.ndarray, eps: float, min_points: int, use_ellipse_fit: bool,
+                  use_ransac: bool, executor: concurrent.futures.Executor = None,
+                  labels: np.ndarray = None) -> SliceResult:
+    """
+    Find the stems in a flattened slice by clustering, and fit the diameter of each one.
+
+    Clustering is 2D, on x and y only, with gridscan.grid_dbscan(). If an executor is given, the fits for each stem
+    are done concurrently in it. If labels are given (e.g. from gridscan.SliceClusterer with the same eps and
+    min_points), they're used instead of clustering again.
+    """
+    if labels is None:
+        labels = grid_dbscan(points, eps, min_points)
+    # To find the stem diameter, we need the distance between the furthest 2 points
+    # These 2 points will always be a part of the convex hull
+    # Use numpy to find stem diameter, since the slice is 2D
+    clusters = [cluster[:, :2] for cluster in group_clusters(points, labels)] if len(labels) else []
+    def fit(cluster: np.ndarray) -> float:
+        if use_ellipse_fit:
+            return compute_diameters_ellipse(cluster, use_ransac=use_ransac)[0]
+        return compute_diameters_simple(cluster)[0]
+    fits = executor.map(fit, clusters) if executor is not None and len(clusters) > 1 else map(fit, clusters)
+    diameters = [diam for diam in fits if not math.isnan(diam)]
+    return SliceResult(labels, len(clusters), sorted(diameters, reverse=True))
+
+
+def _hull_vertices(points: np.ndarray) -> np.ndarray:
+    """
+    Get the vertices of the 2D convex hull of an (N, 2) array of points. Degenerate inputs are returned as is.
+    """
+    if len(points) < 3:
+        return points
+    try:
+        return points[scipy.spatial.ConvexHull(points).vertices]
+    except scipy.spatial.qhull.QhullError:
+        # All the points are on a line
+        return points
+
+
+def crown_width_from_hull(hull: np.ndarray, use_ellipse_fit: bool = True,
+                          use_ransac: bool = True) -> Tuple[float, float]:
+    """
+    Find the (long, short) crown width from the vertices of the tree's convex hull when squashed flat.
+    """
+    if use_ellipse_fit:
+        return compute_diameters_ellipse(hull, use_ransac=use_ransac)
+    return compute_diameters_simple(hull)
+
+
+def crown_width(points: np.ndarray, use_ellipse_fit: bool = True, use_ransac: bool = True) -> Tuple[float, float]:
+    """
+    Find the (long, short) crown width of a tree from an (N, 2+) array of points.
+    """
+    # Use convex hull to eliminate all the points not on the perimeter after squashing
+    return crown_width_from_hull(_hull_vertices(points[:, :2]), use_ellipse_fit, use_ransac)
+
+
+class ZSortedPoints:
+    """
+    Points sorted by height, so that every horizontal slice is a contiguous range that can be found by binary search.
+    """
+
+    def __init__(self, points: np.ndarray) -> None:
+        z = points[:, 2]
+        # Points loaded from the cache are already sorted, and checking is much cheaper than sorting
+        self.points = points if np.all(z[1:] >= z[:-1]) else points[np.argsort(z, kind="stable")]
+        self.z = self.points[:, 2].astype(np.float64)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @property
+    def z_min(self) -> float:
+        return self.z[0]
+
+    @property
+    def z_max(self) -> float:
+        return self.z[-1]
+
+    def slice_range(self, z: float, thickness: float) -> Tuple[int, int]:
+        """
+        Get the (start, stop) indices of the points strictly within thickness / 2 of z.
+        """
+        start = np.searchsorted(self.z, z - thickness / 2, side="right")
+        stop = np.searchsorted(self.z, z + thickness / 2, side="left")
+        return int(start), int(stop)
+
+    def slice(self, z: float, thickness: float) -> np.ndarray:
+        """
+        Get the points strictly within thickness / 2 of z, as a view into the sorted points.
+        """
+        start, stop = self.slice_range(z, thickness)
+        return self.points[start:stop]
+
+
+class CrownHull:
+    """
+    Cached convex hull of a tree squashed flat, for crown width.
+
+    The z-sorted points are split into chunks, and the hull of each chunk is found once (concurrently if an executor
+    is given). Since the hull of a union is the hull of the union of the hulls, the hull of the whole tree or any
+    height band is then just the hull of a few chunk hulls, plus the points of the chunks the band only partly covers.
+    """
+
+    def __init__(self, points: ZSortedPoints, chunk_size: int = 100_000,
+                 executor: concurrent.futures.Executor = None) -> None:
+        self.points = points
+        self.starts = np.arange(0, len(points), chunk_size)
+        self.stops = np.append(self.starts[1:], len(points))
+        chunks = [points.points[start:stop, :2] for start, stop in zip(self.starts, self.stops)]
+        if executor is not None:
+            self.chunk_hulls = list(executor.map(_hull_vertices, chunks))
+        else:
+            self.chunk_hulls = [_hull_vertices(chunk) for chunk in chunks]
+        self._bands = {}
+
+    def vertices(self, z_min: float = -np.inf, z_max: float = np.inf) -> np.ndarray:
+        """
+        Get the (M, 2) hull vertices of the points with z_min <= z <= z_max.
+        """
+        key = (z_min, z_max)
+        if key not in self._bands:
+            start = np.searchsorted(self.points.z, z_min, side="left")
+            stop = np.searchsorted(self.points.z, z_max, side="right")
+            parts = []
+            for i, (chunk_start, chunk_stop) in enumerate(zip(self.starts, self.stops)):
+                if chunk_stop <= start or chunk_start >= stop:
+                    continue
+                if start <= chunk_start and chunk_stop <= stop:
+                    parts.append(self.chunk_hulls[i])
+                else:
+                    parts.append(self.points.points[max(start, chunk_start):min(stop, chunk_stop), :2])
+            self._bands[key] = _hull_vertices(np.concatenate(parts)) if parts else np.empty((0, 2))
+        return self._bands[key]
+
+
+def flatten(slice_points: np.ndarray) -> np.ndarray:
+    """
+    Flatten the points in a slice onto its average height.
+    """
+    flat = slice_points.astype(np.float64)
+    if len(flat):
+        flat[:, 2] -= np.mean(flat[:, 2])
+    return flat
+
+
+def estimate_normals(points: np.ndarray, radius: float = 0.1, max_nn: int = 10,
+                     chunk_size: int = 1_000_000, index: SpatialIndex = None) -> np.ndarray:
+    """
+    Estimate the (unoriented) normal of every point from up to max_nn neighbours within radius, using open3d's KD-tree.
+
+    This is done in z-sorted chunks of chunk_size points, so the KD-tree never has to hold the whole cloud. Each chunk
+    includes the points within radius above and below it, so the results are the same as doing it all at once.
+
+    If an index built on the same points is given, its tree is used instead of building new ones.
+    """
+    if index is not None:
+        if len(index) != len(points):
+            raise ValueError(f"Index has {len(index)} points, but there are {len(points)} points")
+        return index.normals(radius, max_nn, chunk_size)
+    z = points[:, 2]
+    order = None if np.all(z[1:] >= z[:-1]) else np.argsort(z, kind="stable")
+    sorted_points = points if order is None else points[order]
+    sorted_z = sorted_points[:, 2]
+    param = o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn)
+    normals = np.empty_like(sorted_points, dtype=np.float64)
+    for start in range(0, len(sorted_points), chunk_size):
+        stop = min(start + chunk_size, len(sorted_points))
+        lo = np.searchsorted(sorted_z, sorted_z[start] - radius, side="left")
+        hi = np.searchsorted(sorted_z, sorted_z[stop - 1] + radius, side="right")
+        cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(sorted_points[lo:hi].astype(np.float64)))
+        cloud.estimate_normals(search_param=param)
+        normals[start:stop] = np.asarray(cloud.normals)[start - lo:stop - lo]
+    if order is None:
+        return normals
+    result = np.empty_like(normals)
+    result[order] = normals
+    return result
+
+
+def verticality_filter(points: np.ndarray, max_angle: float = 75, normals: np.ndarray = None,
+                       viewpoint: Tuple[float, float, float] = (0, 0, 0), radius: float = 0.1, max_nn: int = 10,
+                       chunk_size: int = 1_000_000, index: SpatialIndex = None) -> np.ndarray:
+    """
+    Find the points whose surface faces the viewpoint (the scanner), i.e. whose normal is within max_angle degrees of
+    the line of sight. Surfaces seen edge-on, like most of the foliage, are dropped while the stems are kept.
+
+    If normals aren't given they're estimated with estimate_normals() using radius, max_nn, chunk_size and index.
+
+    Returns a boolean mask of the points to keep.
+    """
+    if normals is None:
+        normals = estimate_normals(points, radius, max_nn, chunk_size, index)
+    threshold = np.cos(np.deg2rad(max_angle))
+    mask = np.empty(len(points), dtype=bool)
+    for start in range(0, len(points), chunk_size):
+        rays = points[start:start + chunk_size] - viewpoint
+        # Row-wise dot products; the normals are already unit length
+        cos = np.abs(np.einsum("ij,ij->i", rays, normals[start:start + chunk_size]))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cos /= np.linalg.norm(rays, axis=1)
+        mask[start:start + chunk_size] = cos > threshold
+    return mask
+
+
+def load_points(filename: str, use_cache: bool = True, copy: bool = False) -> np.ndarray:
+    """
+    Load a point cloud file into an (N, 3) array.
+
+    If use_cache is True, the points are loaded through a native cache next to the file (see pccache), which is
+    created the first time. Points from the cache are sorted by z, and are a read-only float32 view of the memory
+    mapped cache, so nothing is read until it's used and the pages are shared with other processes. Clouds far from
+    the origin (e.g. georeferenced ones) are relative to the cache's offset; pass copy=True to get a float64 copy in the
+    original coordinates instead.
+    """
+    if use_cache:
+        cloud = pccache.load(filename)
+        return cloud.points() if copy else cloud.xyz
+    return np.asarray(o3d.io.read_point_cloud(filename).points)
+
+
+def tree_metrics(points: np.ndarray, heights: Iterable[float] = (1.3,), slice_step: float = 0.1,
+                 eps: float = 0.15, min_points: int = 5, use_ellipse_fit: bool = True,
+                 use_ransac: bool = True, stem_filter_angle: float = None,
+                 crown_base: float = 0, index: SpatialIndex = None) -> Dict[str, object]:
+    """
+    Compute the metrics for a single tree: overall height, crown width, and the number of stems and their diameters
+    at each of the given heights (in meters above the lowest point).
+
+    If stem_filter_angle is given, the stems are found after removing points with verticality_filter() using that
+    angle; the height and crown width always use every point.
+
+    The crown width only uses the points at least crown_base meters above the lowest point, e.g. to leave out the
+    stems below the live crown.
+
+    If an index built on the same points is given, it's used for the normals instead of building new trees.
+
+    Returns a dict of metric name to value. Diameters at each height are given as a space-separated string from
+    largest to smallest, along with the largest diameter on its own.
+    """
+    tree = ZSortedPoints(points)
+    hull = CrownHull(tree).vertices(tree.z_min + crown_base)
+    long_width, short_width = crown_width_from_hull(hull, use_ellipse_fit, use_ransac)
+    metrics = {
+        "points": len(tree),
+        "height": tree.z_max - tree.z_min,
+        "crown_long": long_width,
+        "crown_short": short_width,
+        "crown_average": (long_width + short_width) / 2,
+    }
+    stems = tree
+    if stem_filter_angle is not None:
+        stems = ZSortedPoints(tree.points[verticality_filter(tree.points, stem_filter_angle, index=index)])
+        metrics["stem_filter_points"] = len(stems)
+    for height in heights:
+        result = analyze_slice(flatten(stems.slice(tree.z_min + height, slice_step)), eps, min_points,
+                               use_ellipse_fit, use_ransac)
+        metrics[f"stems_{height}m"] = result.stem_count
+        metrics[f"max_diameter_{height}m"] = result.diameters[0] if result.diameters else np.nan
+        metrics[f"diameters_{height}m"] = " ".join(f"{d:.4f}" for d in result.diameters)
+    return metrics
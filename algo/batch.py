@@ -0,0 +1,130 @@
+"""
+Compute tree metrics for many point clouds at once, without the GUI.
+
+Each input cloud should contain a single processed tree (like the input to demo.py). Results are written as one row
+per tree to a CSV, or Parquet if the output name ends in .parquet (requires pandas and pyarrow).
+"""
+from typing import Dict, List
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import sys
+import time
+from analysis import load_points, tree_metrics
+from spatial import open_index
+
+CLOUD_EXTENSIONS = (".ply", ".pcd", ".xyz", ".xyzn", ".xyzrgb", ".pts")
+
+
+def find_clouds(inputs: List[str]) -> List[str]:
+    """
+    Expand a list of files, directories and glob patterns into a list of point cloud files.
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(sorted(os.path.join(item, f) for f in os.listdir(item)
+                                if os.path.splitext(f)[1].lower() in CLOUD_EXTENSIONS))
+        elif os.path.isfile(item):
+            files.append(item)
+        else:
+            files.extend(sorted(glob.glob(item, recursive=True)))
+    return files
+
+
+def process_file(filename: str, options: Dict[str, object], use_index: bool = False) -> Dict[str, object]:
+    """
+    Compute the metrics for one file. Runs in a worker process.
+
+    If use_index is True, the normals for the stem filter use a saved KD-tree index next to the file (see
+    spatial.py), which is created the first time. Nothing else needs one, so it's only used with a stem filter.
+    """
+    row = {"file": filename}
+    points = load_points(filename)
+    index = None
+    if use_index and options.get("stem_filter_angle") is not None:
+        index = open_index(filename, points)
+        # There's already a worker process per core
+        index.workers = 1
+    row.update(tree_metrics(points, index=index, **options))
+    return row
+
+
+def write_results(rows: List[Dict[str, object]], output: str) -> None:
+    if output.lower().endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            print("Error: pandas (and pyarrow) are needed to write Parquet files", file=sys.stderr)
+            raise
+        pd.DataFrame(rows).to_parquet(output)
+        return
+    # Not every row has every column if some files failed
+    fields = list(dict.fromkeys(k for row in rows for k in row))
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute tree metrics for many point clouds.")
+    parser.add_argument("inputs", nargs="+", help="Point cloud files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="metrics.csv", help="Output CSV or Parquet file")
+    parser.add_argument("--heights", type=float, nargs="+", default=[1.3],
+                        help="Heights above the lowest point to measure stems at, in meters (default 1.3)")
+    parser.add_argument("--slice-step", type=float, default=0.1, help="Slice thickness in meters")
+    parser.add_argument("--eps", type=float, default=0.15, help="Clustering eps")
+    parser.add_argument("--min-points", type=int, default=5, help="Clustering min points")
+    parser.add_argument("--simple-fit", action="store_true", help="Use the convex hull fit instead of ellipses")
+    parser.add_argument("--no-ransac", action="store_true", help="Don't use RANSAC for ellipse fitting")
+    parser.add_argument("--crown-base", type=float, default=0,
+                        help="Only use points this far above the lowest point for crown width, in meters")
+    parser.add_argument("--stem-filter", type=float, default=None, metavar="ANGLE",
+                        help="Before finding stems, only keep points whose normals are within ANGLE degrees of the "
+                             "line of sight to the scanner at the origin (e.g. 75)")
+    parser.add_argument("--index", action="store_true",
+                        help="Save a KD-tree index next to each cloud for the --stem-filter normals, and reuse it on "
+                             "later runs")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default all cores)")
+    args = parser.parse_args()
+    if args.index and args.stem_filter is None:
+        parser.error("--index only speeds up --stem-filter, so it needs --stem-filter too")
+
+    files = find_clouds(args.inputs)
+    if not files:
+        print("No point clouds found", file=sys.stderr)
+        sys.exit(1)
+    options = {
+        "heights": args.heights,
+        "slice_step": args.slice_step,
+        "eps": args.eps,
+        "min_points": args.min_points,
+        "use_ellipse_fit": not args.simple_fit,
+        "use_ransac": not args.no_ransac,
+        "stem_filter_angle": args.stem_filter,
+        "crown_base": args.crown_base,
+    }
+
+    print(f"Processing {len(files)} point clouds")
+    start = time.monotonic()
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = {pool.submit(process_file, f, options, args.index): f for f in files}
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            filename = futures[future]
+            try:
+                rows.append(future.result())
+                print(f"[{i + 1}/{len(files)}] {filename}")
+            except Exception as e: # pylint: disable=broad-except
+                print(f"[{i + 1}/{len(files)}] {filename}: Error: {e}", file=sys.stderr)
+                rows.append({"file": filename, "error": str(e)})
+    rows.sort(key=lambda row: row["file"])
+    write_results(rows, args.output)
+    print(f"Wrote {args.output} in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
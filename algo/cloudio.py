@@ -0,0 +1,531 @@
+"""
+Chunked point cloud reading and writing, for files that are too big to load all at once.
+
+Chunks are dicts of column name to array. Every chunk has "xyz", an (N, 3) float64 array, and may have other
+per-point columns such as "intensity".
+"""
+from typing import Dict, Iterator, List, Tuple
+import itertools
+import os
+import time
+import numpy as np
+
+Chunk = Dict[str, np.ndarray]
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+PLY_TYPE_NAMES = {"i1": "char", "u1": "uchar", "i2": "short", "u2": "ushort", "i4": "int", "u4": "uint",
+                  "f4": "float", "f8": "double"}
+
+
+class CloudReader:
+    """
+    Base class for chunked point cloud readers. Use as a context manager, or call close() when done.
+    """
+
+    # Total number of points in the file
+    count = 0
+    # Columns present in each chunk
+    columns = ["xyz"]
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "CloudReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class PlyReader(CloudReader):
+    """
+    Reads the vertices of a PLY file (ASCII or binary). Binary files are memory mapped, so only the chunk being
+    processed has to be in memory.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        if self.file.readline().strip() != b"ply":
+            raise ValueError(f"{path} is not a PLY file")
+        self.format = None
+        self.count = 0
+        fields = []
+        element = None
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ValueError(f"Unexpected end of PLY header in {path}")
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "format":
+                self.format = words[1]
+            elif words[0] == "element":
+                if element == "vertex":
+                    # Other elements (e.g. faces) after the vertices are ignored
+                    element = None
+                    break
+                if words[1] != "vertex":
+                    raise ValueError(f"Only PLY files with vertices first are supported, got {words[1]}")
+                element = "vertex"
+                self.count = int(words[2])
+            elif words[0] == "property":
+                if words[1] == "list":
+                    raise ValueError("List properties on vertices are not supported")
+                fields.append((words[2], PLY_TYPES[words[1]]))
+            elif words[0] == "end_header":
+                break
+        # Skip to the end of the header if we stopped early
+        while line.strip() != b"end_header":
+            line = self.file.readline()
+        self.data_offset = self.file.tell()
+        byte_order = ">" if self.format == "binary_big_endian" else "<"
+        self.dtype = np.dtype([(name, byte_order + t) for name, t in fields])
+        self.properties = [name for name, _ in fields]
+        self.columns = _chunk_columns(self.properties)
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        if self.format == "ascii":
+            self.file.seek(self.data_offset)
+            remaining = self.count
+            while remaining > 0:
+                n = min(chunk_size, remaining)
+                rows = np.loadtxt(itertools.islice(self.file, n), dtype=np.float64, ndmin=2)
+                remaining -= n
+                yield _make_chunk({name: rows[:, i] for i, name in enumerate(self.properties)})
+            return
+        records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.data_offset, shape=(self.count,))
+        for start in range(0, self.count, chunk_size):
+            block = records[start:start + chunk_size]
+            yield _make_chunk({name: block[name] for name in self.properties})
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class LasReader(CloudReader):
+    """
+    Reads LAS/LAZ files in chunks using laspy (which needs lazrs or laszip for LAZ).
+    """
+
+    def __init__(self, path: str) -> None:
+        import laspy
+        self.reader = laspy.open(path)
+        self.count = self.reader.header.point_count
+        self.columns = ["xyz", "intensity"]
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        for points in self.reader.chunk_iterator(chunk_size):
+            chunk = {"xyz": np.column_stack((points.x, points.y, points.z))}
+            chunk["intensity"] = np.asarray(points.intensity, dtype=np.float32)
+            yield chunk
+
+    def close(self) -> None:
+        self.reader.close()
+
+
+class NpyReader(CloudReader):
+    """
+    Reads a .npy file of an (N, 3+) array, where the columns are x, y, z and optionally intensity.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.array = np.load(path, mmap_mode="r")
+        if self.array.ndim != 2 or self.array.shape[1] < 3:
+            raise ValueError(f"Expected an (N, 3+) array in {path}, got {self.array.shape}")
+        self.count = len(self.array)
+        self.columns = ["xyz", "intensity"] if self.array.shape[1] > 3 else ["xyz"]
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        for start in range(0, self.count, chunk_size):
+            block = np.asarray(self.array[start:start + chunk_size], dtype=np.float64)
+            chunk = {"xyz": block[:, :3]}
+            if block.shape[1] > 3:
+                chunk["intensity"] = block[:, 3].astype(np.float32)
+            yield chunk
+
+
+class PcdReader(CloudReader):
+    """
+    Reads a PCD file (ASCII or binary, but not binary_compressed). Binary files are memory mapped.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        header = {}
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ValueError(f"Unexpected end of PCD header in {path}")
+            words = line.decode("ascii").split()
+            if not words or words[0].startswith("#"):
+                continue
+            header[words[0].upper()] = words[1:]
+            if words[0].upper() == "DATA":
+                break
+        self.data_format = header["DATA"][0]
+        if self.data_format not in ("ascii", "binary"):
+            raise ValueError(f"PCD data format {self.data_format} is not supported")
+        self.data_offset = self.file.tell()
+        self.count = int(header["POINTS"][0])
+        fields = []
+        counts = header.get("COUNT", ["1"] * len(header["FIELDS"]))
+        for name, size, kind, count in zip(header["FIELDS"], header["SIZE"], header["TYPE"], counts):
+            dtype = "<" + {"F": "f", "I": "i", "U": "u"}[kind] + size
+            # Padding fields are named _ and might be repeated, so give them unique names
+            name = f"_{len(fields)}" if name == "_" else name
+            fields.append((name, dtype) if int(count) == 1 else (name, dtype, (int(count),)))
+        self.dtype = np.dtype(fields)
+        self.properties = list(self.dtype.names)
+        self.columns = _chunk_columns(self.properties)
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        if self.data_format == "ascii":
+            self.file.seek(self.data_offset)
+            remaining = self.count
+            while remaining > 0:
+                n = min(chunk_size, remaining)
+                rows = np.loadtxt(itertools.islice(self.file, n), dtype=np.float64, ndmin=2)
+                remaining -= n
+                # Only the scalar fields are supported in ASCII files
+                yield _make_chunk({name: rows[:, i] for i, name in enumerate(self.properties)})
+            return
+        records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.data_offset, shape=(self.count,))
+        for start in range(0, self.count, chunk_size):
+            block = records[start:start + chunk_size]
+            yield _make_chunk({name: block[name] for name in self.properties})
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Open3dReader(CloudReader):
+    """
+    Fallback for formats without a streaming reader; loads the whole file with open3d and returns it as one chunk.
+    """
+
+    def __init__(self, path: str) -> None:
+        import open3d as o3d
+        self.points = np.asarray(o3d.io.read_point_cloud(path).points)
+        self.count = len(self.points)
+
+    def chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+        for start in range(0, self.count, chunk_size):
+            yield {"xyz": self.points[start:start + chunk_size]}
+
+
+INTENSITY_NAMES = ("intensity", "scalar_intensity")
+
+
+def _chunk_columns(properties: List[str]) -> List[str]:
+    """
+    Find which chunk columns can be made from a file's properties.
+    """
+    if not all(name in properties for name in "xyz"):
+        raise ValueError(f"Points need x, y and z, but only got {properties}")
+    return ["xyz", "intensity"] if any(name in properties for name in INTENSITY_NAMES) else ["xyz"]
+
+
+def _make_chunk(columns: Dict[str, np.ndarray]) -> Chunk:
+    """
+    Convert the columns from a PLY or PCD file into a chunk.
+    """
+    chunk = {"xyz": np.column_stack((columns["x"], columns["y"], columns["z"])).astype(np.float64)}
+    for name in INTENSITY_NAMES:
+        if name in columns:
+            chunk["intensity"] = np.asarray(columns[name], dtype=np.float32)
+            break
+    return chunk
+
+
+def open_reader(path: str) -> CloudReader:
+    """
+    Open a chunked reader for a point cloud file, based on its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".ply":
+        return PlyReader(path)
+    if ext in (".las", ".laz"):
+        return LasReader(path)
+    if ext == ".npy":
+        return NpyReader(path)
+    if ext == ".pcd":
+        try:
+            return PcdReader(path)
+        except ValueError:
+            # Probably binary_compressed
+            pass
+    return Open3dReader(path)
+
+
+class CloudWriter:
+    """
+    Base class for chunked point cloud writers. The total number of points must be known up front, and columns lists
+    which chunk columns will be written. Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, count: int, columns: List[str] = ("xyz",)) -> None:
+        self.count = count
+        self.columns = list(columns)
+        self.written = 0
+        # Set when leaving the context because of an error, so close() doesn't replace it with its own
+        self.aborted = False
+
+    def write(self, chunk: Chunk) -> None:
+        self._write(chunk)
+        self.written += len(chunk["xyz"])
+
+    def _write(self, chunk: Chunk) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        if self.written != self.count and not self.aborted:
+            raise ValueError(f"Expected to write {self.count} points but wrote {self.written}")
+
+    def __enter__(self) -> "CloudWriter":
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        self.aborted = exc_type is not None
+        self.close()
+
+
+class _RecordWriter(CloudWriter):
+    """
+    Base for formats that are a text header followed by packed binary records.
+    """
+
+    def __init__(self, path: str, count: int, columns: List[str] = ("xyz",)) -> None:
+        super().__init__(count, columns)
+        fields = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")]
+        if "intensity" in self.columns:
+            fields.append(("intensity", "<f4"))
+        self.dtype = np.dtype(fields)
+        self.file = open(path, "wb")
+        self.file.write(self.header().encode("ascii"))
+
+    def header(self) -> str:
+        raise NotImplementedError
+
+    def _write(self, chunk: Chunk) -> None:
+        records = np.empty(len(chunk["xyz"]), dtype=self.dtype)
+        records["x"], records["y"], records["z"] = chunk["xyz"].T
+        if "intensity" in self.dtype.names:
+            records["intensity"] = chunk.get("intensity", 0)
+        self.file.write(records.tobytes())
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+
+class PlyWriter(_RecordWriter):
+    """
+    Writes a binary PLY file.
+    """
+
+    def header(self) -> str:
+        header = ["ply", "format binary_little_endian 1.0", f"element vertex {self.count}"]
+        header.extend(f"property {PLY_TYPE_NAMES[self.dtype[name].str[1:]]} {name}" for name in self.dtype.names)
+        header.append("end_header")
+        return "\n".join(header) + "\n"
+
+
+class PcdWriter(_RecordWriter):
+    """
+    Writes a binary PCD file.
+    """
+
+    def header(self) -> str:
+        names = self.dtype.names
+        return "\n".join([
+            "# .PCD v0.7 - Point Cloud Data file format",
+            "VERSION 0.7",
+            "FIELDS " + " ".join(names),
+            "SIZE " + " ".join(str(self.dtype[name].itemsize) for name in names),
+            "TYPE " + " ".join("F" for _ in names),
+            "COUNT " + " ".join("1" for _ in names),
+            f"WIDTH {self.count}",
+            "HEIGHT 1",
+            "VIEWPOINT 0 0 0 1 0 0 0",
+            f"POINTS {self.count}",
+            "DATA binary",
+        ]) + "\n"
+
+
+class NpyWriter(CloudWriter):
+    """
+    Writes an (N, 3) array of xyz, or (N, 4) if intensity is included, to a .npy file.
+    """
+
+    def __init__(self, path: str, count: int, columns: List[str] = ("xyz",)) -> None:
+        super().__init__(count, columns)
+        width = 4 if "intensity" in self.columns else 3
+        self.array = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(count, width))
+
+    def _write(self, chunk: Chunk) -> None:
+        end = self.written + len(chunk["xyz"])
+        self.array[self.written:end, :3] = chunk["xyz"]
+        if self.array.shape[1] > 3:
+            self.array[self.written:end, 3] = chunk.get("intensity", 0)
+
+    def close(self) -> None:
+        self.array.flush()
+        del self.array
+        super().close()
+
+
+class LasWriter(CloudWriter):
+    """
+    Writes a LAS/LAZ file using laspy, with millimeter precision.
+
+    LAS stores coordinates as scaled integers relative to an offset, which is taken from the first chunk.
+    """
+
+    SCALE = 0.001
+
+    def __init__(self, path: str, count: int, columns: List[str] = ("xyz",)) -> None:
+        import laspy
+        super().__init__(count, columns)
+        self.laspy = laspy
+        self.path = path
+        self.writer = None
+
+    def _write(self, chunk: Chunk) -> None:
+        xyz = chunk["xyz"]
+        if self.writer is None:
+            header = self.laspy.LasHeader(point_format=0, version="1.2")
+            header.scales = np.full(3, self.SCALE)
+            header.offsets = np.floor(xyz.min(axis=0)) if len(xyz) else np.zeros(3)
+            self.writer = self.laspy.open(self.path, mode="w", header=header)
+        points = self.laspy.ScaleAwarePointRecord.zeros(len(xyz), header=self.writer.header)
+        points.x, points.y, points.z = xyz.T
+        if "intensity" in self.columns and "intensity" in chunk:
+            points.intensity = np.clip(chunk["intensity"], 0, 0xFFFF).astype(np.uint16)
+        self.writer.write_points(points)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        super().close()
+
+
+def open_writer(path: str, count: int, columns: List[str] = ("xyz",)) -> CloudWriter:
+    """
+    Open a chunked writer for a point cloud file, based on its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    writers = {".ply": PlyWriter, ".pcd": PcdWriter, ".npy": NpyWriter, ".las": LasWriter, ".laz": LasWriter}
+    if ext not in writers:
+        raise ValueError(f"Can't write {ext} files; supported formats are {', '.join(writers)}")
+    return writers[ext](path, count, columns)
+
+
+def convert(src: str, dest: str, columns: List[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+            progress: bool = True) -> Tuple[int, float]:
+    """
+    Convert a point cloud from one format to another, one chunk at a time.
+
+    columns selects which columns to write (e.g. ["xyz"] or ["xyz", "intensity"]); by default everything the source
+    has is written.
+
+    Returns a tuple of (number of points, seconds taken).
+    """
+    start = time.monotonic()
+    with open_reader(src) as reader:
+        if columns is None:
+            columns = reader.columns
+        missing = [c for c in columns if c not in reader.columns]
+        if missing:
+            raise ValueError(f"{src} doesn't have {', '.join(missing)}")
+        with open_writer(dest, reader.count, columns) as writer:
+            for chunk in reader.chunks(chunk_size):
+                writer.write({name: chunk[name] for name in columns})
+                if progress:
+                    elapsed = time.monotonic() - start
+                    print(f"{writer.written}/{reader.count} points, {writer.written / max(elapsed, 1e-9):.0f} points/s")
+    return reader.count, time.monotonic() - start
+
+
+class VoxelAccumulator:
+    """
+    Incremental voxel downsampling: points are added in chunks, and each occupied voxel is reduced to the average of
+    the points in it, like open3d's voxel_down_sample().
+
+    Memory use is proportional to the number of occupied voxels, not the number of points added.
+    """
+
+    # Voxel indices are packed into 21 bits each
+    KEY_BITS = 21
+    KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+    def __init__(self, voxel_size: float) -> None:
+        self.voxel_size = voxel_size
+        self.keys = np.empty(0, dtype=np.int64)
+        self.sums = np.empty((0, 3))
+        self.counts = np.empty(0, dtype=np.int64)
+        # Reduced chunks waiting to be merged in; merging is only done once there's about as much pending as there
+        # is already merged, so the total cost stays low
+        self._pending = []
+        self._pending_size = 0
+
+    def voxel_keys(self, xyz: np.ndarray) -> np.ndarray:
+        """
+        Get the packed voxel index of each point.
+        """
+        idx = np.floor(xyz / self.voxel_size).astype(np.int64) + self.KEY_OFFSET
+        if np.any(idx < 0) or np.any(idx >= 1 << self.KEY_BITS):
+            raise ValueError("Points are too far from the origin for this voxel size")
+        return (idx[:, 0] << (2 * self.KEY_BITS)) | (idx[:, 1] << self.KEY_BITS) | idx[:, 2]
+
+    def add(self, xyz: np.ndarray) -> None:
+        if not len(xyz):
+            return
+        self._pending.append(_reduce_voxels(self.voxel_keys(xyz), xyz, np.ones(len(xyz), dtype=np.int64)))
+        self._pending_size += len(self._pending[-1][0])
+        if self._pending_size >= max(len(self.keys), 1 << 16):
+            self._merge()
+
+    def _merge(self) -> None:
+        if not self._pending:
+            return
+        keys, sums, counts = zip(*self._pending)
+        self.keys, self.sums, self.counts = _reduce_voxels(np.concatenate((self.keys,) + keys),
+                                                           np.concatenate((self.sums,) + sums),
+                                                           np.concatenate((self.counts,) + counts))
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self) -> int:
+        self._merge()
+        return len(self.keys)
+
+    def points(self) -> np.ndarray:
+        """
+        Get the downsampled points, one per occupied voxel.
+        """
+        self._merge()
+        return self.sums / self.counts[:, None]
+
+
+def _reduce_voxels(keys: np.ndarray, sums: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray,
+                                                                                     np.ndarray]:
+    """
+    Combine the sums and counts of entries with the same voxel key.
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    reduced = np.column_stack([np.bincount(inverse, weights=sums[:, i], minlength=len(unique_keys))
+                               for i in range(3)])
+    return unique_keys, reduced, np.bincount(inverse, weights=counts, minlength=len(unique_keys)).astype(np.int64)
@@ -1,15 +1,22 @@
-from typing import Tuple
-import math
+from typing import Dict, List, Tuple
+import collections
+import concurrent.futures
 import open3d as o3d
 import numpy as np
+import os
 import sys
-import scipy
 import itertools
+import threading
 from open3d.visualization import gui
-from skimage import measure
+from analysis import CrownHull, SliceResult, ZSortedPoints, analyze_slice, crown_width_from_hull, flatten, load_points
+from lod import LodCloud, ViewWatcher
+from gridscan import SliceClusterer
 
 SLICE_COLOR = (0, 0, 1)
 TREE_COLOR = (0, 0, 0)
+# Max number of points to draw in the tree view when the camera is still, and while it's moving
+TREE_POINT_BUDGET = 3_000_000
+MOVING_POINT_BUDGET = 300_000
 COLORS = np.array([
     [0, 0, 1],
     [0, 1, 0],
@@ -20,56 +27,73 @@ COLORS = np.array([
 ])
 
 
-def get_color(label: int):
-    return np.array([0, 0, 0]) if label == -1 else COLORS[label % len(COLORS)]
-
-def compute_diameters_ellipse(points: np.ndarray, use_ransac: bool = True) -> Tuple[float, float]:
-    if len(points) < 3:
-        return (np.nan, np.nan)
-    # Use RANSAC to fit an ellipse to the points
-    if use_ransac:
-        ellipse, _ = measure.ransac(points, measure.fit.EllipseModel, min(max(3, len(points) // 3), 20), 0.01, max_trials=30)
-        if ellipse is None:
-            return compute_diameters_ellipse(points, use_ransac=False)
-    else:
-        ellipse = measure.fit.EllipseModel()
-        if not ellipse.estimate(points):
-            return np.nan, np.nan
-    a = ellipse.params[2] * 2
-    b = ellipse.params[3] * 2
-    return max(a, b), min(a, b)
-
-def compute_diameters_simple(points: np.ndarray) -> Tuple[float, float]:
-    if len(points) < 3:
-        return np.nan, np.nan
-    try:
-        hull = points[scipy.spatial.ConvexHull(points).vertices]
-    except scipy.spatial.qhull.QhullError:
-        return np.nan, np.nan
-    dist = scipy.spatial.distance_matrix(hull, hull)
-    i, j = np.unravel_index(np.argmax(dist), dist.shape)
-        # Compute the distance along the axis perpendicular to the diameter axis
-    # Find the vector to project onto, normalized and perpendicular to the difference between the diameter points
-    s = hull[i] - hull[j]
-    s /= np.sqrt(np.dot(s, s))
-    s[0], s[1] = -s[1], s[0]
-    # Find the length of each projection by taking the dot product
-    proj_lens = np.dot(hull - hull[i], s)
-    # Instead of taking the most positive projected length and subtracting the most negative, we take the projected
-    # length furthest from zero and double it. This is because in the scanned point cloud, the stem might appear as
-    # only half of an ellipse since the back is blocked
-    return dist[i, j], np.max(np.abs(proj_lens)) * 2
+# Last row is for noise
+PALETTE = np.vstack((COLORS, [0, 0, 0]))
 
 
-class Demo:
+def label_colors(labels: np.ndarray) -> np.ndarray:
+    """
+    Get the colour of each point from its cluster label.
+    """
+    return PALETTE[np.where(labels < 0, len(COLORS), labels % len(COLORS))]
+
+
+class StemProfileCache:
+    """
+    LRU cache of slice results, keyed by (z bin, slice step, eps, min points, use ellipse fit, use RANSAC).
+
+    This is accessed from both the GUI and the precompute workers, so everything is done under a lock.
+    """
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> SliceResult:
+        """
+        Get the result for a key, or None if it's not in the cache.
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: Tuple, result: SliceResult) -> None:
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
 
-    def __init__(self, filename: str) -> None:
-        self.tree = o3d.io.read_point_cloud(filename)
-        print("Loaded", self.tree)
+    def results(self) -> Dict[Tuple, SliceResult]:
+        """
+        Get a snapshot of everything in the cache.
+        """
+        with self._lock:
+            return dict(self._entries)
 
-        self.point_arr = np.asarray(self.tree.points)
-        self.SLICE_START = np.min(self.point_arr[:, 2])
-        self.SLICE_STOP = np.max(self.point_arr[:, 2])
+
+class Demo:
+
+    # If precompute is True, the stems in every slice of the tree are found in the background, so moving the slider
+    # only has to look up the results.
+    def __init__(self, filename: str, precompute: bool = False) -> None:
+        # Loaded through the native cache, so the file only has to be parsed the first time
+        self.point_arr = load_points(filename)
+        print(f"Loaded {len(self.point_arr)} points")
+
+        # Sort the points by height once, so that every slice is just a contiguous range found by binary search
+        self.sorted_points = ZSortedPoints(self.point_arr)
+        # Grid cells for clustering are found once for the whole tree, and every slice is a range of them
+        self.slice_clusterer = SliceClusterer(self.sorted_points.points)
+        self.SLICE_START = float(self.sorted_points.z_min)
+        self.SLICE_STOP = float(self.sorted_points.z_max)
         self.slice_step = 0.1
         self.slice_z = self.SLICE_START
         self.slice_updated = True
@@ -77,14 +101,30 @@ class Demo:
         self.window = None
         self.slice_z_slider = None
         self.slice_z_edit = None
+        self.slice_step_edit = None
         self.diam_edits = []
         self.stems_edit = None
         self.crown_width_edits = []
+        self.crown_base = 0.0
         self.cluster_eps = 0.15
         self.cluster_min_points = 5
-        self.use_ransac = False
+        self.use_ransac = True
         self.use_ellipse_fit = True
         self.save_name_edit = None
+
+        self.profile_cache = StemProfileCache()
+        self.precompute = precompute
+        self.precompute_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+        # Separate from the precompute pool, since precompute tasks wait on these
+        self.fit_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+        self.precompute_futures = []
+        # Only part of the tree is drawn, from the coarsest levels of detail up. Sorting the points into levels takes a
+        # while for big trees, so it's done in the background, and a strided subset is drawn until it's ready.
+        self.lod = LodCloud()
+        self.lod_future = self.fit_pool.submit(self.lod.add, self.point_arr)
+        # The hull doesn't change with the fit settings, so it's only found once
+        self.crown_hull = CrownHull(self.sorted_points, executor=self.fit_pool)
+
         self.init_window()
         self.recompute_crown_width()
 
@@ -92,7 +132,13 @@ class Demo:
         self.slice_vis = None
         self.slice_cloud = None
         self.flat_slice_cloud = None
+        self.tree_cloud = None
+        self.view_watcher = None
+        self.shown_budget = None
+        self.shown_lod = False
         self.init_visualizers()
+        if self.precompute:
+            self.start_precompute()
 
     def init_window(self) -> None:
         self.window = gui.Application.instance.create_window(
@@ -124,6 +170,13 @@ class Demo:
         
         collapse = gui.CollapsableVert("Crown width", 0.33 * em, gui.Margins(em, 0, 0, 0))
         horiz = gui.Horiz()
+        horiz.add_child(gui.Label("Crown base (m):"))
+        nedit = gui.NumberEdit(gui.NumberEdit.DOUBLE)
+        nedit.double_value = self.crown_base
+        nedit.set_on_value_changed(self._on_crown_base_edit)
+        horiz.add_child(nedit)
+        collapse.add_child(horiz)
+        horiz = gui.Horiz()
         horiz.add_child(gui.Label("Long Axis (m):"))
         nedit = gui.NumberEdit(gui.NumberEdit.DOUBLE)
         self.crown_width_edits.append(nedit)
@@ -163,10 +216,10 @@ class Demo:
 
         horiz = gui.Horiz()
         horiz.add_child(gui.Label("Slice thickness:"))
-        nedit = gui.NumberEdit(gui.NumberEdit.DOUBLE)
-        nedit.double_value = self.slice_step
-        nedit.set_on_value_changed(self._on_slice_step_edit)
-        horiz.add_child(nedit)
+        self.slice_step_edit = gui.NumberEdit(gui.NumberEdit.DOUBLE)
+        self.slice_step_edit.double_value = self.slice_step
+        self.slice_step_edit.set_on_value_changed(self._on_slice_step_edit)
+        horiz.add_child(self.slice_step_edit)
         collapse.add_child(horiz)
 
         horiz = gui.Horiz()
@@ -206,6 +259,9 @@ class Demo:
         button = gui.Button("Save Slice")
         button.set_on_clicked(self._on_save_slice)
         horiz.add_child(button)
+        button = gui.Button("Save Profile")
+        button.set_on_clicked(self._on_save_profile)
+        horiz.add_child(button)
         collapse.add_child(horiz)
 
         layout.add_child(collapse)
@@ -213,13 +269,9 @@ class Demo:
         self.window.add_child(layout)
     
     def recompute_crown_width(self):
-        # Use convex hull to eliminate all the points not on the perimeter after squashing
-        pts = self.point_arr[:, :2]
-        hull = pts[scipy.spatial.ConvexHull(pts).vertices]
-        if self.use_ellipse_fit:
-            long_diam, perp_diam = compute_diameters_ellipse(hull, use_ransac=self.use_ransac)
-        else:
-            long_diam, perp_diam = compute_diameters_simple(hull)
+        # Only the points above the crown base (in meters above the lowest point) count
+        hull = self.crown_hull.vertices(self.SLICE_START + self.crown_base)
+        long_diam, perp_diam = crown_width_from_hull(hull, self.use_ellipse_fit, self.use_ransac)
         self.crown_width_edits[0].double_value = long_diam
         self.crown_width_edits[1].double_value = perp_diam
         self.crown_width_edits[2].double_value = (long_diam + perp_diam) / 2
@@ -233,27 +285,40 @@ class Demo:
             self.slice_z_edit.double_value = val
         print("Slice at", val)
 
+    def _on_crown_base_edit(self, val: float):
+        self.crown_base = val
+        self.recompute_crown_width()
+
     def _on_cluster_eps_slider(self, val: float):
         self.slice_updated = True
         self.cluster_eps = val
+        self.invalidate_profile()
 
     def _on_cluster_points_slider(self, val: int):
         self.slice_updated = True
         self.cluster_min_points = int(val)
+        self.invalidate_profile()
     
     def _on_slice_step_edit(self, val: float):
+        if val <= 0:
+            # Slices are binned by the step, so it can't be zero; keep the old one
+            self.slice_step_edit.double_value = self.slice_step
+            return
         self.slice_updated = True
         self.slice_step = val
+        self.invalidate_profile()
     
     def _on_ransac_cb(self, checked: bool):
         self.slice_updated = True
         self.use_ransac = checked
         self.recompute_crown_width()
+        self.invalidate_profile()
     
     def _on_ellipse_cb(self, checked: bool):
         self.slice_updated = True
         self.use_ellipse_fit = checked
         self.recompute_crown_width()
+        self.invalidate_profile()
     
     def _on_save_slice(self):
         name = self.save_name_edit.text_value
@@ -261,6 +326,15 @@ class Demo:
             np.save(f, np.asarray(self.flat_slice_cloud.points)[:, :2])
         print("Saved to", name)
     
+    def _on_save_profile(self):
+        name = self.save_name_edit.text_value
+        z, stem_counts, diameters = self.diameter_profile()
+        with open(name, "w") as f:
+            f.write("z,stems,diameters\n")
+            for height, count, diams in zip(z, stem_counts, diameters):
+                f.write(f"{height},{count},{' '.join(str(d) for d in diams)}\n")
+        print("Saved to", name)
+
     def _on_save_crown(self):
         name = self.save_name_edit.text_value
         with open(name, "wb") as f:
@@ -275,12 +349,15 @@ class Demo:
         self.tree_vis.get_render_option().point_size = 2.0
         self.slice_vis.get_render_option().point_size = 4.0
 
-        self.slice_cloud = self.make_slice()
+        slice_points = self.make_slice()
+        self.slice_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(slice_points.astype(np.float64)))
         self.slice_cloud.paint_uniform_color(SLICE_COLOR)
-        self.flat_slice_cloud = self.make_flat_slice()
+        self.flat_slice_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.make_flat_slice(slice_points)))
         self.flat_slice_cloud.paint_uniform_color(SLICE_COLOR)
-        self.tree.paint_uniform_color(TREE_COLOR)
-        self.tree_vis.add_geometry(self.tree.uniform_down_sample(10))
+        self.tree_cloud = o3d.geometry.PointCloud()
+        self.view_watcher = ViewWatcher(self.tree_vis)
+        self.update_tree_cloud(TREE_POINT_BUDGET)
+        self.tree_vis.add_geometry(self.tree_cloud)
         self.tree_vis.add_geometry(o3d.geometry.TriangleMesh.create_coordinate_frame())
         self.tree_vis.add_geometry(self.slice_cloud)
         self.slice_vis.add_geometry(self.flat_slice_cloud)
@@ -288,58 +365,131 @@ class Demo:
         self.tree_vis.reset_view_point(True)
         self.slice_vis.reset_view_point(True)
 
-    def make_slice(self):
-        cloud_slice = self.tree.select_by_index(
-            np.where(abs(self.slice_z - self.point_arr[:, 2]) < self.slice_step / 2)[0])
-        return cloud_slice
-
-    def make_flat_slice(self):
-        cloud_slice = self.make_slice()
-        return cloud_slice.translate((0, 0, -cloud_slice.get_center()[2]))
-
-    def update_characteristics(self, cloud: o3d.geometry.PointCloud):
-        # Use clustering to find different stems
-        labels = np.array(cloud.cluster_dbscan(eps=self.cluster_eps, min_points=self.cluster_min_points))
-        cluster_count = np.max(labels) + 1
-        self.stems_edit.int_value = cluster_count
+    def update_tree_cloud(self, budget: int) -> None:
+        """
+        Draw up to budget points of the tree.
+        """
+        self.shown_lod = self.lod_future.done()
+        if self.shown_lod:
+            points = self.lod.select(budget)
+        else:
+            points = self.point_arr[::max(int(np.ceil(len(self.point_arr) / budget)), 1)].astype(np.float64)
+        self.tree_cloud.points = o3d.utility.Vector3dVector(points)
+        self.tree_cloud.paint_uniform_color(TREE_COLOR)
+        self.shown_budget = budget
+
+    def make_slice(self, z: float = None, thickness: float = None) -> np.ndarray:
+        """
+        Get the points within half a slice step of a height (the current slice by default), as a view into the sorted
+        points.
+        """
+        if z is None:
+            z = self.slice_center()
+        if thickness is None:
+            thickness = self.slice_step
+        return self.sorted_points.slice(z, thickness)
+
+    def make_flat_slice(self, slice_points: np.ndarray) -> np.ndarray:
+        """
+        Flatten the points from make_slice() onto the slice's average height.
+        """
+        return flatten(slice_points)
+
+    def z_bin(self, z: float) -> int:
+        # Bins are centered on multiples of the step from z = 0, so round heights like 1.3m land exactly on a bin
+        return round(z / self.slice_step)
+
+    def slice_center(self) -> float:
+        """
+        Get the height of the current slice, snapped to the slice step so that results can be cached.
+        """
+        return self.z_bin(self.slice_z) * self.slice_step
+
+    def profile_key(self, z_bin: int) -> Tuple:
+        return (z_bin, self.slice_step, self.cluster_eps, self.cluster_min_points, self.use_ellipse_fit,
+                self.use_ransac)
+
+    def slice_result(self, key: Tuple) -> SliceResult:
+        """
+        Get the stems in a slice, from the cache if possible. key should come from profile_key().
+
+        Everything needed is taken from the key rather than the current settings, since the settings could change
+        while this is running in a precompute worker.
+        """
+        result = self.profile_cache.get(key)
+        if result is None:
+            z_bin, slice_step, eps, min_points = key[:4]
+            start, stop = self.sorted_points.slice_range(z_bin * slice_step, slice_step)
+            labels = self.slice_clusterer.labels(start, stop, eps, min_points)
+            result = analyze_slice(self.make_flat_slice(self.sorted_points.points[start:stop]), *key[2:],
+                                   executor=self.fit_pool, labels=labels)
+            self.profile_cache.put(key, result)
+        return result
+
+    def invalidate_profile(self) -> None:
+        """
+        Throw away all cached results after a tunable is changed, and restart the precompute if it's enabled.
+        """
+        for future in self.precompute_futures:
+            future.cancel()
+        self.precompute_futures = []
+        self.profile_cache.clear()
+        if self.precompute:
+            self.start_precompute()
+
+    def start_precompute(self) -> None:
+        """
+        Start finding the stems in every slice of the tree in the background.
+        """
+        z_bins = range(self.z_bin(self.SLICE_START), self.z_bin(self.SLICE_STOP) + 1)
+        self.profile_cache.max_entries = max(self.profile_cache.max_entries, len(z_bins))
+        self.precompute_futures = [self.precompute_pool.submit(self.slice_result, self.profile_key(z_bin))
+                                   for z_bin in z_bins]
+
+    def diameter_profile(self) -> Tuple[np.ndarray, np.ndarray, List[List[float]]]:
+        """
+        Get the stem count and diameters at every height that's been computed with the current settings.
+
+        Returns a tuple of (heights, stem counts, diameters), sorted by height.
+        """
+        settings = self.profile_key(0)[1:]
+        results = sorted((k[0], r) for k, r in self.profile_cache.results().items() if k[1:] == settings)
+        z = np.array([z_bin * self.slice_step for z_bin, _ in results])
+        return z, np.array([r.stem_count for _, r in results]), [r.diameters for _, r in results]
+
+    def update_characteristics(self, cloud: o3d.geometry.PointCloud, result: SliceResult):
+        self.stems_edit.int_value = result.stem_count
         # Colour each stem differently
-        colors = np.empty((len(labels), 3))
-        for i, label in enumerate(labels):
-            colors[i] = get_color(label)
-        cloud.colors = o3d.utility.Vector3dVector(colors)
-        # To find the stem diameter, we need the distance between the furthest 2 points
-        # These 2 points will always be a part of the convex hull
-        # Use numpy to find stem diameter, since the slice is 2D
-        cloud_points = np.asarray(cloud.points)
-        diameters = []
-        for cluster_index in range(cluster_count):
-            # Extract the points in the current cluster and slice to make it 2D
-            points = cloud_points[np.where(labels == cluster_index)][:, :2]
-            if self.use_ellipse_fit:
-                diam, _ = compute_diameters_ellipse(points, use_ransac=self.use_ransac)
-            else:
-                diam, _ = compute_diameters_simple(points)
-            if not math.isnan(diam):
-                diameters.append(diam)
+        cloud.colors = o3d.utility.Vector3dVector(label_colors(result.labels))
         # Set the diameters in sorted order
-        for diam_edit, long_diam in zip(self.diam_edits, itertools.chain(sorted(diameters, reverse=True), itertools.repeat(np.nan))):
+        for diam_edit, long_diam in zip(self.diam_edits, itertools.chain(result.diameters, itertools.repeat(np.nan))):
             diam_edit.double_value = long_diam
 
     def run(self):
         while True:
             if self.slice_updated:
                 self.slice_updated = False
-                self.slice_cloud.points = self.make_slice().points
+                slice_points = self.make_slice()
+                self.slice_cloud.points = o3d.utility.Vector3dVector(slice_points.astype(np.float64))
                 self.slice_cloud.paint_uniform_color(SLICE_COLOR)
-                self.flat_slice_cloud.points = self.make_flat_slice().points
+                self.flat_slice_cloud.points = o3d.utility.Vector3dVector(self.make_flat_slice(slice_points))
                 self.flat_slice_cloud.paint_uniform_color(SLICE_COLOR)
 
-                self.update_characteristics(self.flat_slice_cloud)
+                key = self.profile_key(self.z_bin(self.slice_z))
+                self.update_characteristics(self.flat_slice_cloud, self.slice_result(key))
 
                 self.tree_vis.update_geometry(self.slice_cloud)
                 self.slice_vis.update_geometry(self.flat_slice_cloud)
                 self.slice_vis.reset_view_point(True)
+            # Switch to fewer points while the camera moves, so it stays smooth, and to the levels of detail once
+            # they're ready
+            budget = MOVING_POINT_BUDGET if self.view_watcher.moving() else TREE_POINT_BUDGET
+            if budget != self.shown_budget or (not self.shown_lod and self.lod_future.done()):
+                self.update_tree_cloud(budget)
+                self.tree_vis.update_geometry(self.tree_cloud)
             if not gui.Application.instance.run_one_tick():
+                self.precompute_pool.shutdown(wait=False, cancel_futures=True)
+                self.fit_pool.shutdown(wait=False, cancel_futures=True)
                 break
             self.tree_vis.poll_events()
             self.tree_vis.update_renderer()
@@ -349,5 +499,5 @@ class Demo:
 
 if __name__ == "__main__":
     gui.Application.instance.initialize()
-    window = Demo(sys.argv[1])
+    window = Demo(sys.argv[1], precompute="--precompute" in sys.argv[2:])
     window.run()
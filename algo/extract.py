@@ -1,28 +1,51 @@
 import open3d as o3d
 import numpy as np
 import sys
+import time
+import cloudio
+import pccache
+from spatial import SpatialIndex
+
+VOXEL_SIZE = 0.05
+CHUNK_SIZE = 1_000_000
+# Only keep points with y above this, to cut out only one tree
+CROP_MIN_Y = -1
+# Center the tree
+TRANSLATION = np.array([2.1, -4.9, 0])
+ROTATION = o3d.geometry.get_rotation_matrix_from_xyz((0, 0, np.pi))
+CAMERA_POS = np.array([-15, 0, 1.30])
 
 print("Loading point cloud")
-tree = o3d.io.read_point_cloud(sys.argv[1])
-print(f"Loaded point cloud: {tree}")
+start = time.monotonic()
+# Read, crop and transform one chunk at a time, so only the downsampled cloud ever has to fit in memory
+# The rotation is done about the origin here; it's corrected to be about the center of the tree afterwards, since
+# the center isn't known until all the points have been read
+voxels = cloudio.VoxelAccumulator(VOXEL_SIZE)
+# Uses the native cache if there is one, but doesn't make one since the input might not fit in memory
+with pccache.open_reader(sys.argv[1]) as reader:
+    print(f"Reading {reader.count} points")
+    read = 0
+    for chunk in reader.chunks(CHUNK_SIZE):
+        xyz = chunk["xyz"]
+        read += len(xyz)
+        xyz = xyz[xyz[:, 1] > CROP_MIN_Y]
+        voxels.add((xyz + TRANSLATION) @ ROTATION.T)
+        # len(voxels) would merge the pending chunks every time, so the voxel count is only reported at the end
+        print(f"Read {read}/{reader.count} points")
+points = voxels.points()
+print(f"Downsampled and trimmed to {len(points)} voxels in {time.monotonic() - start:.1f}s")
 
-# Preprocessing
-tree = tree.voxel_down_sample(0.05)
-tree.paint_uniform_color([0.75, 0.75, 0.75])
-print(f"Downsampled to {tree}")
-# Cut out only one tree
-tree = tree.select_by_index(np.where(np.asarray(tree.points)[:, 1] > -1)[0])
-print(f"Trimmed to {tree}")
-tree.remove_radius_outlier(10, 0.1)
+points = points[SpatialIndex(points).radius_outliers(10, 0.1)]
+tree = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
 print(f"After outlier removal: {tree}")
-# Center the tree
-tree.translate((2.1, -4.9, 0))
-# Rotate
-tree.rotate(tree.get_rotation_matrix_from_xyz((0, 0, np.pi)))
+tree.paint_uniform_color([0.75, 0.75, 0.75])
+# Correct the rotation to be about the center of the tree (R^T c is the center before rotation)
+center = tree.get_center()
+tree.translate(ROTATION.T @ center - center)
 
 camera = o3d.geometry.TriangleMesh.create_box(0.2, 0.2, 0.2)
 camera.translate((-0.1, -0.1, -0.1))
-camera.translate((-15, 0, 1.30))
+camera.translate(CAMERA_POS)
 camera.paint_uniform_color([0, 0.5, 0])
 
 # Shift the origin
@@ -31,7 +54,15 @@ camera.translate(-offset)
 tree.translate(-offset)
 
 if len(sys.argv) > 2:
-    o3d.io.write_point_cloud(sys.argv[2], tree)
+    if sys.argv[2].lower().endswith(".ply"):
+        # Write in chunks so there's never a second full copy of the points
+        points = np.asarray(tree.points)
+        with cloudio.PlyWriter(sys.argv[2], len(points)) as writer:
+            for i in range(0, len(points), CHUNK_SIZE):
+                writer.write({"xyz": points[i:i + CHUNK_SIZE]})
+    else:
+        o3d.io.write_point_cloud(sys.argv[2], tree)
+    print(f"Saved to {sys.argv[2]}")
 
 vis = o3d.visualization.Visualizer()
 vis.create_window()
@@ -1,12 +1,16 @@
-from pyntcloud import PyntCloud
-import sys
+import argparse
+import cloudio
 
-src = sys.argv[1]
-dest = sys.argv[2]
+parser = argparse.ArgumentParser(description="Convert between point cloud formats (LAS/LAZ, PLY, PCD, NPY), "
+                                             "streaming in chunks so the cloud never has to fit in memory.")
+parser.add_argument("src")
+parser.add_argument("dest")
+parser.add_argument("--columns", choices=["xyz", "xyz,intensity"], default=None,
+                    help="Columns to write (default everything in the source)")
+parser.add_argument("--chunk-size", type=int, default=cloudio.DEFAULT_CHUNK_SIZE, help="Points per chunk")
+args = parser.parse_args()
 
-print("Loading", src)
-cloud = PyntCloud.from_file(src)
-#cloud.plot(backend="threejs")
-print("Saving to", dest)
-cloud.to_file(dest)
-print("Done")
+print("Converting", args.src, "to", args.dest)
+count, elapsed = cloudio.convert(args.src, args.dest, args.columns.split(",") if args.columns else None,
+                                 args.chunk_size)
+print(f"Done, {count} points in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} points/s)")
@@ -0,0 +1,206 @@
+"""
+DBSCAN for flattened slices, on a 2D grid instead of a KD-tree.
+
+Points are hashed into square cells eps / sqrt(2) across, so any two points in the same cell are within eps of each
+other, and a point's neighbours can only be in the 5x5 block of cells around it. Distances are only checked between
+points in neighbouring cells, all at once with numpy, and clusters are joined up a cell at a time.
+
+The cell of each point only depends on eps, so for a stack of slices from the same cloud (like a stem profile) the
+cells are found once for the whole cloud, and each slice just takes its range of them.
+"""
+from typing import Iterator, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Cell indices are packed into one int64 key, 31 bits each
+KEY_OFFSET = 1 << 30
+KEY_STRIDE = 1 << 31
+# Max number of point pairs to check at once, to keep memory use down for dense cells
+PAIR_BATCH = 1 << 22
+
+
+def cell_keys(xy: np.ndarray, eps: float) -> np.ndarray:
+    """
+    Get the packed key of the grid cell of each point for clustering with eps.
+    """
+    idx = np.floor(xy[:, :2] / (eps / np.sqrt(2))).astype(np.int64) + KEY_OFFSET
+    return idx[:, 0] * KEY_STRIDE + idx[:, 1]
+
+
+def _point_pairs(order: np.ndarray, starts: np.ndarray, sizes: np.ndarray, cell_a: np.ndarray,
+                 cell_b: np.ndarray) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Enumerate every pair of points between each pair of cells (cell_a[k], cell_b[k]), in batches of about PAIR_BATCH
+    pairs. Yields tuples of (index into the cell pairs, point index in a, point index in b).
+    """
+    ends = np.cumsum(sizes[cell_a] * sizes[cell_b])
+    batch_start = 0
+    while batch_start < len(ends):
+        done = ends[batch_start - 1] if batch_start else 0
+        batch_stop = max(int(np.searchsorted(ends, done + PAIR_BATCH, side="right")), batch_start + 1)
+        a, b = cell_a[batch_start:batch_stop], cell_b[batch_start:batch_stop]
+        pair_counts = sizes[a] * sizes[b]
+        pair_cell = np.repeat(np.arange(len(a)), pair_counts)
+        within = np.arange(len(pair_cell)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        i = order[starts[a][pair_cell] + within // sizes[b][pair_cell]]
+        j = order[starts[b][pair_cell] + within % sizes[b][pair_cell]]
+        yield pair_cell + batch_start, i, j
+        batch_start = batch_stop
+
+
+def _closest_points(xy: np.ndarray, cell_of: np.ndarray, centers: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """
+    Find the point in each cell closest to the cell's center plus target. Returns a point index per cell.
+    """
+    diff = xy - (centers[cell_of] + target)
+    dist = np.einsum("ij,ij->i", diff, diff)
+    best = np.full(len(centers), np.inf)
+    np.minimum.at(best, cell_of, dist)
+    closest = np.full(len(centers), len(xy))
+    hits = np.flatnonzero(dist == best[cell_of])
+    np.minimum.at(closest, cell_of[hits], hits)
+    return closest
+
+
+def _components(edges_a: np.ndarray, edges_b: np.ndarray, n: int) -> np.ndarray:
+    """
+    Label the connected components of a graph of n nodes.
+    """
+    graph = csr_matrix((np.ones(len(edges_a), dtype=np.int8), (edges_a, edges_b)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def grid_dbscan(xy: np.ndarray, eps: float, min_points: int, keys: np.ndarray = None) -> np.ndarray:
+    """
+    Cluster an (N, 2+) array of points on their x and y with DBSCAN: a point is a core point if it has at least
+    min_points points (including itself) within eps. keys can be given from cell_keys() if they're already known.
+
+    Clusters are numbered in order of their first point, border points join the cluster of their first core
+    neighbour, and noise is -1.
+    """
+    n = len(xy)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    xy = np.ascontiguousarray(xy[:, :2], dtype=np.float64)
+    keys = cell_keys(xy, eps) if keys is None else keys
+    order = np.argsort(keys, kind="stable")
+    cells, starts, sizes = np.unique(keys[order], return_index=True, return_counts=True)
+    cell_of = np.empty(n, dtype=np.int64)
+    cell_of[order] = np.repeat(np.arange(len(cells)), sizes)
+    size = eps / np.sqrt(2)
+    centers = (np.column_stack((cells // KEY_STRIDE, cells % KEY_STRIDE)) - KEY_OFFSET + 0.5) * size
+    eps2 = eps * eps
+
+    # Every point in a cell is within eps of every other point in it, so a cell with at least min_points points is
+    # all core points. Neighbour counts start at the cell size.
+    dense = sizes >= min_points
+    counts = sizes[cell_of].copy()
+    # Each pair of neighbouring cells is only looked at once, so only half the offsets around a cell are needed
+    offsets = [(dx, dy) for dx in range(3) for dy in range(-2, 3) if dx > 0 or dy > 0]
+    pairs_a, pairs_b, pairs_offset = [], [], []
+    for dx, dy in offsets:
+        other = np.searchsorted(cells, cells + dx * KEY_STRIDE + dy)
+        found = other < len(cells)
+        found[found] = cells[other[found]] == cells[found] + dx * KEY_STRIDE + dy
+        pairs_a.append(np.flatnonzero(found))
+        pairs_b.append(other[found])
+        pairs_offset.append(np.full(np.count_nonzero(found), len(pairs_offset)))
+    pairs_a, pairs_b, pairs_offset = np.concatenate(pairs_a), np.concatenate(pairs_b), np.concatenate(pairs_offset)
+
+    # Every point pair within eps that involves a cell that isn't dense, since those are needed for the counts
+    sparse = ~dense[pairs_a] | ~dense[pairs_b]
+    close_a, close_b = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for _, i, j in _point_pairs(order, starts, sizes, pairs_a[sparse], pairs_b[sparse]):
+        diff = xy[i] - xy[j]
+        close = np.einsum("ij,ij->i", diff, diff) <= eps2
+        close_a.append(i[close])
+        close_b.append(j[close])
+    close_a, close_b = np.concatenate(close_a), np.concatenate(close_b)
+    counts += np.bincount(close_a, minlength=n) + np.bincount(close_b, minlength=n)
+    core = counts >= min_points
+
+    # Join up cells with core points within eps of each other. The core points in a cell all belong together.
+    links = core[close_a] & core[close_b]
+    edges_a, edges_b = [cell_of[close_a[links]]], [cell_of[close_b[links]]]
+    # Two dense cells are usually joined by the points in each closest to the other, so try those first, and only
+    # check every pair for the cells where that fails
+    dense_a, dense_b, dense_offset = pairs_a[~sparse], pairs_b[~sparse], pairs_offset[~sparse]
+    unresolved = []
+    for k, (dx, dy) in enumerate(offsets):
+        in_offset = dense_offset == k
+        if not np.any(in_offset):
+            continue
+        a, b = dense_a[in_offset], dense_b[in_offset]
+        target = np.array([dx, dy]) * size
+        closest_a = _closest_points(xy, cell_of, centers, target)[a]
+        closest_b = _closest_points(xy, cell_of, centers, -target)[b]
+        diff = xy[closest_a] - xy[closest_b]
+        joined = np.einsum("ij,ij->i", diff, diff) <= eps2
+        edges_a.append(a[joined])
+        edges_b.append(b[joined])
+        unresolved.append(np.flatnonzero(in_offset)[~joined])
+    edges_a, edges_b = np.concatenate(edges_a), np.concatenate(edges_b)
+    components = _components(edges_a, edges_b, len(cells))
+    if unresolved:
+        unresolved = np.concatenate(unresolved)
+        # Only cells that aren't joined some other way yet matter, and only if their bounding boxes are close enough
+        a, b = dense_a[unresolved], dense_b[unresolved]
+        sorted_xy = xy[order]
+        low, high = np.minimum.reduceat(sorted_xy, starts), np.maximum.reduceat(sorted_xy, starts)
+        gap = np.maximum(np.maximum(low[b] - high[a], low[a] - high[b]), 0)
+        unresolved = unresolved[(components[a] != components[b]) & (np.einsum("ij,ij->i", gap, gap) <= eps2)]
+        any_close = np.zeros(len(unresolved), dtype=bool)
+        for pair, i, j in _point_pairs(order, starts, sizes, dense_a[unresolved], dense_b[unresolved]):
+            diff = xy[i] - xy[j]
+            any_close[pair[np.einsum("ij,ij->i", diff, diff) <= eps2]] = True
+        if np.any(any_close):
+            edges_a = np.concatenate((edges_a, dense_a[unresolved[any_close]]))
+            edges_b = np.concatenate((edges_b, dense_b[unresolved[any_close]]))
+            components = _components(edges_a, edges_b, len(cells))
+    labels = np.where(core, components[cell_of], -1)
+
+    # Border points join the cluster of their first core neighbour, from the same cell or a close pair. They're never
+    # in dense cells, so the close pairs have all their neighbours.
+    first_core = np.full(len(cells), n)
+    np.minimum.at(first_core, cell_of[core], np.flatnonzero(core))
+    nearest_core = np.where(core, n, first_core[cell_of])
+    for a, b in ((close_a, close_b), (close_b, close_a)):
+        border = ~core[a] & core[b]
+        np.minimum.at(nearest_core, a[border], b[border])
+    joined = ~core & (nearest_core < n)
+    labels[joined] = labels[nearest_core[joined]]
+
+    clustered = labels >= 0
+    unique, first, inverse = np.unique(labels[clustered], return_index=True, return_inverse=True)
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(unique))
+    labels[clustered] = rank[inverse]
+    return labels
+
+
+class SliceClusterer:
+    """
+    Clusters slices of a z-sorted cloud (see analysis.ZSortedPoints), finding the grid cells of every point once per
+    eps and sharing them between all the slices.
+
+    Only the cells for the last eps used are kept, since they take 8 bytes per point.
+    """
+
+    def __init__(self, points: np.ndarray) -> None:
+        self.points = points
+        self._keys = (None, None)
+
+    def keys(self, eps: float) -> np.ndarray:
+        # Swapped as a whole, so it's safe to use from several threads
+        keys_eps, keys = self._keys
+        if keys_eps != eps:
+            keys = cell_keys(self.points, eps)
+            self._keys = (eps, keys)
+        return keys
+
+    def labels(self, start: int, stop: int, eps: float, min_points: int) -> np.ndarray:
+        """
+        Cluster the points in [start, stop) with grid_dbscan().
+        """
+        return grid_dbscan(self.points[start:stop], eps, min_points, self.keys(eps)[start:stop])
@@ -0,0 +1,266 @@
+from typing import List, Tuple
+import asyncio
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+# The wire protocol is shared with the LiDAR code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lidar"))
+import protocol
+
+
+class ClientStream:
+    """
+    Points received from a single client, waiting to be picked up by the renderer.
+
+    Chunks are added from the server thread and taken from the render thread. deque appends and pops are atomic, so
+    this doesn't need a lock.
+    """
+
+    def __init__(self, client_id: int, address: Tuple[str, int]) -> None:
+        self.client_id = client_id
+        self.address = address
+        self.connected = True
+        self.chunks = collections.deque()
+        # Totals for the whole connection; points_taken is only updated by the render thread, and the rest only by
+        # the server thread
+        self.bytes_received = 0
+        self.points_received = 0
+        self.points_taken = 0
+        self.connected_at = time.monotonic()
+        # Used to compute rates between calls to rates()
+        self._last_stats = (self.connected_at, 0, 0)
+        self._protocol = None
+
+    def take(self) -> List[np.ndarray]:
+        """
+        Take all the chunks of points that have been received. Only call this from the render thread.
+        """
+        chunks = []
+        try:
+            while True:
+                chunk = self.chunks.popleft()
+                self.points_taken += len(chunk)
+                chunks.append(chunk)
+        except IndexError:
+            pass
+        if chunks and self._protocol is not None:
+            self._protocol.drained()
+        return chunks
+
+    @property
+    def pending_points(self) -> int:
+        return self.points_received - self.points_taken
+
+    def rates(self) -> Tuple[float, float]:
+        """
+        Get the rates in (points/s, bytes/s) since the last call.
+        """
+        now = time.monotonic()
+        t, points, nbytes = self._last_stats
+        self._last_stats = (now, self.points_received, self.bytes_received)
+        dt = max(now - t, 1e-9)
+        return (self.points_received - points) / dt, (self.bytes_received - nbytes) / dt
+
+
+class IngestProtocol(asyncio.BufferedProtocol):
+    """
+    Receives points from one client, using either the framed protocol or the legacy raw double protocol.
+
+    Data is received straight into a preallocated buffer and decoded out of it in bulk. If the renderer falls behind
+    and too many points are waiting, reading is paused until it catches up, which pushes back on the client through
+    TCP flow control.
+    """
+
+    # Big enough for the largest possible frame
+    RECV_BUF_SIZE = 1 << 20
+
+    def __init__(self, server: "IngestServer") -> None:
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.stream = None
+        self.buf = bytearray(self.RECV_BUF_SIZE)
+        self.mem = memoryview(self.buf)
+        self.arr = np.frombuffer(self.buf, dtype=np.uint8)
+        self.fill = 0
+        # None until the first bytes come in, then either "framed" or "legacy"
+        self.mode = None
+        self.scan_id = self.seq = None
+        self.paused = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.stream = self.server.add_client(transport.get_extra_info("peername"))
+        self.stream._protocol = self
+        print(f"Connection established from {self.stream.address}")
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.stream.connected = False
+        self.stream._protocol = None
+        print(f"Connection from {self.stream.address} terminated")
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.mem[self.fill:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.fill += nbytes
+        self.stream.bytes_received += nbytes
+        if self.mode is None and not self.negotiate():
+            return
+        try:
+            consumed, points = self.decode()
+        except protocol.ProtocolError as e:
+            print(f"Error from {self.stream.address}: {e}", file=sys.stderr)
+            self.transport.close()
+            return
+        self.consume(consumed)
+        if len(points):
+            self.stream.chunks.append(points)
+            self.stream.points_received += len(points)
+            if self.stream.pending_points > self.server.max_pending_points and not self.paused:
+                self.paused = True
+                self.transport.pause_reading()
+
+    def consume(self, count: int) -> None:
+        """
+        Drop the first count bytes from the buffer.
+        """
+        # Only the leftover partial message is moved, which is small compared to the buffer
+        self.arr[:self.fill - count] = self.arr[count:self.fill]
+        self.fill -= count
+
+    def negotiate(self) -> bool:
+        """
+        Figure out which protocol the client is using. Returns False if more data is needed.
+        """
+        # Clients using the framed protocol start with a hello, while legacy clients start sending points right away
+        if self.fill < len(protocol.MAGIC):
+            return False
+        if not self.buf.startswith(protocol.MAGIC):
+            self.mode = "legacy"
+            print(f"Client {self.stream.address} is using the legacy protocol")
+            return True
+        if self.fill < protocol.HELLO.size:
+            return False
+        _, client_version = protocol.HELLO.unpack(self.mem[:protocol.HELLO.size])
+        version = min(client_version, protocol.VERSION)
+        self.transport.write(protocol.HELLO.pack(protocol.MAGIC, version))
+        print(f"Client {self.stream.address} is using protocol version {version}")
+        self.mode = "framed"
+        self.consume(protocol.HELLO.size)
+        return True
+
+    def drained(self) -> None:
+        """
+        Called from the render thread when points have been taken.
+        """
+        if self.paused:
+            self.loop.call_soon_threadsafe(self._resume)
+
+    def _resume(self) -> None:
+        if self.paused and self.stream.pending_points <= self.server.max_pending_points:
+            self.paused = False
+            self.transport.resume_reading()
+
+    def decode(self) -> Tuple[int, np.ndarray]:
+        """
+        Decode everything complete in the buffer. Returns a tuple of (bytes consumed, (N, 3) array of points).
+        """
+        if self.mode == "legacy":
+            # The copy is needed since the buffer gets reused
+            count = self.fill // protocol.LEGACY_POINT_SIZE
+            points = np.frombuffer(self.buf, dtype=protocol.LEGACY_DTYPE, count=count * 3).reshape(-1, 3).copy()
+            return count * protocol.LEGACY_POINT_SIZE, points
+
+        frames, consumed = protocol.decode_frames(self.mem[:self.fill])
+        for header, _ in frames:
+            if header.scan_id != self.scan_id:
+                print(f"Receiving scan {header.scan_id} from {self.stream.address}")
+            elif header.seq != (self.seq + 1) & 0xFFFFFFFF:
+                print(f"Warning: Expected frame {(self.seq + 1) & 0xFFFFFFFF} but got {header.seq}")
+            self.scan_id, self.seq = header.scan_id, header.seq
+        points = np.concatenate([p[:, :3] for _, p in frames]) if frames else np.empty((0, 3))
+        return consumed, points
+
+
+class IngestServer:
+    """
+    asyncio server receiving points from any number of clients, running its event loop in a background thread.
+
+    Each client gets its own ClientStream. If a client has more than max_pending_points waiting to be taken, reading
+    from it is paused until the renderer catches up.
+    """
+
+    def __init__(self, port: int, max_pending_points: int = 1_000_000, stats_interval: float = 5) -> None:
+        self.port = port
+        self.max_pending_points = max_pending_points
+        self.stats_interval = stats_interval
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self._streams = []
+        self._ids = itertools.count()
+        self._ready = threading.Event()
+        # Set if the server couldn't start (e.g. the port is in use), to be raised in start()
+        self._error = None
+        self._server = None
+
+    def start(self) -> None:
+        """
+        Start the server thread, and wait until the server is listening. Raises the error if it couldn't start.
+        """
+        self.thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self.thread.join()
+            raise self._error
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def streams(self) -> List[ClientStream]:
+        """
+        Get the streams for every client that has connected so far, including ones that have disconnected.
+        """
+        return list(self._streams)
+
+    def add_client(self, address: Tuple[str, int]) -> ClientStream:
+        stream = ClientStream(next(self._ids), address)
+        self._streams.append(stream)
+        return stream
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: IngestProtocol(self), port=self.port, reuse_address=True))
+        except Exception as e:
+            self._error = e
+            self.loop.close()
+            return
+        finally:
+            self._ready.set()
+        stats_task = self.loop.create_task(self._print_stats())
+        try:
+            self.loop.run_forever()
+        finally:
+            stats_task.cancel()
+            self.loop.run_until_complete(asyncio.gather(stats_task, return_exceptions=True))
+            self._server.close()
+            self.loop.run_until_complete(self._server.wait_closed())
+            self.loop.close()
+
+    async def _print_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            for stream in self._streams:
+                if not stream.connected:
+                    continue
+                point_rate, byte_rate = stream.rates()
+                print(f"{stream.address}: {point_rate:.0f} points/s, {byte_rate / 1024:.1f} KiB/s, "
+                      f"{stream.pending_points} waiting")
@@ -1,104 +1,126 @@
-import socketserver
-import threading
 import numpy as np
 import open3d as o3d
-import queue
-import struct
 import colorsys
+import time
+from ingest import IngestServer
+from live_metrics import LiveMetrics, circle_lines, summary
+from lod import LodCloud, ViewWatcher
 
 print("Libraries loaded")
 
 PORT = 4206
+# Max number of times per second to send the point clouds to open3d
+MAX_REFRESH_RATE = 10
+# Reading from a client is paused when it has more than this many points waiting to be drawn
+MAX_PENDING_POINTS = 1_000_000
+# Heights above the lowest point to find stems at while scanning, and the max number of times per second to update them
+LIVE_HEIGHTS = (1.3,)
+LIVE_UPDATE_RATE = 1
+# Max number of points to draw (shared between clients) when the camera is still, and while it's moving
+POINT_BUDGET = 3_000_000
+MOVING_POINT_BUDGET = 300_000
 
-class LidarDemoHandler(socketserver.BaseRequestHandler):
 
-    # This will be running in a different thread, so use the thread safe queue
-    point_queue = None # type: queue.Queue
-    MSG_SIZE = 24
+class ClientCloud:
+    """
+    Points received from one client and the open3d cloud used to show them.
+    """
 
-    def handle(self):
-        print(f"Connection established from {self.client_address}")
-        self.buf = bytearray()
-        while True:
-            data = self.request.recv(1024)
-            if not data:
-                break
-            # Combine the newly received data with previous data
-            self.buf.extend(data)
-            # Unpack the doubles and add them to the queue
-            mem = memoryview(self.buf)
-            i = 0
-            while i < len(self.buf) - (self.MSG_SIZE - 1):
-                x, y, z = struct.unpack("ddd", mem[i:i + self.MSG_SIZE])
-                self.point_queue.put((x, y, z))
-                print(f"Received point ({x}, {y}, {z})")
-                i += 24
-            del mem
-            self.buf = self.buf[i:]
-        print(f"Connection from {self.client_address} terminated")
+    def __init__(self, client_id: int) -> None:
+        # Sorted into levels of detail as they come in, so only as many as the budget allows are drawn
+        self.points = LodCloud()
+        self.cloud = o3d.geometry.PointCloud()
+        # Give each client its own colour
+        self.color = colorsys.hsv_to_rgb((client_id * 0.618) % 1, 0.8, 0.8)
+        self.shown_version = self.points.version
+        self.shown_budget = None
 
 
 if __name__ == "__main__":
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.ThreadingTCPServer(("", PORT), LidarDemoHandler) as server:
-        # Set up shared queue for points
-        point_queue = queue.Queue()
-        LidarDemoHandler.point_queue = point_queue
+    server = IngestServer(PORT, MAX_PENDING_POINTS)
+    server.start()
+    print(f"Started server on port {PORT}")
 
-        server_thread = threading.Thread(target=server.serve_forever)
-        server.daemon_threads = True
-        server_thread.daemon = True
-        server_thread.start()
-        print(f"Started server on port {PORT} in thread {server_thread.name}")
+    # Now set up open3d stuff
+    # Points are collected per client, and only copied over to the open3d clouds when it's time to redraw
+    clouds = {}
+    vis = o3d.visualization.VisualizerWithKeyCallback()
+    vis.create_window()
+    vis.get_render_option().point_size = 2.0
+    vis.add_geometry(o3d.geometry.TriangleMesh.create_coordinate_frame())
+    view_watcher = ViewWatcher(vis)
+    # Stems found so far from every client's points together, drawn as circles
+    live = LiveMetrics(LIVE_HEIGHTS, update_interval=1 / LIVE_UPDATE_RATE)
+    live_result = None
+    stem_lines = o3d.geometry.LineSet()
+    vis.add_geometry(stem_lines, reset_bounding_box=False)
 
-        # Now set up open3d stuff
-        cloud = o3d.geometry.PointCloud()
-        vis = o3d.visualization.VisualizerWithKeyCallback()
-        vis.create_window()
-        vis.get_render_option().point_size = 2.0
-        vis.add_geometry(cloud)
-        vis.add_geometry(o3d.geometry.TriangleMesh.create_coordinate_frame())
+    close = False
+    def reset_view_callback(vis, action, mods):
+        # Key up
+        if action == 1:
+            vis.reset_view_point(True)
+            print("Reset view")
+    def quit_callback(vis, action, mods):
+        global close
+        if action == 1:
+            close = True
+    def save_callback(vis, action, mods):
+        if action == 1:
+            for client_id, client in clouds.items():
+                o3d.io.write_point_cloud(f"network_cloud_{client_id}.ply",
+                                         o3d.geometry.PointCloud(o3d.utility.Vector3dVector(client.points.points())))
+            all_points = [client.points.points() for client in clouds.values()]
+            o3d.io.write_point_cloud("network_cloud.ply", o3d.geometry.PointCloud(
+                o3d.utility.Vector3dVector(np.concatenate(all_points) if all_points else np.empty((0, 3)))))
+            print("Saved point cloud")
+    def reset_callback(vis, action, mods):
+        global live_result
+        if action == 1:
+            for client in clouds.values():
+                client.points.clear()
+            live.reset()
+            live_result = None
+            print("Reset")
+    vis.register_key_action_callback(ord(' '), reset_view_callback)
+    vis.register_key_action_callback(ord('Q'), quit_callback)
+    vis.register_key_action_callback(ord('S'), save_callback)
+    vis.register_key_action_callback(ord('R'), reset_callback)
 
-        close = False
-        def reset_view_callback(vis, action, mods):
-            # Key up
-            if action == 1:
-                vis.reset_view_point(True)
-                print("Reset view")
-        def quit_callback(vis, action, mods):
-            global close
-            if action == 1:
-                close = True
-        def save_callback(vis, action, mods):
-            if action == 1:
-                o3d.io.write_point_cloud("network_cloud.ply", cloud)
-                print("Saved point cloud")
-        def reset_callback(vis, action, mods):
-            if action == 1:
-                cloud.points = o3d.utility.Vector3dVector()
-                vis.update_geometry(cloud)
-                print("Reset")
-        vis.register_key_action_callback(ord(' '), reset_view_callback)
-        vis.register_key_action_callback(ord('Q'), quit_callback)
-        vis.register_key_action_callback(ord('S'), save_callback)
-        vis.register_key_action_callback(ord('R'), reset_callback)
+    last_refresh = 0
+    while not close:
+        for stream in server.streams():
+            client = clouds.get(stream.client_id)
+            if client is None:
+                client = clouds[stream.client_id] = ClientCloud(stream.client_id)
+                vis.add_geometry(client.cloud, reset_bounding_box=False)
+            for chunk in stream.take():
+                client.points.add(chunk)
+                live.add(chunk)
+        now = time.monotonic()
+        if now - last_refresh >= 1 / MAX_REFRESH_RATE:
+            # Fewer points while the camera moves, so it stays smooth
+            budget = (MOVING_POINT_BUDGET if view_watcher.moving() else POINT_BUDGET) // max(len(clouds), 1)
+            for client in clouds.values():
+                if client.points.version != client.shown_version or budget != client.shown_budget:
+                    client.cloud.points = o3d.utility.Vector3dVector(client.points.select(budget))
+                    client.cloud.paint_uniform_color(client.color)
+                    vis.update_geometry(client.cloud)
+                    client.shown_version = client.points.version
+                    client.shown_budget = budget
+            last_refresh = now
+        result = live.poll()
+        if result is not None:
+            print(summary(result, live_result))
+            live_result = result
+            points, lines = circle_lines([stem for stems in result.stems.values() for stem in stems])
+            stem_lines.points = o3d.utility.Vector3dVector(points)
+            stem_lines.lines = o3d.utility.Vector2iVector(lines)
+            stem_lines.paint_uniform_color((1, 0, 0))
+            vis.update_geometry(stem_lines)
+        vis.poll_events()
+        vis.update_renderer()
+    vis.destroy_window()
 
-        while not close:
-            updated = False
-            try:
-                while True:
-                    updated = True
-                    x, y, z = point_queue.get(block=False)
-                    cloud.points.append(np.array((x, y, z)))
-                    #cloud.colors.append(np.array(colorsys.hsv_to_rgb(strength / 10000 * 0.667, 1, 1)))
-                    #cloud.paint_uniform_color([0.75, 0.75, 0.75])
-                    print(f"Added point ({x}, {y}, {z})")
-            except queue.Empty:
-                pass
-            if updated:
-                vis.update_geometry(cloud)
-            vis.poll_events()
-            vis.update_renderer()
-        vis.destroy_window()
-
-        server.shutdown()
+    live.close()
+    server.stop()
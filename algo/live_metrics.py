@@ -0,0 +1,219 @@
+"""
+Progressive tree metrics for a cloud that's still being scanned.
+
+Incoming points are hashed into voxels, grouped into horizontal bands. The stems are only refitted when bands around
+the measurement heights get new voxels, at most once per update interval, and in a background thread so drawing isn't
+held up.
+"""
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import concurrent.futures
+import time
+import numpy as np
+from analysis import compute_diameters_simple, fit_ellipse_ransac, group_clusters
+from cloudio import VoxelAccumulator
+from gridscan import grid_dbscan
+
+
+class Stem(NamedTuple):
+    """
+    A stem found at one of the measurement heights. center is (x, y, z), and diameter is the long diameter.
+    """
+    center: np.ndarray
+    diameter: float
+
+
+class LiveResult(NamedTuple):
+    """
+    Estimates from one update. stems has the stems at each height (in meters above the lowest point), from largest
+    to smallest.
+    """
+    stems: Dict[float, List[Stem]]
+    voxels: int
+    time: float
+
+
+def fit_stems(slice_points: np.ndarray, labels: np.ndarray, use_ransac: bool = True) -> List[Stem]:
+    """
+    Fit each cluster in a slice, keeping where each one is so they can be drawn.
+    """
+    stems = []
+    z = np.mean(slice_points[:, 2]) if len(slice_points) else 0
+    for cluster in group_clusters(slice_points[:, :2], labels):
+        if len(cluster) < 3:
+            continue
+        # Same settings as analysis.compute_diameters_ellipse()
+        ellipse = fit_ellipse_ransac(cluster, min(max(5, len(cluster) // 3), 20), 0.01, seed=0) if use_ransac else None
+        if ellipse is not None:
+            center, diameter = ellipse[0], 2 * np.max(ellipse[1])
+        else:
+            center, diameter = np.mean(cluster, axis=0), compute_diameters_simple(cluster)[0]
+        if np.isfinite(diameter):
+            stems.append(Stem(np.append(center, z), float(diameter)))
+    return sorted(stems, key=lambda stem: -stem.diameter)
+
+
+class _BandGrid:
+    """
+    Voxel keys of a cloud, grouped into horizontal bands so the slices at the measurement heights can be found
+    without looking at the rest of the cloud. Only used from the LiveMetrics worker thread.
+    """
+
+    def __init__(self, voxels: VoxelAccumulator, band_height: float) -> None:
+        self.voxels = voxels
+        self.band_height = band_height
+        # Sorted voxel keys in each band
+        self.bands = {}
+        self.dirty = set()
+        self.z_min = np.inf
+        self.voxel_count = 0
+
+    def add(self, xyz: np.ndarray) -> None:
+        z_min = np.min(xyz[:, 2])
+        if z_min < self.z_min:
+            # Every measurement height moves, so everything has to be redone
+            self.z_min = z_min
+            self.dirty.update(self.bands)
+        keys = np.unique(self.voxels.voxel_keys(xyz))
+        z_index = (keys & ((1 << VoxelAccumulator.KEY_BITS) - 1)) - VoxelAccumulator.KEY_OFFSET
+        band_of = np.floor(z_index * self.voxels.voxel_size / self.band_height).astype(np.int64)
+        order = np.argsort(band_of, kind="stable")
+        bands, starts = np.unique(band_of[order], return_index=True)
+        for band, band_keys in zip(bands.tolist(), np.split(keys[order], starts[1:])):
+            old = self.bands.get(band, np.empty(0, dtype=np.int64))
+            merged = np.union1d(old, band_keys)
+            if len(merged) != len(old):
+                self.bands[band] = merged
+                self.voxel_count += len(merged) - len(old)
+                self.dirty.add(band)
+
+    def slice_bands(self, z: float, thickness: float) -> range:
+        return range(int(np.floor((z - thickness / 2) / self.band_height)),
+                     int(np.floor((z + thickness / 2) / self.band_height)) + 1)
+
+    def slice_points(self, z: float, thickness: float) -> np.ndarray:
+        """
+        Get the centers of the voxels within thickness / 2 of z.
+        """
+        keys = [self.bands[band] for band in self.slice_bands(z, thickness) if band in self.bands]
+        if not keys:
+            return np.empty((0, 3))
+        keys = np.concatenate(keys)
+        mask = (1 << VoxelAccumulator.KEY_BITS) - 1
+        idx = np.column_stack((keys >> (2 * VoxelAccumulator.KEY_BITS), (keys >> VoxelAccumulator.KEY_BITS) & mask,
+                               keys & mask)) - VoxelAccumulator.KEY_OFFSET
+        points = (idx + 0.5) * self.voxels.voxel_size
+        return points[np.abs(points[:, 2] - z) < thickness / 2]
+
+
+class LiveMetrics:
+    """
+    Keeps a voxelized copy of a growing cloud and estimates the stems at the given heights above the lowest point.
+
+    Call add() with new points as they come in, and poll() regularly (e.g. once per frame) to get new results. add()
+    only queues the points up, so it's cheap enough for a render loop; they're voxelized in the background when the
+    next update starts.
+    """
+
+    def __init__(self, heights: Iterable[float] = (1.3,), voxel_size: float = 0.01, band_height: float = 0.1,
+                 slice_step: float = 0.1, eps: float = 0.15, min_points: int = 5, use_ransac: bool = True,
+                 update_interval: float = 1) -> None:
+        self.heights = tuple(heights)
+        self.voxels = VoxelAccumulator(voxel_size)
+        self.band_height = band_height
+        self.slice_step = slice_step
+        self.eps = eps
+        self.min_points = min_points
+        self.use_ransac = use_ransac
+        self.update_interval = update_interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.reset()
+
+    def reset(self) -> None:
+        # An update that's still running works on the old grid, and its result is never looked at
+        self.grid = _BandGrid(self.voxels, self.band_height)
+        # Chunks of points added since the last update started
+        self.pending = []
+        self.future = None
+        self.last_update = 0
+        self.last_result = None
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def add(self, points: np.ndarray) -> None:
+        """
+        Add an (N, 3+) array of new points.
+        """
+        if len(points):
+            self.pending.append(points[:, :3])
+
+    def poll(self) -> Optional[LiveResult]:
+        """
+        Get a new result if one has finished since the last call (otherwise None), and start another update if it's
+        time and points have been added since the last one.
+        """
+        result = None
+        if self.future is not None and self.future.done():
+            result = self.future.result()
+            self.future = None
+            if result is not None:
+                self.last_result = result
+        now = time.monotonic()
+        if self.future is None and self.pending and now - self.last_update >= self.update_interval:
+            self.last_update = now
+            chunks, self.pending = self.pending, []
+            previous = dict(self.last_result.stems) if self.last_result is not None else {}
+            self.future = self.executor.submit(self._update, self.grid, chunks, previous)
+        return result
+
+    def _update(self, grid: _BandGrid, chunks: List[np.ndarray],
+                previous: Dict[float, List[Stem]]) -> Optional[LiveResult]:
+        """
+        Add the new points to the grid and refit the stems at the heights whose bands changed. Returns None if none
+        of them did.
+        """
+        grid.add(np.concatenate(chunks))
+        stems = dict(previous)
+        changed = False
+        for height in self.heights:
+            z = grid.z_min + height
+            if height in previous and not any(band in grid.dirty for band in grid.slice_bands(z, self.slice_step)):
+                continue
+            points = grid.slice_points(z, self.slice_step)
+            # Same clustering as analysis.analyze_slice(), but the fits also need the stem centers
+            labels = grid_dbscan(points, self.eps, self.min_points)
+            stems[height] = fit_stems(points, labels, self.use_ransac) if len(labels) else []
+            changed = True
+        grid.dirty.clear()
+        return LiveResult(stems, grid.voxel_count, time.monotonic()) if changed else None
+
+
+def circle_lines(stems: List[Stem], segments: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Make line segments drawing a horizontal circle for each stem, for an open3d LineSet.
+
+    Returns a tuple of (points, lines).
+    """
+    if not stems:
+        return np.empty((0, 3)), np.empty((0, 2), dtype=np.int64)
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    ring = np.column_stack((np.cos(angles), np.sin(angles), np.zeros(segments)))
+    points = [stem.center + ring * stem.diameter / 2 for stem in stems]
+    ring_lines = np.column_stack((np.arange(segments), (np.arange(segments) + 1) % segments))
+    return np.concatenate(points), np.concatenate([i * segments + ring_lines for i in range(len(stems))])
+
+
+def summary(result: LiveResult, previous: LiveResult = None) -> str:
+    """
+    One line describing a result, with how much the largest diameters changed since the previous one.
+    """
+    parts = []
+    for height, stems in sorted(result.stems.items()):
+        part = f"{height}m: {len(stems)} stems"
+        if stems:
+            part += f", largest {stems[0].diameter:.3f}m"
+            old = previous.stems.get(height) if previous is not None else None
+            if old:
+                part += f" ({stems[0].diameter - old[0].diameter:+.3f})"
+        parts.append(part)
+    return f"[Live] {'; '.join(parts)} from {result.voxels} voxels"
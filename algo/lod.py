@@ -0,0 +1,130 @@
+"""
+Level of detail for drawing big point clouds.
+
+Points are sorted into a voxel pyramid as they're added: each level has voxels half the size of the one before, and
+each point goes in the coarsest level where its voxel has no point yet. Taking the levels in order from the coarsest
+gives an evenly spread subset of the cloud of any size, so only as many points as the viewer can handle get drawn.
+"""
+import time
+import numpy as np
+import open3d as o3d
+from pointbuf import PointBuffer
+
+# Voxel indices are packed into 21 bits each, like cloudio.VoxelAccumulator
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+# Points are sorted into levels this many at a time, to keep the memory used for voxel indices down
+CHUNK_SIZE = 1 << 20
+
+
+class LodCloud:
+    """
+    Growable point cloud sorted into levels of detail, with voxel_size meters at the finest level and levels levels in
+    total. Points that don't go in any level (their finest voxel already has a point) go in a last level of their own,
+    so every point added is kept.
+
+    version is incremented on every change, like PointBuffer.
+    """
+
+    def __init__(self, voxel_size: float = 0.01, levels: int = 8) -> None:
+        self.voxel_size = voxel_size
+        self.levels = [PointBuffer() for _ in range(levels + 1)]
+        # Sorted keys of the occupied voxels in each level, counting the points in coarser levels too
+        self._occupied = [np.empty(0, dtype=np.int64) for _ in range(levels)]
+        self.version = 0
+
+    def __len__(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+    def clear(self) -> None:
+        for level in self.levels:
+            level.clear()
+        self._occupied = [np.empty(0, dtype=np.int64) for _ in self._occupied]
+        self.version += 1
+
+    def add(self, points: np.ndarray) -> None:
+        """
+        Add an (N, 3) array of points.
+        """
+        for start in range(0, len(points), CHUNK_SIZE):
+            self._add(points[start:start + CHUNK_SIZE])
+        self.version += 1
+
+    def _add(self, points: np.ndarray) -> None:
+        idx = np.floor(points / self.voxel_size).astype(np.int64)
+        # Go from the finest level to the coarsest: a point can only have the first voxel at a coarse level if it also
+        # has the first voxel at every finer level, so each level only has to look at what's left from the last one
+        candidates = np.arange(len(points))
+        survivors = []
+        for level in reversed(range(len(self._occupied))):
+            keys = _pack(idx[candidates] >> (len(self._occupied) - 1 - level))
+            # Any one point per voxel will do, so there's no need for the stable sort np.unique() would use
+            order = np.argsort(keys)
+            keys = keys[order]
+            head = np.ones(len(keys), dtype=bool)
+            head[1:] = keys[1:] != keys[:-1]
+            keys, first = keys[head], order[head]
+            occupied = self._occupied[level]
+            pos = np.searchsorted(occupied, keys)
+            new = occupied[np.minimum(pos, len(occupied) - 1)] != keys if len(occupied) else np.ones(len(keys), bool)
+            # Both are sorted, so inserting keeps the keys sorted without sorting again
+            self._occupied[level] = np.insert(occupied, pos[new], keys[new])
+            candidates = np.sort(candidates[first[new]])
+            survivors.append(candidates)
+        survivors.reverse()
+        # survivors[level] includes everything in coarser levels, so take away the next coarser level's points
+        taken = np.zeros(len(points), dtype=bool)
+        for level, members in enumerate(survivors):
+            self.levels[level].extend(points[members[~taken[members]]])
+            taken[members] = True
+        self.levels[-1].extend(points[~taken])
+
+    def select(self, budget: int) -> np.ndarray:
+        """
+        Get up to budget points, from the coarsest levels first. If a level only partly fits, an evenly strided
+        subset of it is used.
+        """
+        parts = []
+        for level in self.levels:
+            if budget <= 0:
+                break
+            points = level.view()
+            if len(points) > budget:
+                points = points[::int(np.ceil(len(points) / budget))]
+            parts.append(points)
+            budget -= len(points)
+        return np.concatenate(parts) if parts else np.empty((0, 3))
+
+    def points(self) -> np.ndarray:
+        """
+        Get every point added (in level order, not the order they were added in).
+        """
+        return np.concatenate([level.view() for level in self.levels])
+
+
+def _pack(idx: np.ndarray) -> np.ndarray:
+    idx = idx + KEY_OFFSET
+    if np.any(idx < 0) or np.any(idx >= 1 << KEY_BITS):
+        raise ValueError("Points are too far from the origin for this voxel size")
+    return (idx[:, 0] << (2 * KEY_BITS)) | (idx[:, 1] << KEY_BITS) | idx[:, 2]
+
+
+class ViewWatcher:
+    """
+    Tells whether the camera of an open3d Visualizer is moving, by checking if its extrinsic matrix has changed in
+    the last idle_time seconds.
+    """
+
+    def __init__(self, vis: o3d.visualization.Visualizer, idle_time: float = 0.3) -> None:
+        self.vis = vis
+        self.idle_time = idle_time
+        self._extrinsic = None
+        self._last_change = -np.inf
+
+    def moving(self) -> bool:
+        extrinsic = self.vis.get_view_control().convert_to_pinhole_camera_parameters().extrinsic
+        now = time.monotonic()
+        if self._extrinsic is not None and not np.array_equal(extrinsic, self._extrinsic):
+            self._last_change = now
+        self._extrinsic = np.array(extrinsic)
+        return now - self._last_change < self.idle_time
@@ -0,0 +1,277 @@
+"""
+Native point cloud cache, so big clouds only have to be parsed once.
+
+The first time a cloud is loaded, its points are written next to the source file as <source>.pcc: a small JSON
+header followed by contiguous columns (float32 xyz, plus optional attributes like intensity). The points are stored
+sorted by z, and the header has the bounding box. Later loads just memory map the columns, which is nearly instant and
+lets several processes share the same pages.
+
+float32 is good to half a millimeter out to LOCAL_LIMIT meters from the origin, so clouds within that are stored as
+they are. Clouds further out (e.g. georeferenced ones) are stored relative to an offset near their lower corner.
+
+A cache is used as long as the source's size and modification time match, or if only the modification time changed,
+as long as a hash of the whole source still matches.
+"""
+from typing import Dict, Iterator, Optional
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+import cloudio
+
+MAGIC = b"PCC\0"
+VERSION = 2
+EXTENSION = ".pcc"
+# Magic, version, header length
+PREFIX = struct.Struct("<4sII")
+# Columns start on this alignment
+ALIGNMENT = 64
+# Clouds with every coordinate within this many meters of the origin are stored without an offset
+LOCAL_LIMIT = 4096
+# How much of the source to read at a time when hashing it
+HASH_BYTES = 1 << 20
+
+
+def cache_path(source: str) -> str:
+    return source + EXTENSION
+
+
+def source_hash(source: str) -> str:
+    """
+    Hash the size and contents of a file. This is only needed to check that a file with a new modification time hasn't
+    actually changed (e.g. after being copied), and since an edit can be anywhere, the whole file is read.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(os.path.getsize(source).to_bytes(8, "little"))
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_stamp(source: str) -> Dict[str, object]:
+    """
+    Get what's needed to tell later whether a source file has changed, for source_matches().
+    """
+    stat = os.stat(source)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns, "source_hash": source_hash(source)}
+
+
+def source_matches(source: str, stamp: Dict[str, object]) -> bool:
+    """
+    Check whether a source file is unchanged since source_stamp() was called on it.
+
+    If only the modification time changed (e.g. after a touch or copy), stamp is updated with the new one, so the
+    caller can save it and skip hashing the source next time.
+    """
+    stat = os.stat(source)
+    if stat.st_size != stamp["source_size"]:
+        return False
+    if stat.st_mtime_ns == stamp["source_mtime_ns"]:
+        return True
+    if source_hash(source) != stamp["source_hash"]:
+        return False
+    stamp["source_mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+class CachedCloud:
+    """
+    A memory mapped point cloud cache. Points are sorted by z.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, header_len = PREFIX.unpack(f.read(PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a point cloud cache")
+            if version != VERSION:
+                raise ValueError(f"{path} has cache version {version}, expected {VERSION}")
+            self.header = json.loads(f.read(header_len))
+        self.count = self.header["count"]
+        self.offset = np.array(self.header["offset"])
+        self.bbox_min = np.array(self.header["bbox_min"])
+        self.bbox_max = np.array(self.header["bbox_max"])
+        self.columns = {}
+        for name, info in self.header["columns"].items():
+            shape = (self.count, *info["shape"])
+            self.columns[name] = np.memmap(path, dtype=info["dtype"], mode="r", offset=info["offset"], shape=shape)
+
+    @property
+    def xyz(self) -> np.ndarray:
+        """
+        The float32 xyz column, relative to self.offset.
+        """
+        return self.columns["xyz"]
+
+    def points(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Get a range of points as an (N, 3) float64 array in the original coordinates. This is a copy; use xyz for a
+        view of the cache itself.
+        """
+        return self.xyz[start:stop].astype(np.float64) + self.offset
+
+    def matches(self, source: str) -> bool:
+        """
+        Check whether this cache is still valid for a source file.
+        """
+        mtime = self.header.get("source_mtime_ns")
+        if not source_matches(source, self.header):
+            return False
+        if self.header["source_mtime_ns"] != mtime:
+            self._update_header()
+        return True
+
+    def _update_header(self) -> None:
+        """
+        Write the header back to the file in place. There's padding after it, so small changes fit without moving the
+        columns.
+        """
+        try:
+            with open(self.path, "r+b") as f:
+                _, _, header_len = PREFIX.unpack(f.read(PREFIX.size))
+                header_bytes = json.dumps(self.header).encode("utf-8")
+                if len(header_bytes) <= header_len:
+                    f.write(header_bytes.ljust(header_len))
+        except OSError as e:
+            # Only costs a hash of the source next time
+            print(f"Warning: Couldn't update cache header of {self.path}: {e}")
+
+
+class _InMemoryCloud(CachedCloud):
+    """
+    Stand-in with the same interface as a CachedCloud, for when the cache couldn't be written.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, columns: Dict[str, np.ndarray]) -> None:
+        xyz = columns["xyz"]
+        order = np.argsort(xyz[:, 2], kind="stable")
+        self.path = None
+        self.header = {}
+        self.count = len(xyz)
+        self.offset = np.zeros(3)
+        self.bbox_min = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+        self.bbox_max = xyz.max(axis=0) if len(xyz) else np.zeros(3)
+        self.columns = {name: column[order] for name, column in columns.items()}
+
+    def points(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self.xyz[start:stop]
+
+
+class CacheReader(cloudio.CloudReader):
+    """
+    Chunked reader for a cache, so anything using cloudio readers can use it in place of the source.
+    """
+
+    def __init__(self, cloud: CachedCloud) -> None:
+        self.cloud = cloud
+        self.count = cloud.count
+        self.columns = list(cloud.columns)
+
+    def chunks(self, chunk_size: int = cloudio.DEFAULT_CHUNK_SIZE) -> Iterator[cloudio.Chunk]:
+        for start in range(0, self.count, chunk_size):
+            chunk = {"xyz": self.cloud.points(start, start + chunk_size)}
+            for name, column in self.cloud.columns.items():
+                if name != "xyz":
+                    chunk[name] = np.asarray(column[start:start + chunk_size])
+            yield chunk
+
+
+def write_cache(source: str, columns: Dict[str, np.ndarray], path: Optional[str] = None) -> CachedCloud:
+    """
+    Write a cache for a source file from its columns (at least "xyz", as an (N, 3) float64 array), and open it.
+    """
+    path = path or cache_path(source)
+    xyz = columns["xyz"]
+    order = np.argsort(xyz[:, 2], kind="stable")
+    if len(xyz):
+        bbox_min, bbox_max = xyz.min(axis=0), xyz.max(axis=0)
+    else:
+        bbox_min = bbox_max = np.zeros(3)
+    # float32 loses too much precision for georeferenced coordinates, so those are stored relative to the bounding box
+    local = np.all(np.abs(bbox_min) <= LOCAL_LIMIT) and np.all(np.abs(bbox_max) <= LOCAL_LIMIT)
+    offset = np.zeros(3) if local else np.floor(bbox_min)
+    arrays = {"xyz": (xyz[order] - offset).astype(np.float32)}
+    for name, column in columns.items():
+        if name != "xyz":
+            arrays[name] = np.ascontiguousarray(column[order])
+
+    header = {
+        "count": len(xyz),
+        "offset": offset.tolist(),
+        "bbox_min": bbox_min.tolist(),
+        "bbox_max": bbox_max.tolist(),
+        **source_stamp(source),
+        "columns": {},
+    }
+    # The column offsets depend on the header size, so lay them out with room for the offsets themselves
+    header_len = len(json.dumps(header)) + 128 * len(arrays) + 64
+    pos = -(-(PREFIX.size + header_len) // ALIGNMENT) * ALIGNMENT
+    for name, array in arrays.items():
+        header["columns"][name] = {"dtype": array.dtype.str, "shape": list(array.shape[1:]), "offset": pos}
+        pos = -(-(pos + array.nbytes) // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode("utf-8").ljust(header_len)
+
+    # Write to a temporary file first, so other processes never see a partial cache
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(PREFIX.pack(MAGIC, VERSION, header_len))
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(header["columns"][name]["offset"])
+                f.write(array.tobytes())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return CachedCloud(path)
+
+
+def open_cache(source: str) -> Optional[CachedCloud]:
+    """
+    Open the cache for a source file if there's a valid one, otherwise return None.
+    """
+    path = cache_path(source)
+    if not os.path.exists(path):
+        return None
+    try:
+        cloud = CachedCloud(path)
+        if cloud.matches(source):
+            return cloud
+    except (ValueError, KeyError, OSError) as e:
+        print(f"Warning: Ignoring bad cache {path}: {e}")
+    return None
+
+
+def load(source: str) -> CachedCloud:
+    """
+    Load a point cloud through its cache, creating the cache first if needed.
+    """
+    cloud = open_cache(source)
+    if cloud is not None:
+        return cloud
+    with cloudio.open_reader(source) as reader:
+        chunks = list(reader.chunks())
+        columns = {name: np.concatenate([c[name] for c in chunks]) if chunks else np.empty((0, 3))
+                   for name in reader.columns}
+    try:
+        return write_cache(source, columns)
+    except OSError as e:
+        # e.g. the source is in a read-only directory; the points can still be used, just not cached
+        print(f"Warning: Couldn't write cache for {source}: {e}")
+        return _InMemoryCloud(columns)
+
+
+def open_reader(source: str) -> cloudio.CloudReader:
+    """
+    Open a chunked reader for a point cloud, reading from its cache if it has a valid one. Unlike load(), this never
+    creates a cache, so it's fine for clouds too big to sort in memory.
+    """
+    cloud = open_cache(source)
+    if cloud is not None:
+        return CacheReader(cloud)
+    return cloudio.open_reader(source)
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class PointBuffer:
+    """
+    Growable array of points, for adding points in bulk without reallocating every time.
+
+    The capacity doubles whenever it runs out, so adding N points in chunks takes amortized O(N) time.
+    """
+
+    def __init__(self, columns: int = 3, capacity: int = 1024, dtype=np.float64) -> None:
+        self._data = np.empty((capacity, columns), dtype=dtype)
+        self._size = 0
+        # Incremented on every change, so users can tell if they need to update
+        self.version = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    def extend(self, points: np.ndarray) -> None:
+        """
+        Add an (N, columns) array of points.
+        """
+        needed = self._size + len(points)
+        if needed > len(self._data):
+            # A buffer can start out with no capacity, which doubling alone would never grow
+            capacity = max(len(self._data), 1)
+            while capacity < needed:
+                capacity *= 2
+            data = np.empty((capacity, self._data.shape[1]), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:needed] = points
+        self._size = needed
+        self.version += 1
+
+    def clear(self) -> None:
+        """
+        Remove all points, keeping the allocated memory.
+        """
+        self._size = 0
+        self.version += 1
+
+    def view(self) -> np.ndarray:
+        """
+        Get the points currently in the buffer.
+
+        This is a view into the buffer, so it's only valid until the next call to extend().
+        """
+        return self._data[:self._size]
@@ -0,0 +1,92 @@
+"""
+Turn a raw capture from the LiDAR (see lidar/capture.py) into a point cloud, with adjustable calibration.
+
+This redoes what the scanner does live, but all at once, so a scan with the wrong calibration can be fixed in seconds
+instead of being redone in the field.
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import cloudio
+
+# The capture format and projection are shared with the LiDAR code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lidar"))
+import capture
+from projection import interpolate_angles, to_cartesian
+
+
+def reproject(session: capture.Capture, scan: int = None, arm_length: float = None, vert_offset: float = None,
+              h_offset: float = 0, range_scale: float = 1, range_offset: float = 0, latency: float = 0,
+              min_strength: int = 0) -> np.ndarray:
+    """
+    Convert the readings in one session of a capture to an (N, 4) array of x, y, z, strength.
+
+    If scan is given, only that scan of the session (counting from 0) is used. Calibration settings that aren't given
+    are taken from the session's metadata:
+    - arm_length: Offset from the servo arm in meters.
+    - vert_offset: The actual VERT_OFFSET of the vertical servo, if the one used while scanning was wrong.
+    - h_offset: Degrees to add to the horizontal angles.
+    - range_scale, range_offset: Corrected range is range * range_scale + range_offset.
+    - latency: How far the servos lag behind their commands in seconds.
+    - min_strength: Readings weaker than this are thrown away.
+    """
+    meta = session.metadata
+    readings = session.readings
+    if scan is not None:
+        start = session.scans[scan]
+        stop = session.scans[scan + 1] if scan + 1 < len(session.scans) else np.inf
+        readings = readings[(readings["t"] >= start) & (readings["t"] < stop)]
+    if arm_length is None:
+        arm_length = meta.get("arm_length", 0.05)
+    # Commanded angles are relative to the offset that was set, so correct for the difference
+    v_correction = 0 if vert_offset is None else meta.get("vert_offset", vert_offset) - vert_offset
+
+    h, v, record = interpolate_angles(readings["t"] - latency, session.servos)
+    keep = record & (readings["r"] >= 0) & (readings["strength"] >= min_strength)
+    r = readings["r"][keep] * range_scale + range_offset
+    points = np.empty((len(r), 4))
+    points[:, :3] = to_cartesian(r, h[keep] + h_offset, v[keep] + v_correction, arm_length)
+    points[:, 3] = readings["strength"][keep]
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproject a raw LiDAR capture into a point cloud.")
+    parser.add_argument("capture", help="Capture file from the scanner")
+    parser.add_argument("output", help="Output point cloud (.ply, .pcd, .npy, .las or .laz)")
+    parser.add_argument("--scan", type=int, default=None,
+                        help="Only use this scan (from 0, counting through every session in the file)")
+    parser.add_argument("--arm-length", type=float, default=None, help="Servo arm length in meters")
+    parser.add_argument("--vert-offset", type=float, default=None, help="Actual vertical servo offset in degrees")
+    parser.add_argument("--h-offset", type=float, default=0, help="Degrees to add to the horizontal angles")
+    parser.add_argument("--range-scale", type=float, default=1, help="Scale factor for ranges")
+    parser.add_argument("--range-offset", type=float, default=0, help="Offset to add to ranges in meters")
+    parser.add_argument("--latency", type=float, default=0, help="Servo lag behind commands in seconds")
+    parser.add_argument("--min-strength", type=int, default=0, help="Drop readings weaker than this")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    sessions = capture.read_capture(args.capture)
+    print(f"Read {sum(len(session.readings) for session in sessions)} readings, "
+          f"{sum(len(session.servos) for session in sessions)} servo commands and "
+          f"{sum(len(session.scans) for session in sessions)} scans from {len(sessions)} sessions")
+    # Each session has its own clock and settings, so they're reprojected separately
+    jobs = [(session, None) for session in sessions]
+    if args.scan is not None:
+        first_scans = np.cumsum([0] + [len(session.scans) for session in sessions])
+        if not 0 <= args.scan < first_scans[-1]:
+            parser.error(f"--scan must be less than the number of scans ({first_scans[-1]})")
+        i = int(np.searchsorted(first_scans, args.scan, side="right")) - 1
+        jobs = [(sessions[i], args.scan - int(first_scans[i]))]
+    points = [reproject(session, scan, args.arm_length, args.vert_offset, args.h_offset, args.range_scale,
+                        args.range_offset, args.latency, args.min_strength) for session, scan in jobs]
+    points = np.concatenate(points) if points else np.empty((0, 4))
+    with cloudio.open_writer(args.output, len(points), ["xyz", "intensity"]) as writer:
+        writer.write({"xyz": points[:, :3], "intensity": points[:, 3]})
+    print(f"Wrote {len(points)} points to {args.output} in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
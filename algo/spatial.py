@@ -0,0 +1,199 @@
+"""
+Shared KD-tree for a point cloud, so outlier removal and normal estimation don't each build their own.
+
+The index can be saved next to the cloud as <source>.kdt and loaded again in a fraction of the time it takes to build,
+the same way as the point cache (see pccache). Build it on the points from analysis.load_points(), which are sorted by
+z, so that any horizontal slice is a range of indices and slice queries can use the same tree.
+
+Index files are .npz archives of the tree's arrays, loaded without pickle, so opening one can't run any code. The
+arrays are cKDTree's internal state, so an index is only used with the same scipy version that saved it.
+"""
+from typing import Dict, Optional, Tuple
+import json
+import os
+import zipfile
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+import pccache
+
+VERSION = 2
+EXTENSION = ".kdt"
+
+
+def index_path(source: str) -> str:
+    return source + EXTENSION
+
+
+class SpatialIndex:
+    """
+    KD-tree over an (N, 3+) array of points, with the neighbour queries the rest of the code needs.
+
+    Queries run on workers threads (-1 for all cores). Pass tree to wrap an existing cKDTree instead of building one.
+    """
+
+    def __init__(self, points: Optional[np.ndarray], leafsize: int = 16, workers: int = -1,
+                 tree: Optional[cKDTree] = None) -> None:
+        self.tree = tree if tree is not None else cKDTree(np.ascontiguousarray(points[:, :3]), leafsize=leafsize)
+        self.workers = workers
+        self.header = {}
+
+    def __len__(self) -> int:
+        return self.tree.n
+
+    @property
+    def points(self) -> np.ndarray:
+        return self.tree.data
+
+    def knn(self, query: np.ndarray, k: int, max_distance: float = np.inf,
+            mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest indexed points to each query point, no further than max_distance. If mask is given, only
+        the indexed points where it's True count.
+
+        Returns a tuple of (distances, indices), each (M, k) and sorted by distance. Missing neighbours have a
+        distance of inf and an index of len(self), like cKDTree.query().
+        """
+        n = len(self)
+        query = query[:, :3]
+        if mask is None:
+            distances, indices = self.tree.query(query, k, distance_upper_bound=max_distance, workers=self.workers)
+            return distances.reshape(len(query), k), indices.reshape(len(query), k)
+        distances = np.full((len(query), k), np.inf)
+        indices = np.full((len(query), k), n)
+        # Ask for more neighbours than needed to allow for the masked out ones, and ask again with twice as many for
+        # any points that still don't have enough
+        todo = np.arange(len(query))
+        k_try = min(n, max(k, int(np.ceil(1.5 * k * n / max(np.count_nonzero(mask), 1)))))
+        while len(todo):
+            d, i = self.tree.query(query[todo], k_try, distance_upper_bound=max_distance, workers=self.workers)
+            d, i = d.reshape(len(todo), k_try), i.reshape(len(todo), k_try)
+            found = i < n
+            valid = found & mask[np.minimum(i, n - 1)]
+            # Neighbours past max_distance are missing, so there's no point asking for more
+            done = (np.count_nonzero(valid, axis=1) >= k) | ~np.all(found, axis=1) | (k_try >= n)
+            first = np.argsort(~valid[done], axis=1, kind="stable")[:, :k]
+            keep = np.take_along_axis(valid[done], first, axis=1)
+            distances[todo[done]] = np.where(keep, np.take_along_axis(d[done], first, axis=1), np.inf)
+            indices[todo[done]] = np.where(keep, np.take_along_axis(i[done], first, axis=1), n)
+            todo = todo[~done]
+            k_try = min(n, 2 * k_try)
+        return distances, indices
+
+    def normals(self, radius: float = 0.1, max_nn: int = 10, chunk_size: int = 1_000_000) -> np.ndarray:
+        """
+        Estimate the (unoriented) normal of every indexed point by PCA of up to max_nn neighbours within radius, like
+        open3d's estimate_normals() with a hybrid search. Points with fewer than 3 neighbours get (0, 0, 1).
+        """
+        normals = np.empty((len(self), 3))
+        for start in range(0, len(self), chunk_size):
+            _, idx = self.knn(self.points[start:start + chunk_size], max_nn, radius)
+            found = idx < len(self)
+            counts = np.count_nonzero(found, axis=1)
+            neighbours = np.where(found[..., None], self.points[np.minimum(idx, len(self) - 1)], 0)
+            mean = neighbours.sum(axis=1) / np.maximum(counts, 1)[:, None]
+            centered = np.where(found[..., None], neighbours - mean[:, None], 0)
+            cov = np.einsum("nki,nkj->nij", centered, centered)
+            # Eigenvalues come out in ascending order, so the normal is the first eigenvector
+            _, vectors = np.linalg.eigh(cov)
+            normals[start:start + chunk_size] = np.where(counts[:, None] >= 3, vectors[:, :, 0], (0, 0, 1))
+        return normals
+
+    def statistical_outliers(self, nb_neighbors: int, std_ratio: float,
+                             mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Find the points whose average distance to their nb_neighbors nearest neighbours (including themselves) is
+        less than std_ratio standard deviations above the average, like open3d's remove_statistical_outlier(). If
+        mask is given, only the points where it's True are considered, both as points and as neighbours.
+
+        Returns a boolean mask of the points to keep.
+        """
+        subset = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        distances, _ = self.knn(self.points[subset], nb_neighbors, mask=mask)
+        mean_distances = np.mean(np.where(np.isfinite(distances), distances, 0), axis=1)
+        threshold = np.mean(mean_distances) + std_ratio * np.std(mean_distances, ddof=1)
+        keep = np.zeros(len(self), dtype=bool)
+        keep[subset] = mean_distances < threshold
+        return keep
+
+    def radius_outliers(self, nb_points: int, radius: float) -> np.ndarray:
+        """
+        Find the points with at least nb_points points (including themselves) within radius, like open3d's
+        remove_radius_outlier().
+
+        Returns a boolean mask of the points to keep.
+        """
+        counts = self.tree.query_ball_point(self.points, radius, workers=self.workers, return_length=True)
+        return counts >= nb_points
+
+    def save(self, path: str, source: Optional[str] = None, stamp: Optional[Dict[str, object]] = None) -> None:
+        """
+        Save the index to a file. If it was built from a source file, pass it so the index can be checked against it
+        when loading, or pass its stamp from pccache.source_stamp() if that's already known.
+        """
+        header = {"version": VERSION, "count": len(self), "scipy": scipy.__version__}
+        if stamp is not None:
+            header.update(stamp)
+        elif source is not None:
+            header.update(pccache.source_stamp(source))
+        # Missing parts of the tree's state (like boxsize) are None, and are left out
+        parts = self.tree.__getstate__()
+        state = {f"state_{i}": np.asarray(part) for i, part in enumerate(parts) if part is not None}
+        # Write to a temporary file first, so other processes never see a partial index
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, header=np.array(json.dumps(header)), state_length=len(parts), **state)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.header = header
+
+    @classmethod
+    def load(cls, path: str) -> "SpatialIndex":
+        with np.load(path, allow_pickle=False) as archive:
+            header = json.loads(archive["header"].item())
+            if header.get("version") != VERSION:
+                raise ValueError(f"{path} has index version {header.get('version')}, expected {VERSION}")
+            if header.get("scipy") != scipy.__version__:
+                raise ValueError(f"{path} was saved with scipy {header.get('scipy')}, not {scipy.__version__}")
+            state = [archive[f"state_{i}"] if f"state_{i}" in archive else None
+                     for i in range(int(archive["state_length"]))]
+        # Sizes are saved as 0-d arrays, but the tree wants them as plain numbers
+        state = tuple(part.item() if part is not None and part.ndim == 0 else part for part in state)
+        tree = cKDTree.__new__(cKDTree)
+        tree.__setstate__(state)
+        index = cls(None, tree=tree)
+        index.header = header
+        return index
+
+
+def open_index(source: str, points: np.ndarray) -> SpatialIndex:
+    """
+    Get the index for the points loaded from a source file, from <source>.kdt if there's a valid one, otherwise by
+    building it and saving it there.
+    """
+    path = index_path(source)
+    if os.path.exists(path):
+        try:
+            index = SpatialIndex.load(path)
+            mtime = index.header.get("source_mtime_ns")
+            if len(index) == len(points) and pccache.source_matches(source, index.header) \
+                    and np.array_equal(index.points, points[:, :3]):
+                if index.header["source_mtime_ns"] != mtime:
+                    # Only the source's modification time changed, so save the new one to skip hashing it next time
+                    stamp = {key: value for key, value in index.header.items() if key.startswith("source_")}
+                    try:
+                        index.save(path, stamp=stamp)
+                    except OSError as e:
+                        print(f"Warning: Couldn't update index for {source}: {e}")
+                return index
+        except (ValueError, KeyError, OSError, EOFError, zipfile.BadZipFile) as e:
+            print(f"Warning: Ignoring bad index {path}: {e}")
+    index = SpatialIndex(points)
+    try:
+        index.save(path, source)
+    except OSError as e:
+        print(f"Warning: Couldn't save index for {source}: {e}")
+    return index
@@ -1,23 +1,21 @@
 import open3d as o3d
 import sys
 import numpy as np
+from analysis import load_points, verticality_filter
+from spatial import open_index
 
-cloud = o3d.io.read_point_cloud(sys.argv[1])
-print(cloud)
+points = load_points(sys.argv[1])
+print(f"Loaded {len(points)} points")
+# Both filters search the same saved KD-tree
+index = open_index(sys.argv[1], points)
 
-cloud.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=10))
-
-#o3d.visualization.draw_geometries([cloud], point_show_normal=True)
-
-points = np.asarray(cloud.points)
-normals = np.asarray(cloud.normals)
-filtered = points[np.where(np.abs([np.dot(a, b) / np.linalg.norm(a) for a, b in zip(points, normals)]) > np.cos(np.deg2rad(75)))]
+vertical = verticality_filter(points, 75, radius=0.1, max_nn=10, index=index)
+print(f"{np.count_nonzero(vertical)} points facing the scanner")
+keep = index.statistical_outliers(20, 1.5, mask=vertical)
+print(f"{np.count_nonzero(keep)} points after outlier removal")
 
 c = o3d.geometry.PointCloud()
-c.points = o3d.utility.Vector3dVector(filtered)
-print(c)
-c, _ = c.remove_statistical_outlier(20, 1.5, True)
-print(c)
+c.points = o3d.utility.Vector3dVector(points[keep].astype(np.float64))
 
 #o3d.visualization.draw(cloud)
 
@@ -0,0 +1,166 @@
+"""
+Raw capture logs, so scans can be reprocessed later (e.g. with better calibration) instead of redone.
+
+A capture file starts with MAGIC and the format version, followed by any number of blocks. Each block is a type byte
+and a payload length, then the payload:
+
+- BLOCK_META: JSON with the settings in use when recording started (precision, arm length, servo offsets, ...)
+- BLOCK_SCAN: a float64 timestamp marking the start of a scan
+- BLOCK_READINGS: packed READING_RECORD records of raw sensor readings
+- BLOCK_SERVOS: packed SERVO_RECORD records of servo commands
+
+Files are only ever appended to, so several sessions can go in one file, and a file cut short by a crash can still be
+read up to the last complete block. Each session starts with a BLOCK_META block, and everything after it up to the
+next one belongs to it. Timestamps are time.monotonic(), which starts over when the scanner reboots, so they're only
+comparable within a session, and read_capture() keeps the sessions apart.
+"""
+from typing import Dict, List, NamedTuple
+import json
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from ringbuf import READING_DTYPE, SERVO_DTYPE
+
+MAGIC = b"TDCP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sB")
+# Block type, payload length
+BLOCK_HEADER = struct.Struct("<BI")
+BLOCK_META = 0
+BLOCK_SCAN = 1
+BLOCK_READINGS = 2
+BLOCK_SERVOS = 3
+
+# Smaller versions of the ring buffer records, since float32 is plenty for everything but the timestamps
+READING_RECORD = np.dtype([("t", "<f8"), ("r", "<f4"), ("strength", "<i4"), ("temp", "<f4")])
+SERVO_RECORD = np.dtype([("t", "<f8"), ("h", "<f4"), ("v", "<f4"), ("record", "u1")])
+
+
+class Capture(NamedTuple):
+    """
+    One session read from a capture file. readings and servos use the ring buffer dtypes (ringbuf.READING_DTYPE and
+    ringbuf.SERVO_DTYPE), scans are the start times of each scan, and metadata is the settings the session was
+    recorded with.
+    """
+    readings: np.ndarray
+    servos: np.ndarray
+    scans: np.ndarray
+    metadata: Dict[str, object]
+
+
+class CaptureWriter:
+    """
+    Appends blocks to a capture file from a background thread, so that recording never blocks the caller.
+
+    Everything passed in is queued and written (buffered) by the writer thread. Call flush() to make sure everything
+    so far gets written out to the OS, and close() when done.
+    """
+
+    def __init__(self, path: str, metadata: Dict[str, object]) -> None:
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.bytes_written = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._put(BLOCK_META, json.dumps(metadata).encode("utf-8"))
+
+    def _put(self, block_type: int, payload: bytes) -> None:
+        self._queue.put(BLOCK_HEADER.pack(block_type, len(payload)) + payload)
+
+    def start_scan(self, t: float = None) -> None:
+        self._put(BLOCK_SCAN, struct.pack("<d", time.monotonic() if t is None else t))
+
+    def write_readings(self, readings: np.ndarray) -> None:
+        """
+        Record an array of readings (ringbuf.READING_DTYPE).
+        """
+        if len(readings):
+            self._put(BLOCK_READINGS, _pack(readings, READING_RECORD))
+
+    def write_servos(self, servos: np.ndarray) -> None:
+        """
+        Record an array of servo commands (ringbuf.SERVO_DTYPE).
+        """
+        if len(servos):
+            self._put(BLOCK_SERVOS, _pack(servos, SERVO_RECORD))
+
+    def flush(self) -> None:
+        """
+        Ask the writer thread to flush once it has written everything queued so far. Doesn't wait for it.
+        """
+        self._queue.put(b"")
+
+    def close(self) -> None:
+        """
+        Write everything that's queued and close the file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.file.close()
+
+    def _run(self) -> None:
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if not data:
+                self.file.flush()
+                continue
+            self.file.write(data)
+            self.bytes_written += len(data)
+        self.file.flush()
+
+
+def _pack(records: np.ndarray, dtype: np.dtype) -> bytes:
+    packed = np.empty(len(records), dtype=dtype)
+    for name in dtype.names:
+        packed[name] = records[name]
+    return packed.tobytes()
+
+
+def _unpack(blocks: List[bytes], record: np.dtype, dtype: np.dtype) -> np.ndarray:
+    packed = np.frombuffer(b"".join(blocks), dtype=record)
+    records = np.empty(len(packed), dtype=dtype)
+    for name in record.names:
+        records[name] = packed[name]
+    return records
+
+
+def read_capture(path: str) -> List[Capture]:
+    """
+    Read a whole capture file, with one Capture per session in the order they were recorded. An incomplete block at
+    the end (e.g. from a crash) is ignored.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a capture file")
+    if version > VERSION:
+        raise ValueError(f"{path} has capture version {version}, but only up to {VERSION} is supported")
+    # Blocks of each type for each session, along with its metadata
+    sessions = []
+    pos = FILE_HEADER.size
+    while pos + BLOCK_HEADER.size <= len(data):
+        block_type, length = BLOCK_HEADER.unpack_from(data, pos)
+        pos += BLOCK_HEADER.size
+        if pos + length > len(data):
+            break
+        payload = data[pos:pos + length]
+        pos += length
+        if block_type == BLOCK_META or not sessions:
+            sessions.append(({BLOCK_SCAN: [], BLOCK_READINGS: [], BLOCK_SERVOS: []}, {}))
+        blocks, meta = sessions[-1]
+        if block_type == BLOCK_META:
+            meta.update(json.loads(payload))
+        # Skip unknown blocks so newer files can still be read
+        elif block_type in blocks:
+            blocks[block_type].append(payload)
+    return [Capture(_unpack(blocks[BLOCK_READINGS], READING_RECORD, READING_DTYPE),
+                    _unpack(blocks[BLOCK_SERVOS], SERVO_RECORD, SERVO_DTYPE),
+                    np.frombuffer(b"".join(blocks[BLOCK_SCAN]), dtype="<f8"), meta) for blocks, meta in sessions]
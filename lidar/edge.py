@@ -0,0 +1,131 @@
+"""
+Preprocessing on the scanner, so only useful points are sent to the server.
+"""
+from typing import Tuple
+import numpy as np
+
+
+class EdgeFilter:
+    """
+    Vectorized filter for batches of readings, applied before they're turned into points.
+
+    In order, it:
+    - Drops readings weaker than min_strength (overflowing strengths count as the strongest possible).
+    - Drops readings outside of min_range to max_range meters, which includes dropouts (range -1).
+    - If median_window is set (an odd number of readings), replaces each range with the median of the ones around it
+      along the same sweep. Consecutive readings more than line_gap degrees apart are taken to be on different sweeps.
+      The last median_window // 2 readings of each batch are held back until the next batch (or the final one of the
+      scan), so every reading gets its whole window no matter where the batches split.
+    - If angular_resolution is set, keeps only the first reading in each bin of angular_resolution degrees in both
+      directions and range_resolution meters in range, for the whole scan. This gets rid of the many repeated readings
+      taken while the servos are moving slower than the sensor samples.
+
+    Call reset() between scans. stats counts how many readings were dropped by each step since the last reset.
+    """
+
+    def __init__(self, min_strength: int = 100, min_range: float = 0.1, max_range: float = 12,
+                 median_window: int = 0, line_gap: float = 1, angular_resolution: float = 0,
+                 range_resolution: float = 0.02) -> None:
+        if median_window and median_window % 2 == 0:
+            raise ValueError(f"median_window must be odd, got {median_window}")
+        self.min_strength = min_strength
+        self.min_range = min_range
+        self.max_range = max_range
+        self.median_window = median_window
+        self.line_gap = line_gap
+        self.angular_resolution = angular_resolution
+        self.range_resolution = range_resolution
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start a new scan.
+        """
+        self.stats = {"input": 0, "strength": 0, "range": 0, "duplicate": 0, "output": 0}
+        # Sorted keys of every bin seen so far this scan
+        self._seen = np.empty(0, dtype=np.int64)
+        # The ranges and angles of the last few readings passed on, so the median doesn't restart at every batch
+        self._context = (np.empty(0), np.empty(0), np.empty(0))
+        # Readings, and their angles, held back until the readings after them come in
+        self._held = None
+
+    def filter(self, readings: np.ndarray, h: np.ndarray, v: np.ndarray,
+               final: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Filter a batch of readings (ringbuf.READING_DTYPE, or anything with r and strength fields) in time order, with
+        their horizontal and vertical angles in degrees. Pass final=True for the last batch of a scan, so no readings
+        are held back.
+
+        Returns a tuple of (readings, h, v, ranges) for the readings to pass on, where ranges are after smoothing.
+        These can include readings held back from earlier batches.
+        """
+        r = readings["r"]
+        strength = readings["strength"]
+        self.stats["input"] += len(r)
+        keep = np.flatnonzero(np.where(strength < 0, 0xFFFF, strength) >= self.min_strength)
+        self.stats["strength"] += len(r) - len(keep)
+        in_range = (r[keep] >= self.min_range) & (r[keep] <= self.max_range)
+        self.stats["range"] += len(keep) - np.count_nonzero(in_range)
+        keep = keep[in_range]
+        readings, h, v = readings[keep], h[keep], v[keep]
+        ranges = readings["r"]
+        if self.median_window > 1:
+            readings, h, v, ranges = self._smooth(readings, h, v, final)
+        if self.angular_resolution > 0:
+            first = self._dedupe(ranges, h, v)
+            self.stats["duplicate"] += len(readings) - len(first)
+            readings, h, v, ranges = readings[first], h[first], v[first], ranges[first]
+        self.stats["output"] += len(readings)
+        return readings, h, v, ranges
+
+    def _smooth(self, readings: np.ndarray, h: np.ndarray, v: np.ndarray,
+                final: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Median filter the ranges along each sweep. Returns the readings that are done, along with their angles and
+        smoothed ranges, and holds back the rest.
+        """
+        half = self.median_window // 2
+        if self._held is not None:
+            held_readings, held_h, held_v = self._held
+            readings = np.concatenate((held_readings, readings))
+            h = np.concatenate((held_h, h))
+            v = np.concatenate((held_v, v))
+        prev_r, prev_h, prev_v = self._context
+        all_r = np.concatenate((prev_r, readings["r"]))
+        all_h = np.concatenate((prev_h, h))
+        all_v = np.concatenate((prev_v, v))
+        # Readings whose windows aren't complete yet wait for the next batch
+        done = len(readings) if final else max(len(readings) - half, 0)
+        self._held = (readings[done:], h[done:], v[done:])
+        offset = len(prev_r)
+        end = offset + done
+        self._context = (all_r[:end][-half:], all_h[:end][-half:], all_v[:end][-half:])
+        readings, h, v = readings[:done], h[:done], v[:done]
+        if not done:
+            return readings, h, v, readings["r"]
+        # Number each sweep, starting a new one wherever the angle jumps
+        jumps = np.maximum(np.abs(np.diff(all_h)), np.abs(np.diff(all_v))) > self.line_gap
+        line = np.concatenate(([0], np.cumsum(jumps)))
+        # Window of indices around each reading; anything past the ends of the scan or on another sweep is left out of
+        # the median
+        idx = np.arange(offset, end)[:, None] + np.arange(-half, half + 1)
+        inside = (idx >= 0) & (idx < len(all_r))
+        idx = np.clip(idx, 0, len(all_r) - 1)
+        windows = np.where(inside & (line[idx] == line[offset:end, None]), all_r[idx], np.nan)
+        return readings, h, v, np.nanmedian(windows, axis=1)
+
+    def _dedupe(self, r: np.ndarray, h: np.ndarray, v: np.ndarray) -> np.ndarray:
+        """
+        Find the readings in bins that haven't been seen before. Returns their indices.
+        """
+        # 21 bits per axis is plenty for any sensible resolution
+        mask = (1 << 21) - 1
+        hb = np.floor(h / self.angular_resolution).astype(np.int64) & mask
+        vb = np.floor(v / self.angular_resolution).astype(np.int64) & mask
+        rb = np.floor(r / self.range_resolution).astype(np.int64) & mask
+        keys = (hb << 42) | (vb << 21) | rb
+        # First reading in each bin within this batch, then only the bins from earlier batches that are new
+        keys, first = np.unique(keys, return_index=True)
+        new = ~np.isin(keys, self._seen, assume_unique=True)
+        self._seen = np.union1d(self._seen, keys[new])
+        return np.sort(first[new])
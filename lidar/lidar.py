@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Union
 import tfmini_s
 import gpiozero
 import time
@@ -7,6 +7,29 @@ import threading
 import sys
 import tqdm
 import contextlib
+import numpy as np
+from ringbuf import RingBuffer, READING_DTYPE, SERVO_DTYPE
+from projection import interpolate_angles, to_cartesian
+from capture import CaptureWriter
+from edge import EdgeFilter
+import planner
+
+
+# Offset from the servo arm length
+ARM_LENGTH = 0.05
+
+BatchCallback = Callable[[np.ndarray], None]
+PointCallback = Callable[[float, float, float, int, float], None]
+
+
+def per_point(callback: PointCallback) -> BatchCallback:
+    """
+    Wrap a callback taking a single point (x, y, z, strength, temp) so it can be used as a batch callback.
+    """
+    def batch_callback(points: np.ndarray) -> None:
+        for x, y, z, strength, temp in points.tolist():
+            callback(x, y, z, int(strength), temp)
+    return batch_callback
 
 
 # Set pin factory to pigpio according to the docs to reduce jitter
@@ -15,30 +38,75 @@ import contextlib
 
 class Lidar:
 
+    # How long the consumer waits between draining the buffers
+    DRAIN_INTERVAL = 0.01
+    # How long the sensor daemon waits when there's no new data
+    POLL_INTERVAL = 0.001
+
     # Note the callback will be called from a separate thread!
+    # The callback is called from its own consumer thread, so a slow callback won't slow down sampling, as long as it
+    # can keep up on average. buffer_size is how many readings can be waiting for the consumer before they're dropped.
+    # If batch_size is 0, the callback gets called once per point with (x, y, z, strength, temp). Otherwise, it's
+    # called with an (N, 5) array of the same, once batch_size points are ready or batch_timeout seconds have passed.
+    # To run without the hardware, pass in a sensor and servos (e.g. from sim.py); the device and port arguments for
+    # anything passed in are ignored.
+    # If capture_path is given, the raw readings and servo commands are also appended to that file (see capture.py),
+    # so the scans can be reprocessed later. Call close() when done to make sure it's all written.
+    # If edge_filter is given, readings are passed through it before being turned into points (see edge.py), and
+    # only the ones it keeps are passed to the callback. Captures always have every reading.
     def __init__(self, sensor_device: str, sensor_baudrate: int, sensor_precision: float, horiz_servo_port: int,
-                 vert_servo_port: int, vert_offset: float, data_callback: Callable[[float, float, float, int, float], None]) -> None:
-        self.sensor = tfmini_s.Sensor(sensor_device, sensor_baudrate, sensor_precision)
+                 vert_servo_port: int, vert_offset: float, data_callback: Union[PointCallback, BatchCallback],
+                 buffer_size: int = 65536, sample_rate: float = 1000, batch_size: int = 0,
+                 batch_timeout: float = 0.05, sensor: tfmini_s.Sensor = None, h_servo=None, v_servo=None,
+                 capture_path: str = None, edge_filter: EdgeFilter = None) -> None:
+        self.sensor = sensor or tfmini_s.Sensor(sensor_device, sensor_baudrate, sensor_precision)
         # Pulse width range 500us to 2500us
         # Frame width of 3ms inferred from operating frequency range (50Hz-330Hz)
-        self.h_servo = gpiozero.AngularServo(horiz_servo_port, initial_angle=0, min_angle=-135, max_angle=135,
+        self.h_servo = h_servo or gpiozero.AngularServo(horiz_servo_port, initial_angle=0, min_angle=-135, max_angle=135,
             min_pulse_width=500e-6, max_pulse_width=2500e-6, frame_width=4e-3)
-        self.v_servo = gpiozero.AngularServo(vert_servo_port, initial_angle=0, min_angle=0 - vert_offset, max_angle=270 - vert_offset,
+        self.v_servo = v_servo or gpiozero.AngularServo(vert_servo_port, initial_angle=0, min_angle=0 - vert_offset, max_angle=270 - vert_offset,
             min_pulse_width=500e-6, max_pulse_width=2500e-6, frame_width=4e-3)
-        self.callback = data_callback
-        # Used by the daemon
+        self.callback = data_callback if batch_size else per_point(data_callback)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.sample_period = 1 / sample_rate
+        # Readings are timestamped and buffered by the sensor daemon, and servo commands are logged with timestamps
+        # by the scan; the consumer matches them up afterwards
+        self.readings = RingBuffer(buffer_size, READING_DTYPE)
+        self.servo_log = RingBuffer(16384, SERVO_DTYPE)
+        self.edge_filter = edge_filter
+        self.capture = None
+        if capture_path is not None:
+            self.capture = CaptureWriter(capture_path, {
+                "precision": sensor_precision,
+                "arm_length": ARM_LENGTH,
+                "vert_offset": vert_offset,
+                "sample_rate": sample_rate,
+            })
+        self._daemons = []
         self.h_angle = 0
         self.v_angle = 0
         self.scanning = False
+        self.consuming = False
         self.scan_up = False
+        # Readings taken while this is False are thrown away, e.g. while moving between sweeps
+        self.recording = True
+        # If set, called from the consumer thread with the (h_angle, v_angle, r) of every recorded reading
+        self._reading_hook = None
+
+    def close(self) -> None:
+        """
+        Finish writing the capture, if there is one.
+        """
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def reset(self) -> None:
         """
         Reset servo angles.
         """
-        self.h_servo.angle = 0
-        self.v_servo.angle = 0
-        self.h_angle = self.v_angle = 0
+        self.move_to_angle(0, 0)
 
     def move_to_angle(self, h_angle: float, v_angle: float) -> None:
         """
@@ -48,36 +116,148 @@ class Lidar:
         self.v_servo.angle = v_angle
         self.h_angle = h_angle
         self.v_angle = v_angle
+        self._log_servos()
+
+    def _log_servos(self) -> None:
+        """
+        Record the current servo command, so readings can be matched with angles later.
+
+        Only call this from the thread running the scan.
+        """
+        self.servo_log.push_one(time.monotonic(), self.h_angle, self.v_angle, self.recording and not self.scan_up)
+
+    def _start_daemons(self) -> None:
+        """
+        Start the sensor and consumer daemons.
+        """
+        self.scanning = self.consuming = True
+        self.readings.drain()
+        self.servo_log.drain()
+        if self.capture is not None:
+            self.capture.start_scan()
+        if self.edge_filter is not None:
+            self.edge_filter.reset()
+        self._log_servos()
+        self._daemons = [threading.Thread(target=self._sensor_daemon, daemon=True),
+                         threading.Thread(target=self._consumer_daemon, daemon=True)]
+        for th in self._daemons:
+            th.start()
+
+    def _stop_daemons(self) -> None:
+        """
+        Stop the daemons, waiting until all buffered readings have been passed to the callback.
+        """
+        self.scanning = False
+        self._daemons[0].join()
+        # Only stop the consumer once the sensor daemon is done pushing readings
+        self.consuming = False
+        self._daemons[1].join()
+        if self.capture is not None:
+            self.capture.flush()
+        if self.edge_filter is not None:
+            stats = self.edge_filter.stats
+            print(f"[LiDAR] Edge filter kept {stats['output']}/{stats['input']} readings (dropped {stats['strength']} "
+                  f"weak, {stats['range']} out of range, {stats['duplicate']} duplicates)")
+        if self.readings.dropped:
+            print(f"[LiDAR] Warning: {self.readings.dropped} readings dropped because the consumer was too slow",
+                  file=sys.stderr)
     
     def _sensor_daemon(self):
         """
         Daemon thread for reading sensor data so the servos don't slow down.
 
-        Relies on the GIL so that setting values are atomic operations.
+        Readings are timestamped and pushed into the readings ring buffer; nothing else is done here so the sampling
+        rate doesn't depend on what's done with the data.
         """
         self.sensor.clear_buf()
+        t_prev = time.monotonic()
+        bad_reads = 0
         while self.scanning:
-            # If more than 2 readings are in the buffer, discard them so we get the latest values
-            clear_buf = self.sensor.readings_avail() > 2
-            # TODO: Add error handling for r being -1, once stuff on the sensor end is figured out
-            for _ in range(5):
-                try:
-                    r, strength, temp = self.sensor.read(clear_buf)
-                    break
-                except tfmini_s.ChecksumError:
-                    pass
-            else:
-                print("[LiDAR] Error: Repeated checksum errors!", file=sys.stderr)
-                raise RuntimeError("Repeated checksum errors when communicating with ranging sensor!")
-            if r == -1:
-                print(f"[LiDAR] Warning: Could not read distance (strength={strength}, temp={temp})", file=sys.stderr)
-            r += 0.05 # Offset from the servo arm length
-            if self.scan_up:
+            readings = self.sensor.read_available()
+            t = time.monotonic()
+            n = len(readings.dist)
+            if readings.checksum_errors:
+                print(f"[LiDAR] Warning: {readings.checksum_errors} checksum errors", file=sys.stderr)
+                bad_reads = bad_reads + 1 if not n else 0
+                if bad_reads >= 5:
+                    print("[LiDAR] Error: Repeated checksum errors!", file=sys.stderr)
+                    raise RuntimeError("Repeated checksum errors when communicating with ranging sensor!")
+            if not n:
+                time.sleep(self.POLL_INTERVAL)
                 continue
-            theta = math.radians(self.h_angle)
-            phi = math.radians(self.v_angle)
-            self.callback(r * math.cos(phi) * math.cos(theta), r * math.cos(phi) * math.sin(theta), r * math.sin(phi),
-                strength, temp)
+            # All the readings came in since the last read, so spread them out evenly over that time
+            t_start = max(t_prev, t - n * self.sample_period)
+            records = np.empty(n, dtype=READING_DTYPE)
+            records["t"] = np.linspace(t_start, t, n + 1)[1:]
+            records["r"] = readings.dist
+            records["strength"] = readings.strength
+            records["temp"] = readings.temp
+            self.readings.push(records)
+            t_prev = t
+
+    def _consumer_daemon(self):
+        """
+        Daemon thread that drains readings in batches, matches them up with servo angles, and calls the callback.
+        """
+        servo_hist = np.empty(0, dtype=SERVO_DTYPE)
+        pending = np.empty(0, dtype=READING_DTYPE)
+        cutoff = 0
+        # Points waiting to be passed to the callback
+        batches = []
+        batch_count = 0
+        batch_start = 0
+        while True:
+            # Check this first so everything that's left gets processed once the scan is done
+            done = not self.consuming
+            # Only process readings up to now, so that every servo command that came before them is known
+            now = time.monotonic()
+            new_servos = self.servo_log.drain()
+            new_readings = self.readings.drain()
+            if self.capture is not None:
+                # This only queues them up, so it doesn't slow anything down
+                self.capture.write_servos(new_servos)
+                self.capture.write_readings(new_readings)
+            servo_hist = np.concatenate((servo_hist, new_servos))
+            readings = np.concatenate((pending, new_readings))
+            ready = readings["t"] <= now
+            pending = readings[~ready]
+            readings = readings[ready]
+            # Timestamps only go up, so commands from before the last command preceding the oldest reading that
+            # hasn't been processed yet won't be needed again
+            if len(pending) or len(readings):
+                cutoff = pending["t"][0] if len(pending) else readings["t"][-1]
+
+            h_angles, v_angles, record = interpolate_angles(readings["t"], servo_hist)
+            readings = readings[record]
+            h_angles = h_angles[record]
+            v_angles = v_angles[record]
+            if self._reading_hook is not None:
+                self._reading_hook(h_angles, v_angles, readings["r"])
+            dropouts = np.count_nonzero(readings["r"] == -1)
+            if dropouts and self.edge_filter is None:
+                print(f"[LiDAR] Warning: Could not read distance for {dropouts} points", file=sys.stderr)
+            ranges = readings["r"]
+            if self.edge_filter is not None:
+                # The filter can hold back the last few readings until the next batch, so tell it about the last one
+                readings, h_angles, v_angles, ranges = self.edge_filter.filter(readings, h_angles, v_angles,
+                                                                               final=done)
+            if len(readings):
+                batch = np.empty((len(readings), 5))
+                batch[:, :3] = to_cartesian(ranges, h_angles, v_angles, ARM_LENGTH)
+                batch[:, 3] = readings["strength"]
+                batch[:, 4] = readings["temp"]
+                if not batches:
+                    batch_start = now
+                batches.append(batch)
+                batch_count += len(batch)
+            if batches and (done or batch_count >= self.batch_size or now - batch_start >= self.batch_timeout):
+                self.callback(np.concatenate(batches))
+                batches = []
+                batch_count = 0
+            servo_hist = servo_hist[max(np.searchsorted(servo_hist["t"], cutoff, side="right") - 1, 0):]
+            if done:
+                break
+            time.sleep(self.DRAIN_INTERVAL)
 
     def scan_h(self, start_angle_h: float, stop_angle_h: float, start_angle_v: float, stop_angle_v: float,
                h_step: float, v_step: float, step_time: float, print_progress: bool = False) -> None:
@@ -95,12 +275,8 @@ class Lidar:
         self.move_to_angle(start_angle_h, start_angle_v)
         time.sleep(1)
 
-        self.scanning = True
-        # Start the daemon
-        th = threading.Thread(target=self._sensor_daemon)
-        th.setDaemon(True)
-        th.start()
         self.scan_up = h_step > 0
+        self._start_daemons()
 
         num_steps = (stop_angle_v - start_angle_v) / v_step
         with tqdm.tqdm(total=math.ceil(num_steps)) if print_progress else contextlib.nullcontext() as pbar:
@@ -109,17 +285,19 @@ class Lidar:
                 while (h_step > 0 and self.h_servo.angle < stop_angle_h) or (h_step < 0 and self.h_servo.angle > start_angle_h):
                     self.h_angle += h_step
                     self.h_servo.angle = self.h_angle
+                    self._log_servos()
 
                 # Change stepping direction and move slow axis
                 h_step = -h_step
                 self.scan_up = h_step > 0
                 self.v_angle += v_step
                 self.v_servo.angle = self.v_angle
+                self._log_servos()
                 if print_progress:
                     pbar.update()
                 time.sleep(step_time)
 
-        self.scanning = False
+        self._stop_daemons()
     
     def scan_v(self, start_angle_h: float, stop_angle_h: float, start_angle_v: float, stop_angle_v: float,
                h_step: float, v_step: float, step_time: float, print_progress: bool = False) -> None:
@@ -129,11 +307,8 @@ class Lidar:
         self.move_to_angle(start_angle_h, start_angle_v)
         time.sleep(1)
 
-        self.scanning = True
-        th = threading.Thread(target=self._sensor_daemon)
-        th.setDaemon(True)
-        th.start()
         self.scan_up = v_step > 0
+        self._start_daemons()
 
         num_steps = (stop_angle_h - start_angle_h) / h_step
         with tqdm.tqdm(total=math.ceil(num_steps)) if print_progress else contextlib.nullcontext() as pbar:
@@ -142,14 +317,92 @@ class Lidar:
                 while (v_step > 0 and self.v_servo.angle < stop_angle_v) or (v_step < 0 and self.v_servo.angle > start_angle_v):
                     self.v_angle += v_step
                     self.v_servo.angle = self.v_angle
+                    self._log_servos()
 
                 # Change stepping direction and move slow axis
                 v_step = -v_step
                 self.scan_up = v_step > 0
                 self.h_angle += h_step
                 self.h_servo.angle = self.h_angle
+                self._log_servos()
                 if print_progress:
                     pbar.update()
                 time.sleep(step_time)
 
-        self.scanning = False
+        self._stop_daemons()
+
+    def scan_adaptive(self, start_angle_h: float, stop_angle_h: float, start_angle_v: float, stop_angle_v: float,
+                      coarse_step: float, fine_step: float, step_time: float, max_range: float = 10,
+                      gradient: float = 0.3, fast_axis: str = "v", print_progress: bool = False) -> None:
+        """
+        Scan the angle range specified, only using fine steps where there's something to see.
+
+        A coarse pass over the whole range is done first with coarse_step degrees between sweeps and points. The
+        coarse results are then used to plan fine passes with fine_step degrees between sweeps and points, covering
+        only the areas with returns within max_range meters, or where the range changes by more than gradient meters
+        between coarse cells (e.g. the edges of a trunk). See planner.py.
+
+        step_time is the time per step along each sweep, and fast_axis ("h" or "v") is the axis to sweep along. Points
+        from both passes are passed to the callback.
+        """
+        h_range = (start_angle_h, stop_angle_h)
+        v_range = (start_angle_v, stop_angle_v)
+        slow_range, fast_range = (h_range, v_range) if fast_axis == "v" else (v_range, h_range)
+
+        coarse = planner.CoarseMap(slow_range, fast_range, coarse_step)
+        if fast_axis == "v":
+            self._reading_hook = coarse.add
+        else:
+            self._reading_hook = lambda h, v, r: coarse.add(v, h, r)
+        sweeps = planner.raster(slow_range, fast_range, coarse_step)
+        self._run_sweeps(sweeps, coarse_step, step_time, fast_axis, print_progress)
+        self._reading_hook = None
+
+        mask = coarse.interesting(max_range, gradient)
+        slow, fast = (self.h_angle, self.v_angle) if fast_axis == "v" else (self.v_angle, self.h_angle)
+        sweeps = planner.plan_fine(coarse, mask, fine_step, fast_position=fast)
+        if print_progress:
+            # Moving between sweeps takes about as long as stepping the same distance along one
+            duration = sum(planner.travel(sweeps, slow, fast)) / fine_step * step_time
+            print(f"[LiDAR] Fine scanning {np.count_nonzero(mask)}/{mask.size} coarse cells in {len(sweeps)} sweeps, "
+                  f"about {duration:.0f}s")
+        self._run_sweeps(sweeps, fine_step, step_time, fast_axis, print_progress)
+
+    def _run_sweeps(self, sweeps: list, step: float, step_time: float, fast_axis: str,
+                    print_progress: bool = False) -> None:
+        """
+        Do a list of planner.Sweep, stepping step degrees every step_time seconds along each one. Readings are only
+        recorded during the sweeps, not while moving between them.
+        """
+        if not sweeps:
+            return
+        self.scan_up = False
+        self.recording = False
+        self._start_daemons()
+        with tqdm.tqdm(total=len(sweeps)) if print_progress else contextlib.nullcontext() as pbar:
+            for sweep in sweeps:
+                # Move to the start of the sweep, giving the servos as long as they'd take to step there
+                self.recording = False
+                prev = (self.h_angle, self.v_angle)
+                self._set_axes(sweep.slow, sweep.start, fast_axis)
+                distance = max(abs(self.h_angle - prev[0]), abs(self.v_angle - prev[1]))
+                time.sleep(step_time * max(distance / step, 1))
+                self.recording = True
+                self._log_servos()
+                for fast in planner.angle_steps(sweep.start, sweep.stop, step)[1:]:
+                    self._set_axes(sweep.slow, fast, fast_axis)
+                    time.sleep(step_time)
+                # Stop recording at the end of the sweep, before moving on, so readings taken on the way to the next
+                # one aren't placed along the line between them
+                self.recording = False
+                self._log_servos()
+                if print_progress:
+                    pbar.update()
+        self.recording = True
+        self._stop_daemons()
+
+    def _set_axes(self, slow: float, fast: float, fast_axis: str) -> None:
+        if fast_axis == "v":
+            self.move_to_angle(slow, fast)
+        else:
+            self.move_to_angle(fast, slow)
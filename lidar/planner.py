@@ -0,0 +1,137 @@
+"""
+Planning for adaptive scans: a quick coarse pass over the whole window, then fine passes only where there's
+something worth scanning (near returns and sharp changes in range, like the edges of a trunk).
+
+Scans are planned as a list of sweeps along the fast axis, each at a fixed angle on the slow axis.
+"""
+from typing import List, NamedTuple, Tuple
+import numpy as np
+
+
+class Sweep(NamedTuple):
+    """
+    Move the fast axis from start to stop (either way round) with the slow axis at slow.
+    """
+    slow: float
+    start: float
+    stop: float
+
+
+def angle_steps(start: float, stop: float, step: float) -> np.ndarray:
+    """
+    Evenly spaced angles from start to stop inclusive, no more than step apart.
+    """
+    return np.linspace(start, stop, max(int(np.ceil(abs(stop - start) / step - 1e-9)), 0) + 1)
+
+
+def raster(slow_range: Tuple[float, float], fast_range: Tuple[float, float], slow_step: float) -> List[Sweep]:
+    """
+    Plan a serpentine raster over the whole window, going back and forth along the fast axis.
+    """
+    sweeps = []
+    for i, slow in enumerate(angle_steps(*slow_range, slow_step)):
+        start, stop = fast_range if i % 2 == 0 else fast_range[::-1]
+        sweeps.append(Sweep(slow, start, stop))
+    return sweeps
+
+
+def travel(sweeps: List[Sweep], slow: float = None, fast: float = None) -> Tuple[float, float]:
+    """
+    Total servo movement in degrees (slow axis, fast axis) to do the sweeps in order, starting from (slow, fast) or
+    the start of the first sweep.
+    """
+    slow_travel = fast_travel = 0
+    for sweep in sweeps:
+        if slow is not None:
+            slow_travel += abs(sweep.slow - slow)
+            fast_travel += abs(sweep.start - fast)
+        fast_travel += abs(sweep.stop - sweep.start)
+        slow, fast = sweep.slow, sweep.stop
+    return slow_travel, fast_travel
+
+
+class CoarseMap:
+    """
+    Grid of the closest valid range seen in each cell of the scan window, filled in from the coarse pass.
+
+    Cells are step degrees across; the first index is the slow axis and the second is the fast axis.
+    """
+
+    def __init__(self, slow_range: Tuple[float, float], fast_range: Tuple[float, float], step: float) -> None:
+        self.slow_range = slow_range
+        self.fast_range = fast_range
+        self.step = step
+        self.shape = (max(int(np.ceil((slow_range[1] - slow_range[0]) / step)), 1),
+                      max(int(np.ceil((fast_range[1] - fast_range[0]) / step)), 1))
+        self.ranges = np.full(self.shape, np.inf)
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+
+    def cell(self, slow: np.ndarray, fast: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        i = np.clip(((slow - self.slow_range[0]) // self.step).astype(np.intp), 0, self.shape[0] - 1)
+        j = np.clip(((fast - self.fast_range[0]) // self.step).astype(np.intp), 0, self.shape[1] - 1)
+        return i, j
+
+    def add(self, slow: np.ndarray, fast: np.ndarray, r: np.ndarray) -> None:
+        """
+        Add readings at the given angles. Ranges of -1 (no return) count as readings, but not as valid ranges.
+        """
+        i, j = self.cell(slow, fast)
+        np.add.at(self.counts, (i, j), 1)
+        valid = r >= 0
+        np.minimum.at(self.ranges, (i[valid], j[valid]), r[valid])
+
+    def interesting(self, max_range: float, gradient: float) -> np.ndarray:
+        """
+        Find the cells worth a fine pass: the ones with a valid return within max_range, or where the range changes
+        by more than gradient meters from a neighbouring cell, plus the cells around those so that edges aren't cut
+        off. Cells with no readings at all are included too, since nothing is known about them.
+
+        Returns a boolean mask the shape of the grid.
+        """
+        near = self.ranges <= max_range
+        # Compare each cell with its neighbours; a valid return next to no return counts as an edge only if it's near
+        padded = np.pad(self.ranges, 1, constant_values=np.inf)
+        edges = np.zeros(self.shape, dtype=bool)
+        for di, dj in ((0, 1), (2, 1), (1, 0), (1, 2)):
+            other = padded[di:di + self.shape[0], dj:dj + self.shape[1]]
+            finite = np.isfinite(self.ranges) & np.isfinite(other)
+            with np.errstate(invalid="ignore"):
+                edges |= finite & (np.abs(self.ranges - other) > gradient)
+        mask = near | edges
+        padded = np.pad(mask, 1)
+        dilated = np.zeros(self.shape, dtype=bool)
+        for di in range(3):
+            for dj in range(3):
+                dilated |= padded[di:di + self.shape[0], dj:dj + self.shape[1]]
+        return dilated | (self.counts == 0)
+
+
+def plan_fine(coarse: CoarseMap, mask: np.ndarray, fine_step: float, max_gap: int = 1,
+              fast_position: float = None) -> List[Sweep]:
+    """
+    Plan fine sweeps covering the cells selected in mask, fine_step degrees apart on the slow axis.
+
+    Gaps of up to max_gap unselected cells along a sweep are swept through instead of starting a new sweep, since
+    stopping and starting costs more than a short sweep. Each sweep goes whichever way starts closest to where the
+    previous one ended, so the fast axis doesn't have to travel back.
+    """
+    sweeps = []
+    fast = coarse.fast_range[0] if fast_position is None else fast_position
+    for slow in angle_steps(*coarse.slow_range, fine_step):
+        i, _ = coarse.cell(np.array([slow]), np.array([coarse.fast_range[0]]))
+        row = mask[i[0]]
+        cells = np.flatnonzero(row)
+        if not len(cells):
+            continue
+        # Split into runs wherever the gap between selected cells is too big
+        breaks = np.flatnonzero(np.diff(cells) > max_gap + 1)
+        runs = [(cells[a], cells[b]) for a, b in zip(np.append(0, breaks + 1), np.append(breaks, len(cells) - 1))]
+        intervals = [(max(coarse.fast_range[0] + a * coarse.step, coarse.fast_range[0]),
+                      min(coarse.fast_range[0] + (b + 1) * coarse.step, coarse.fast_range[1])) for a, b in runs]
+        # Go through the runs in whichever direction starts closer
+        if abs(intervals[-1][1] - fast) < abs(intervals[0][0] - fast):
+            intervals = [(stop, start) for start, stop in reversed(intervals)]
+        for start, stop in intervals:
+            sweeps.append(Sweep(slow, start, stop))
+        fast = sweeps[-1].stop
+    return sweeps
@@ -0,0 +1,36 @@
+from typing import Tuple
+import numpy as np
+
+
+def interpolate_angles(t: np.ndarray, servo_log: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the servo angles at the time of each reading.
+
+    t is an array of reading timestamps, and servo_log is an array of servo commands (ringbuf.SERVO_DTYPE) sorted by
+    time. Angles are linearly interpolated between the commands on either side of each reading, and held at the first
+    or last command outside of that.
+
+    Returns a tuple of (h_angle, v_angle, record) arrays, where record is taken from the last command before each
+    reading.
+    """
+    if len(servo_log) == 0:
+        return np.zeros(len(t)), np.zeros(len(t)), np.ones(len(t), dtype=bool)
+    h = np.interp(t, servo_log["t"], servo_log["h"])
+    v = np.interp(t, servo_log["t"], servo_log["v"])
+    i = np.maximum(np.searchsorted(servo_log["t"], t, side="right") - 1, 0)
+    return h, v, servo_log["record"][i]
+
+
+def to_cartesian(r: np.ndarray, h_angle: np.ndarray, v_angle: np.ndarray, arm_length: float = 0.05) -> np.ndarray:
+    """
+    Convert ranges (in meters) and servo angles (in degrees) to points.
+
+    arm_length is added to each range to account for the offset from the servo arm.
+
+    Returns an (N, 3) array of xyz.
+    """
+    r = r + arm_length
+    theta = np.radians(h_angle)
+    phi = np.radians(v_angle)
+    xy = r * np.cos(phi)
+    return np.column_stack((xy * np.cos(theta), xy * np.sin(theta), r * np.sin(phi)))
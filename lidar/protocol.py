@@ -0,0 +1,205 @@
+"""
+Wire protocol for streaming points from the LiDAR to the processing server.
+
+The client starts by sending a hello (magic + highest version it supports), and the server replies with a hello
+containing the version that will be used. After that, the client sends frames, each made of a header followed by a
+packed payload of count points. Clients that don't send the hello are treated as legacy clients, which just send 3
+raw doubles (x, y, z) per point with no framing.
+"""
+from typing import List, Tuple
+import socket
+import struct
+import time
+import numpy as np
+
+
+MAGIC = b"TDAR"
+VERSION = 1
+# Magic, version
+HELLO = struct.Struct("<4sB")
+# Sync bytes, version, encoding, scan ID, sequence number, point count
+FRAME_SYNC = b"TF"
+FRAME_HEADER = struct.Struct("<2sBBIIH")
+MAX_FRAME_POINTS = 0xFFFF
+
+# xyz as float32 meters
+ENC_FLOAT32 = 0
+# xyz as int16 millimeters, which limits the range to +-32.767m
+ENC_INT16_MM = 1
+PAYLOAD_DTYPES = {
+    ENC_FLOAT32: np.dtype([("xyz", "<f4", 3), ("strength", "<u2")]),
+    ENC_INT16_MM: np.dtype([("xyz", "<i2", 3), ("strength", "<u2")]),
+}
+# The legacy protocol sends 3 doubles per point
+LEGACY_DTYPE = np.dtype("<f8")
+LEGACY_POINT_SIZE = 3 * LEGACY_DTYPE.itemsize
+
+
+class ProtocolError(Exception):
+    """
+    Indicates that the other end sent something that doesn't follow the protocol.
+    """
+
+
+class FrameHeader:
+    """
+    Header of a single frame.
+    """
+
+    def __init__(self, version: int, encoding: int, scan_id: int, seq: int, count: int) -> None:
+        self.version = version
+        self.encoding = encoding
+        self.scan_id = scan_id
+        self.seq = seq
+        self.count = count
+
+    @property
+    def payload_size(self) -> int:
+        return self.count * PAYLOAD_DTYPES[self.encoding].itemsize
+
+    def pack(self) -> bytes:
+        return FRAME_HEADER.pack(FRAME_SYNC, self.version, self.encoding, self.scan_id, self.seq, self.count)
+
+    @classmethod
+    def unpack(cls, data) -> "FrameHeader":
+        sync, version, encoding, scan_id, seq, count = FRAME_HEADER.unpack(data)
+        if sync != FRAME_SYNC:
+            raise ProtocolError(f"Bad frame sync bytes {sync}")
+        if encoding not in PAYLOAD_DTYPES:
+            raise ProtocolError(f"Unknown encoding {encoding}")
+        return cls(version, encoding, scan_id, seq, count)
+
+
+def encode_points(points: np.ndarray, encoding: int) -> bytes:
+    """
+    Pack an (N, 4+) array of x, y, z, strength into a frame payload.
+    """
+    payload = np.empty(len(points), dtype=PAYLOAD_DTYPES[encoding])
+    if encoding == ENC_INT16_MM:
+        payload["xyz"] = np.clip(np.round(points[:, :3] * 1000), -0x7FFF, 0x7FFF)
+    else:
+        payload["xyz"] = points[:, :3]
+    # Strength is -1 on overflow, so saturate it
+    strength = points[:, 3]
+    payload["strength"] = np.where(strength < 0, 0xFFFF, np.clip(strength, 0, 0xFFFF))
+    return payload.tobytes()
+
+
+def decode_points(payload, encoding: int) -> np.ndarray:
+    """
+    Unpack a frame payload into an (N, 4) array of x, y, z, strength (as float64).
+    """
+    records = np.frombuffer(payload, dtype=PAYLOAD_DTYPES[encoding])
+    points = np.empty((len(records), 4))
+    points[:, :3] = records["xyz"]
+    if encoding == ENC_INT16_MM:
+        points[:, :3] /= 1000
+    points[:, 3] = records["strength"]
+    return points
+
+
+class FrameSender:
+    """
+    Batches points and sends them over a socket using the framed protocol.
+
+    Points are sent once max_points have been buffered, or when points have been waiting for longer than max_latency
+    seconds (checked whenever more points are added). Call flush() to send everything immediately, e.g. at the end of
+    a scan.
+    """
+
+    def __init__(self, sock: socket.socket, encoding: int = ENC_INT16_MM, max_points: int = 256,
+                 max_latency: float = 0.05) -> None:
+        self.sock = sock
+        self.encoding = encoding
+        self.max_points = min(max_points, MAX_FRAME_POINTS)
+        self.max_latency = max_latency
+        self.version = None
+        self.scan_id = 0
+        self.seq = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self._batches = []
+        self._count = 0
+        self._batch_start = 0
+
+    def negotiate(self) -> int:
+        """
+        Send the hello to the server and wait for the version to use. Must be called before sending anything else.
+
+        Returns the negotiated version.
+        """
+        self.sock.sendall(HELLO.pack(MAGIC, VERSION))
+        data = b""
+        while len(data) < HELLO.size:
+            chunk = self.sock.recv(HELLO.size - len(data))
+            if not chunk:
+                raise ProtocolError("Connection closed during negotiation")
+            data += chunk
+        magic, version = HELLO.unpack(data)
+        if magic != MAGIC or version > VERSION:
+            raise ProtocolError(f"Bad hello from server: {data}")
+        self.version = version
+        return version
+
+    def new_scan(self) -> None:
+        """
+        Flush any buffered points and start a new scan ID.
+        """
+        self.flush()
+        self.scan_id += 1
+        self.seq = 0
+
+    def send(self, points: np.ndarray) -> None:
+        """
+        Add an (N, 4+) array of x, y, z, strength to be sent.
+        """
+        if not self._batches:
+            self._batch_start = time.monotonic()
+        self._batches.append(points)
+        self._count += len(points)
+        if self._count >= self.max_points or time.monotonic() - self._batch_start >= self.max_latency:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Send all buffered points.
+        """
+        if not self._batches:
+            return
+        points = np.concatenate(self._batches)
+        self._batches = []
+        self._count = 0
+        # Put all the frames into one buffer so it's just one syscall
+        frames = []
+        for i in range(0, len(points), self.max_points):
+            chunk = points[i:i + self.max_points]
+            frames.append(FrameHeader(self.version, self.encoding, self.scan_id, self.seq, len(chunk)).pack())
+            frames.append(encode_points(chunk, self.encoding))
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            self.frames_sent += 1
+        data = b"".join(frames)
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+
+def decode_frames(data) -> Tuple[List[Tuple[FrameHeader, np.ndarray]], int]:
+    """
+    Decode every complete frame at the start of a buffer of received data.
+
+    data can be anything supporting the buffer protocol; payloads are decoded straight out of it.
+
+    Returns a tuple of (frames, consumed), where frames is a list of (header, points) and consumed is the number of
+    bytes used up. points is an (N, 4) array of x, y, z, strength. The bytes after consumed are the start of a frame
+    that hasn't been fully received yet.
+    """
+    mem = memoryview(data)
+    frames = []
+    pos = 0
+    while len(mem) - pos >= FRAME_HEADER.size:
+        header = FrameHeader.unpack(mem[pos:pos + FRAME_HEADER.size])
+        end = pos + FRAME_HEADER.size + header.payload_size
+        if end > len(mem):
+            break
+        frames.append((header, decode_points(mem[pos + FRAME_HEADER.size:end], header.encoding)))
+        pos = end
+    return frames, pos
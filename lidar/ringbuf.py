@@ -0,0 +1,73 @@
+from typing import Optional
+import numpy as np
+
+
+# Raw sensor readings, timestamped with time.monotonic()
+READING_DTYPE = np.dtype([("t", np.float64), ("r", np.float64), ("strength", np.int32), ("temp", np.float64)])
+# Servo commands; record is False when readings taken after this command should be thrown away
+SERVO_DTYPE = np.dtype([("t", np.float64), ("h", np.float64), ("v", np.float64), ("record", np.bool_)])
+
+
+class RingBuffer:
+    """
+    Fixed size ring buffer of records backed by a preallocated numpy array.
+
+    This is safe to use without locks as long as there is only one thread pushing and one thread draining. The writer
+    only ever moves the head and the reader only ever moves the tail, and each index is only updated after the data
+    it covers has been written or copied out, so the GIL is enough to make this work.
+
+    If the buffer is full, new records are dropped instead of blocking the writer, and counted in dropped.
+    """
+
+    def __init__(self, capacity: int, dtype: np.dtype) -> None:
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # Total number of records ever pushed/drained; the array index is these modulo the capacity
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.head - self.tail
+
+    def push(self, records: np.ndarray) -> None:
+        """
+        Add an array of records to the buffer. Only call this from the writer thread.
+        """
+        free = self.capacity - (self.head - self.tail)
+        if len(records) > free:
+            self.dropped += len(records) - free
+            records = records[:free]
+        start = self.head % self.capacity
+        first = min(len(records), self.capacity - start)
+        self.data[start:start + first] = records[:first]
+        self.data[:len(records) - first] = records[first:]
+        self.head += len(records)
+
+    def push_one(self, *fields) -> None:
+        """
+        Add a single record made from the given field values. Only call this from the writer thread.
+        """
+        if self.head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        self.data[self.head % self.capacity] = fields
+        self.head += 1
+
+    def drain(self, max_count: Optional[int] = None) -> np.ndarray:
+        """
+        Remove and return (a copy of) the oldest records in the buffer, up to max_count if specified.
+
+        Only call this from the reader thread.
+        """
+        count = self.head - self.tail
+        if max_count is not None:
+            count = min(count, max_count)
+        start = self.tail % self.capacity
+        if start + count > self.capacity:
+            idx = (start + np.arange(count)) % self.capacity
+        else:
+            idx = slice(start, start + count)
+        records = self.data[idx].copy()
+        self.tail += count
+        return records
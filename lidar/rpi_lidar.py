@@ -1,6 +1,8 @@
 from lidar import Lidar
+from edge import EdgeFilter
+import numpy as np
+import protocol
 import socket
-import struct
 
 SENSOR_DEV = "/dev/serial0"
 SENSOR_BAUDRATE = 460800
@@ -14,29 +16,53 @@ SCAN_RANGE_PHI = (0, 30)
 SCAN_THETA_POINTS = 240
 SCAN_PHI_POINTS = 240
 SCAN_STEP_TIME = 0.01
+# Adaptive scanning does a coarse pass, then only scans the interesting parts finely (see Lidar.scan_adaptive)
+SCAN_ADAPTIVE = False
+SCAN_COARSE_STEP = 2
+SCAN_FINE_STEP = 0.25
+SCAN_ADAPTIVE_STEP_TIME = 0.002
+
+# Either protocol.ENC_INT16_MM (8 bytes per point, mm precision) or protocol.ENC_FLOAT32 (14 bytes per point)
+FRAME_ENCODING = protocol.ENC_INT16_MM
+# Points are sent once there are this many, or the oldest point has waited this long (in seconds)
+FRAME_POINTS = 256
+FRAME_LATENCY = 0.05
+# Points are filtered on the Pi before being sent, to save bandwidth (set EDGE_FILTER to None to send everything)
+EDGE_FILTER = EdgeFilter(min_strength=100, min_range=0.1, max_range=12, median_window=3, angular_resolution=0.1,
+                         range_resolution=0.02)
+# Raw readings are also saved here, so the scan can be reprocessed later with reproject.py (None to turn off)
+CAPTURE_PATH = "capture.tdcp"
 
 print("Initializing")
 
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    def process_datapoint(x: float, y: float, z: float, strength: int, temp: float) -> None:
-        # Just send 3 raw floats per data point for now
-        sock.sendall(struct.pack("ddd", x, y, z))
-    lidar = Lidar(SENSOR_DEV, SENSOR_BAUDRATE, SENSOR_PRECISION, HORIZ_SERVO, VERT_SERVO, VERT_OFFSET, process_datapoint)
+    sender = protocol.FrameSender(sock, FRAME_ENCODING, FRAME_POINTS, FRAME_LATENCY)
+    def process_datapoints(points: np.ndarray) -> None:
+        sender.send(points)
+    lidar = Lidar(SENSOR_DEV, SENSOR_BAUDRATE, SENSOR_PRECISION, HORIZ_SERVO, VERT_SERVO, VERT_OFFSET, process_datapoints,
+                  batch_size=FRAME_POINTS, batch_timeout=FRAME_LATENCY, capture_path=CAPTURE_PATH,
+                  edge_filter=EDGE_FILTER)
 
     host, port = input("Enter host & port for processing server: ").split(":")
     port = int(port)
     # NOTE: Setting the socket to be nonblocking after this might be needed for performance
     sock.connect((host, port))
-    print("Connected")
+    print(f"Connected, using protocol version {sender.negotiate()}")
 
     lidar.reset()
     input("Zero ok? Press enter to confirm")
 
     input("System ready. Press enter to start scan")
-    lidar.scan_v(SCAN_RANGE_THETA[0], SCAN_RANGE_THETA[1], SCAN_RANGE_PHI[0], SCAN_RANGE_PHI[1],
-                 (SCAN_RANGE_THETA[1] - SCAN_RANGE_THETA[0]) / SCAN_THETA_POINTS,
-                 (SCAN_RANGE_PHI[1] - SCAN_RANGE_PHI[0]) / SCAN_PHI_POINTS,
-                 SCAN_STEP_TIME, print_progress=True)
-    print("Scan done, zeroing")
+    if SCAN_ADAPTIVE:
+        lidar.scan_adaptive(SCAN_RANGE_THETA[0], SCAN_RANGE_THETA[1], SCAN_RANGE_PHI[0], SCAN_RANGE_PHI[1],
+                            SCAN_COARSE_STEP, SCAN_FINE_STEP, SCAN_ADAPTIVE_STEP_TIME, print_progress=True)
+    else:
+        lidar.scan_v(SCAN_RANGE_THETA[0], SCAN_RANGE_THETA[1], SCAN_RANGE_PHI[0], SCAN_RANGE_PHI[1],
+                     (SCAN_RANGE_THETA[1] - SCAN_RANGE_THETA[0]) / SCAN_THETA_POINTS,
+                     (SCAN_RANGE_PHI[1] - SCAN_RANGE_PHI[0]) / SCAN_PHI_POINTS,
+                     SCAN_STEP_TIME, print_progress=True)
+    sender.new_scan()
+    print(f"Scan done, sent {sender.bytes_sent} bytes in {sender.frames_sent} frames, zeroing")
     lidar.reset()
+    lidar.close()
     input("Zero done")
@@ -0,0 +1,278 @@
+"""
+Simulated hardware, for running and load testing the scanning pipeline without a Pi.
+
+SimulatedSerial and ReplaySerial stand in for the sensor's serial port (pass them to tfmini_s.Sensor as ser), and
+MockServo stands in for gpiozero.AngularServo. Ranges for SimulatedSerial come from a function of time, such as a
+RangeImage of a point cloud seen through the mock servos.
+"""
+from typing import Callable, Tuple
+import os
+import sys
+import threading
+import time
+import numpy as np
+from tfmini_s import FRAME_SIZE, HEADER_BYTE
+
+# Takes an array of times and returns arrays of (distance in meters, strength); distances < 0 mean no reading
+RangeFunction = Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]
+
+# Raw distance value the sensor sends when it can't measure
+NO_DIST = 0xFFFF
+# Size of the Pi's UART receive buffer; anything past this is lost if it isn't read in time
+UART_BUFFER_SIZE = 4096
+
+
+def encode_frames(dist: np.ndarray, strength: np.ndarray, temp: np.ndarray, precision: float = 1) -> np.ndarray:
+    """
+    Encode readings as sensor frames. dist is in meters (< 0 for no reading), and temp is in degrees Celsius.
+
+    Returns an (N, FRAME_SIZE) array of bytes.
+    """
+    raw_dist = np.where(dist < 0, NO_DIST, np.clip(np.round(dist * 100 / precision), 0, 0xFFFB)).astype(np.uint16)
+    raw_strength = np.clip(strength, 0, 0xFFFF).astype(np.uint16)
+    raw_temp = np.round((np.asarray(temp) + 256) * 8).astype(np.uint16)
+    frames = np.empty((len(raw_dist), FRAME_SIZE), dtype=np.uint8)
+    frames[:, :2] = HEADER_BYTE
+    frames[:, 2] = raw_dist & 0xFF
+    frames[:, 3] = raw_dist >> 8
+    frames[:, 4] = raw_strength & 0xFF
+    frames[:, 5] = raw_strength >> 8
+    frames[:, 6] = raw_temp & 0xFF
+    frames[:, 7] = raw_temp >> 8
+    frames[:, 8] = frames[:, :8].sum(axis=1, dtype=np.uint32) & 0xFF
+    return frames
+
+
+class _PacedSerial:
+    """
+    Base for fake serial ports where data shows up at a fixed rate in real time.
+
+    Only the parts of the pyserial interface used by tfmini_s.Sensor are implemented. Data is generated lazily whenever
+    it's asked for, so nothing has to run in the background. If the data isn't read fast enough, the buffer overflows
+    like a real UART would, and the lost bytes are counted in overrun.
+    """
+
+    def __init__(self, byte_rate: float, buffer_size: int = UART_BUFFER_SIZE) -> None:
+        self.byte_rate = byte_rate
+        self.buffer_size = buffer_size
+        self.overrun = 0
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._made = 0
+
+    def _generate(self, start: int, count: int) -> bytes:
+        """
+        Make count bytes, starting from the start'th byte since the port was opened.
+        """
+        raise NotImplementedError
+
+    def _step(self) -> int:
+        """
+        Number of bytes that are always generated together, e.g. one frame.
+        """
+        return 1
+
+    def _fill(self) -> None:
+        step = self._step()
+        due = int((time.monotonic() - self._start) * self.byte_rate) // step * step - self._made
+        if due <= 0:
+            return
+        space = (self.buffer_size - len(self._buf)) // step * step
+        count = min(due, space)
+        if count:
+            self._buf.extend(self._generate(self._made, count))
+        self.overrun += due - count
+        self._made += due
+
+    @property
+    def in_waiting(self) -> int:
+        with self._lock:
+            self._fill()
+            return len(self._buf)
+
+    def read(self, size: int = 1) -> bytes:
+        """
+        Read size bytes, blocking until they're available.
+        """
+        while True:
+            with self._lock:
+                self._fill()
+                if len(self._buf) >= size:
+                    data = bytes(self._buf[:size])
+                    del self._buf[:size]
+                    return data
+                missing = size - len(self._buf)
+            time.sleep(max(missing / self.byte_rate, 1e-4))
+
+    def reset_input_buffer(self) -> None:
+        with self._lock:
+            self._fill()
+            self._buf.clear()
+
+    def close(self) -> None:
+        pass
+
+
+class SimulatedSerial(_PacedSerial):
+    """
+    Fake TFmini-S serial port, sending a frame every 1 / rate seconds.
+
+    range_function gives the distance and strength at the time of each frame; by default it's a wall 5m away. A
+    fraction error_rate of the frames get a bad checksum, and a fraction dropout_rate are sent with no distance, like
+    when the sensor doesn't get a return. precision has the same meaning as for tfmini_s.Sensor.
+    """
+
+    def __init__(self, range_function: RangeFunction = None, rate: float = 1000, precision: float = 1,
+                 error_rate: float = 0, dropout_rate: float = 0, temp: float = 25, seed: int = None,
+                 buffer_size: int = UART_BUFFER_SIZE) -> None:
+        super().__init__(rate * FRAME_SIZE, buffer_size)
+        self.range_function = range_function or constant_range(5)
+        self.rate = rate
+        self.precision = precision
+        self.error_rate = error_rate
+        self.dropout_rate = dropout_rate
+        self.temp = temp
+        self.rng = np.random.default_rng(seed)
+
+    def _step(self) -> int:
+        return FRAME_SIZE
+
+    def _generate(self, start: int, count: int) -> bytes:
+        first = start // FRAME_SIZE
+        t = self._start + (first + np.arange(count // FRAME_SIZE) + 1) / self.rate
+        dist, strength = self.range_function(t)
+        dist = np.where(self.rng.random(len(t)) < self.dropout_rate, -1, dist)
+        frames = encode_frames(dist, strength, np.full(len(t), self.temp), self.precision)
+        bad = self.rng.random(len(t)) < self.error_rate
+        frames[bad, -1] += 1
+        return frames.tobytes()
+
+
+class ReplaySerial(_PacedSerial):
+    """
+    Fake serial port that replays the raw bytes from a capture of the sensor, at rate frames per second.
+
+    If loop is True, the capture starts over when it runs out; otherwise, nothing more is sent.
+    """
+
+    def __init__(self, path: str, rate: float = 1000, loop: bool = True, buffer_size: int = UART_BUFFER_SIZE) -> None:
+        super().__init__(rate * FRAME_SIZE, buffer_size)
+        with open(path, "rb") as f:
+            self.data = f.read()
+        if not self.data:
+            raise ValueError(f"{path} is empty")
+        self.loop = loop
+
+    def _generate(self, start: int, count: int) -> bytes:
+        if not self.loop:
+            return self.data[start:start + count]
+        n = len(self.data)
+        idx = (start + np.arange(count)) % n
+        return np.frombuffer(self.data, dtype=np.uint8)[idx].tobytes()
+
+
+class MockServo:
+    """
+    Stand-in for gpiozero.AngularServo that models how long the servo takes to get to its position.
+
+    Like the real thing, angle is the last commanded angle. The actual position moves towards it at slew_rate degrees
+    per second, and can be found for any recent time with position(). The default slew rate is about right for
+    a typical hobby servo (0.1s per 60 degrees).
+    """
+
+    # How long to keep commands for, in seconds; position() is only accurate within this long of the last command
+    HISTORY = 2
+
+    def __init__(self, initial_angle: float = 0, min_angle: float = -135, max_angle: float = 135,
+                 slew_rate: float = 600) -> None:
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+        self.slew_rate = slew_rate
+        self._angle = initial_angle
+        # (time, position at that time, target); replaced instead of modified so readers always see a consistent list
+        self._commands = [(time.monotonic(), initial_angle, initial_angle)]
+
+    @property
+    def angle(self) -> float:
+        return self._angle
+
+    @angle.setter
+    def angle(self, value: float) -> None:
+        if not self.min_angle <= value <= self.max_angle:
+            raise ValueError(f"Servo angle must be between {self.min_angle} and {self.max_angle}, got {value}")
+        now = time.monotonic()
+        commands = self._commands
+        # Drop old commands, but always keep at least the last one
+        keep = next((i for i, c in enumerate(commands) if c[0] >= now - self.HISTORY), len(commands) - 1)
+        self._commands = commands[keep:] + [(now, float(self.position(now)), value)]
+        self._angle = value
+
+    def position(self, t) -> np.ndarray:
+        """
+        Get the actual position of the servo at time t (a time.monotonic() timestamp, or an array of them).
+        """
+        commands = np.array(self._commands)
+        i = np.maximum(np.searchsorted(commands[:, 0], t, side="right") - 1, 0)
+        t0, start, target = commands[i].T
+        travel = np.clip(np.asarray(t) - t0, 0, None) * self.slew_rate
+        return start + np.clip(target - start, -travel, travel)
+
+
+def constant_range(dist: float, strength: int = 1000) -> RangeFunction:
+    """
+    Range function for a flat target at a constant distance.
+    """
+    def range_function(t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return np.full(len(t), dist), np.full(len(t), strength)
+    return range_function
+
+
+class RangeImage:
+    """
+    Range function that casts rays from the scanner against a point cloud, pointing wherever the mock servos are.
+
+    The points (relative to the scanner) are binned by direction into a grid with cells resolution degrees across,
+    keeping the closest point in each. Looking up a ray is then just indexing into the grid, so this easily keeps up
+    with high sample rates. Rays that don't hit anything within max_range get no reading.
+    """
+
+    def __init__(self, points: np.ndarray, h_servo: MockServo, v_servo: MockServo, resolution: float = 0.5,
+                 arm_length: float = 0.05, max_range: float = 12) -> None:
+        self.h_servo = h_servo
+        self.v_servo = v_servo
+        self.resolution = resolution
+        self.arm_length = arm_length
+        self.max_range = max_range
+        self.shape = (int(round(360 / resolution)), int(round(180 / resolution)) + 1)
+        r = np.linalg.norm(points, axis=1)
+        theta = np.degrees(np.arctan2(points[:, 1], points[:, 0]))
+        phi = np.degrees(np.arctan2(points[:, 2], np.hypot(points[:, 0], points[:, 1])))
+        self.depth = np.full(self.shape, np.inf)
+        np.minimum.at(self.depth, self._cells(theta, phi), r)
+
+    def _cells(self, theta: np.ndarray, phi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        i = np.round((np.asarray(theta) + 180) / self.resolution).astype(np.intp) % self.shape[0]
+        j = np.clip(np.round((np.asarray(phi) + 90) / self.resolution).astype(np.intp), 0, self.shape[1] - 1)
+        return i, j
+
+    def __call__(self, t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        r = self.depth[self._cells(self.h_servo.position(t), self.v_servo.position(t))]
+        # The range measured by the sensor doesn't include the servo arm (see projection.to_cartesian)
+        dist = np.where(r <= self.max_range, r - self.arm_length, -1)
+        # Return strength falls off with the square of the distance
+        strength = np.clip(20000 / np.maximum(r, 0.1) ** 2, 100, 0xFFFE)
+        return dist, strength
+
+    @classmethod
+    def from_file(cls, path: str, h_servo: MockServo, v_servo: MockServo,
+                  origin: Tuple[float, float, float] = (0, 0, 0), **kwargs) -> "RangeImage":
+        """
+        Make a range image from a point cloud file, with the scanner at origin.
+        """
+        # The point cloud readers are in the processing code
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "algo"))
+        import cloudio
+        with cloudio.open_reader(path) as reader:
+            points = np.concatenate([chunk["xyz"] for chunk in reader.chunks()])
+        return cls(points - np.asarray(origin), h_servo, v_servo, **kwargs)
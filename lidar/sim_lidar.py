@@ -0,0 +1,72 @@
+"""
+Run the scanning pipeline against simulated hardware, sending to the processing server like rpi_lidar.py does.
+
+Useful for load testing lidar_demo.py (or anything else using the server end) on any machine. Ranges come from
+ray casting against a point cloud (--tree), replaying a raw capture from the sensor (--replay), or a flat wall.
+"""
+import argparse
+import socket
+import time
+import protocol
+import sim
+import tfmini_s
+from lidar import Lidar
+
+parser = argparse.ArgumentParser(description="Run simulated scans and send them to the processing server.")
+parser.add_argument("server", help="host:port of the processing server")
+source = parser.add_mutually_exclusive_group()
+source.add_argument("--tree", help="Point cloud to scan, with the scanner at the origin")
+source.add_argument("--replay", help="Raw sensor capture to replay")
+parser.add_argument("--rate", type=float, default=1000, help="Sensor sample rate in Hz")
+parser.add_argument("--error-rate", type=float, default=0, help="Fraction of frames with bad checksums")
+parser.add_argument("--dropout-rate", type=float, default=0, help="Fraction of frames with no distance")
+parser.add_argument("--slew-rate", type=float, default=600, help="Servo speed in degrees/s")
+parser.add_argument("--scans", type=int, default=1, help="Number of scans to run")
+parser.add_argument("--theta", type=float, nargs=2, default=(-30, 30), help="Horizontal scan range in degrees")
+parser.add_argument("--phi", type=float, nargs=2, default=(0, 30), help="Vertical scan range in degrees")
+parser.add_argument("--points", type=int, nargs=2, default=(240, 240), help="Scan steps (horizontal, vertical)")
+parser.add_argument("--step-time", type=float, default=0.01,
+                    help="Time per step of the slow axis (or per step along each sweep for adaptive scans) in seconds")
+parser.add_argument("--adaptive", type=float, nargs=2, default=None, metavar=("COARSE", "FINE"),
+                    help="Do adaptive scans with these step sizes in degrees instead of raster scans")
+parser.add_argument("--encoding", choices=["int16", "float32"], default="int16", help="Point encoding on the wire")
+args = parser.parse_args()
+
+SENSOR_PRECISION = 0.1
+FRAME_POINTS = 256
+FRAME_LATENCY = 0.05
+
+h_servo = sim.MockServo(slew_rate=args.slew_rate)
+v_servo = sim.MockServo(slew_rate=args.slew_rate)
+if args.replay:
+    ser = sim.ReplaySerial(args.replay, args.rate)
+else:
+    target = sim.RangeImage.from_file(args.tree, h_servo, v_servo) if args.tree else None
+    ser = sim.SimulatedSerial(target, args.rate, SENSOR_PRECISION, args.error_rate, args.dropout_rate)
+sensor = tfmini_s.Sensor(None, precision=SENSOR_PRECISION, ser=ser)
+
+encoding = protocol.ENC_INT16_MM if args.encoding == "int16" else protocol.ENC_FLOAT32
+with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sender = protocol.FrameSender(sock, encoding, FRAME_POINTS, FRAME_LATENCY)
+    lidar = Lidar(None, None, SENSOR_PRECISION, None, None, 0, sender.send, sample_rate=args.rate,
+                  batch_size=FRAME_POINTS, batch_timeout=FRAME_LATENCY, sensor=sensor, h_servo=h_servo, v_servo=v_servo)
+    host, port = args.server.split(":")
+    sock.connect((host, int(port)))
+    print(f"Connected, using protocol version {sender.negotiate()}")
+
+    for i in range(args.scans):
+        lidar.reset()
+        start = time.monotonic()
+        bytes_sent = sender.bytes_sent
+        if args.adaptive:
+            lidar.scan_adaptive(args.theta[0], args.theta[1], args.phi[0], args.phi[1], *args.adaptive,
+                                args.step_time, print_progress=True)
+        else:
+            lidar.scan_v(args.theta[0], args.theta[1], args.phi[0], args.phi[1],
+                         (args.theta[1] - args.theta[0]) / args.points[0],
+                         (args.phi[1] - args.phi[0]) / args.points[1], args.step_time, print_progress=True)
+        sender.new_scan()
+        elapsed = time.monotonic() - start
+        print(f"Scan {i + 1}/{args.scans} done in {elapsed:.1f}s, sent {sender.bytes_sent - bytes_sent} bytes "
+              f"({(sender.bytes_sent - bytes_sent) / elapsed / 1024:.1f} KiB/s), "
+              f"{ser.overrun} bytes lost to serial overruns so far")
@@ -1,25 +1,114 @@
-from typing import Tuple
+from typing import NamedTuple, Tuple
+import numpy as np
 import serial
 
 
+FRAME_SIZE = 9
+HEADER_BYTE = 0x59
+
+
 class ChecksumError(Exception):
     """
     Indicates that the checksum was incorrect, possibly due to a hardware issue in the serial line.
     """
 
 
+class Readings(NamedTuple):
+    """
+    A batch of decoded readings, as returned by Sensor.read_available() and Sensor.read_many().
+
+    dist is in meters (-1 where the sensor could not measure a distance), strength is between 0 and 65535 (-1 on
+    overflow), and temp is in degrees Celsius. checksum_errors is the number of frames that had a valid header but
+    failed the checksum, and skipped_bytes is the number of bytes that were thrown away (including those bad frames).
+    """
+    dist: np.ndarray
+    strength: np.ndarray
+    temp: np.ndarray
+    checksum_errors: int
+    skipped_bytes: int
+
+
+def decode_frames(data, precision: float = 1) -> Tuple[Readings, int]:
+    """
+    Decode every valid frame in a buffer of raw bytes from the sensor.
+
+    data can be anything that supports the buffer protocol (bytes, bytearray, memoryview); it is not copied.
+
+    Returns a tuple of (readings, consumed), where consumed is the number of bytes from the start of data that have
+    been fully processed. Any bytes after that might be the start of a frame that hasn't been fully received yet and
+    should be kept for the next call.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    n = len(buf)
+    # Find every position where a full frame could start, then check all the checksums at once
+    # Frame bytes are Header Header Dist_L Dist_H Strength_L Strength_H Temp_L Temp_H Checksum
+    is_header = buf[:-1] == HEADER_BYTE
+    cand = np.flatnonzero(is_header[:max(n - FRAME_SIZE + 1, 0)] & is_header[1:max(n - FRAME_SIZE + 2, 1)])
+    frames = buf[cand[:, None] + np.arange(FRAME_SIZE)]
+    good = (frames[:, :-1].sum(axis=1, dtype=np.uint32) & 0xFF) == frames[:, -1]
+    starts = cand[good]
+    # A valid-looking frame could show up inside of another one by chance (e.g. a distance of 0x5959 followed by the
+    # right bytes), so throw away anything that overlaps with an earlier frame
+    # This is really rare, so only fall back to the slow path when it actually happens
+    if np.any(np.diff(starts) < FRAME_SIZE):
+        keep = []
+        last_end = 0
+        for s in starts:
+            if s >= last_end:
+                keep.append(s)
+                last_end = s + FRAME_SIZE
+        starts = np.array(keep, dtype=np.intp)
+    frames = buf[starts[:, None] + np.arange(FRAME_SIZE)].astype(np.uint16)
+
+    # Bad frames that overlap a good frame are just coincidental 0x59 bytes and don't count as checksum errors
+    bad = cand[~good]
+    if len(starts):
+        i = np.searchsorted(starts, bad)
+        overlaps_next = (i < len(starts)) & (starts[np.minimum(i, len(starts) - 1)] - bad < FRAME_SIZE)
+        overlaps_prev = (i > 0) & (bad - starts[np.maximum(i - 1, 0)] < FRAME_SIZE)
+        checksum_errors = int(np.count_nonzero(~(overlaps_next | overlaps_prev)))
+    else:
+        checksum_errors = len(bad)
+
+    # Everything up to the end of the last frame is done with; after that, keep the bytes from the first possible
+    # header onwards, since they could be the start of a frame that's still being received
+    consumed = int(starts[-1]) + FRAME_SIZE if len(starts) else 0
+    tail_start = max(consumed, n - FRAME_SIZE + 1)
+    tail = buf[tail_start:] == HEADER_BYTE
+    # A lone 0x59 at the very end might still become a header, but 0x59 followed by something else can't
+    tail[:-1] &= buf[tail_start + 1:] == HEADER_BYTE
+    tail = np.flatnonzero(tail)
+    consumed = tail_start + int(tail[0]) if len(tail) else n
+
+    dist = frames[:, 2] | (frames[:, 3] << 8)
+    strength = (frames[:, 4] | (frames[:, 5] << 8)).astype(np.int32)
+    temp = (frames[:, 6] | (frames[:, 7] << 8)) / 8 - 256
+    # Distances of -1, -2, or -4
+    no_dist = (dist == 0xFFFF) | (dist == 0xFFFE) | (dist == 0xFFFC)
+    strength[strength == 0xFFFF] = -1
+    readings = Readings(np.where(no_dist, -1, dist / 100 * precision), strength, temp,
+                        checksum_errors, consumed - len(starts) * FRAME_SIZE)
+    return readings, consumed
+
+
 class Sensor:
     """
     TFmini-S LiDAR sensor over serial.
 
     Precision is the output precision in cm. For example, if the sensor is configured to output in cm,
     precision would be 1.0; if the sensor outputs in mm, then precision is 0.1.
+
+    If ser is given, it's used instead of opening device, e.g. to use one of the simulated serial ports in sim.py.
     """
 
-    def __init__(self, device: str, baudrate: int = 115200, precision: float = 1):
-        self.ser = serial.Serial(device, baudrate, bytesize=serial.EIGHTBITS,
-                                 parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
+    def __init__(self, device: str, baudrate: int = 115200, precision: float = 1, ser=None):
+        if ser is None:
+            ser = serial.Serial(device, baudrate, bytesize=serial.EIGHTBITS,
+                                parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
+        self.ser = ser
         self.precision = precision
+        # Leftover bytes of a partial frame from the last call to read_available()
+        self._pending = bytearray()
 
     def read(self, clear_buf: bool = False) -> Tuple[float, int, float]:
         """
@@ -36,7 +125,7 @@ class Sensor:
         Raises ChecksumError on checksum mismatch.
         """
         if clear_buf:
-            self.ser.reset_input_buffer()
+            self.clear_buf()
         # Format: 0x59 0x59 Dist_L Dist_H Strength_L Strength_H Temp_L Temp_H Checksum
         # First read bytes until we see the full header
         start_byte_count = 0
@@ -66,11 +155,53 @@ class Sensor:
             strength = -1
         return dist / 100 * self.precision, strength, temp
 
+    def read_available(self) -> Readings:
+        """
+        Read and decode all readings currently in the receive buffer, without blocking.
+
+        This does a single read for everything that's waiting instead of reading byte by byte, so it can keep up with
+        the sensor at 1kHz. Any partial frame at the end is kept and completed on the next call. Note that this keeps
+        its own state, so don't mix it with read() unless the buffer is cleared in between.
+
+        Returns a Readings tuple of arrays. Unlike read(), distances that could not be measured are exactly -1.
+        """
+        waiting = self.ser.in_waiting
+        data = self.ser.read(waiting) if waiting else b""
+        if self._pending:
+            self._pending.extend(data)
+            data = self._pending
+        readings, consumed = decode_frames(data, self.precision)
+        self._pending = bytearray(memoryview(data)[consumed:])
+        return readings
+
+    def read_many(self, min_count: int = 1) -> Readings:
+        """
+        Read and decode readings, blocking until at least min_count of them are available.
+
+        Returns a Readings tuple of arrays containing everything that was available, so the result could have more than
+        min_count readings. The error counts are totalled over all the reads that were needed.
+        """
+        batches = []
+        checksum_errors = skipped_bytes = count = 0
+        while True:
+            readings = self.read_available()
+            batches.append(readings)
+            checksum_errors += readings.checksum_errors
+            skipped_bytes += readings.skipped_bytes
+            count += len(readings.dist)
+            if count >= min_count:
+                break
+            # Block until at least the rest of one frame comes in
+            self._pending.extend(self.ser.read(max(FRAME_SIZE - len(self._pending), 1)))
+        return Readings(np.concatenate([b.dist for b in batches]), np.concatenate([b.strength for b in batches]),
+                        np.concatenate([b.temp for b in batches]), checksum_errors, skipped_bytes)
+
     def clear_buf(self) -> None:
         """
         Clear the serial input buffer.
         """
         self.ser.reset_input_buffer()
+        self._pending.clear()
 
     def readings_avail(self) -> int:
         """